@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Benchmark gbp_format_changelog on synthetic commits.
+
+Formats the same commits one at a time with the baseline formatter (by
+default, scripts/gbp_format_changelog as it was before its last change),
+and in one format_changelog_entries() call with the current one, checking
+both produce identical entries. Needs git-buildpackage's gbp module. Run
+from the top of the repository:
+
+    python3 -m benchmarks.bench_gbp_format_changelog --count 10000
+"""
+
+import argparse
+import importlib.machinery
+import importlib.util
+import random
+import subprocess
+import tempfile
+import time
+
+from gbp.git.modifier import GitModifier
+from gbp.scripts import dch as gbp_dch
+
+FORMATTER = "scripts/gbp_format_changelog"
+AUTHORS = ("Chad Smith", "James Falcon", "Jane Contributor", "John Q Public")
+WORDS = (
+    "fix add drop handle network datasource config cloud module schema "
+    "render netplan ephemeral dhcp metadata retry timeout hotplug"
+).split()
+
+
+def load_formatter(path, name="gbp_format_changelog"):
+    """Import a formatter file, which has no .py suffix."""
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(name, loader)
+    )
+    loader.exec_module(module)
+    return module
+
+
+def baseline_source() -> str:
+    """Return the formatter as of before the commit that last changed it."""
+    last_change = subprocess.run(
+        ["git", "rev-list", "-1", "HEAD", "--", FORMATTER],
+        capture_output=True,
+        check=True,
+        universal_newlines=True,
+    ).stdout.strip()
+    return subprocess.run(
+        ["git", "show", f"{last_change}~:{FORMATTER}"],
+        capture_output=True,
+        check=True,
+        universal_newlines=True,
+    ).stdout
+
+
+def generate_commits(count, seed=0):
+    """Generate gbp commit_info dicts with cloud-init style subjects."""
+    rng = random.Random(seed)
+    commits = []
+    for i in range(count):
+        subject = " ".join(rng.choices(WORDS, k=rng.randint(3, 18)))
+        kind = rng.random()
+        if kind < 0.3:
+            subject = f"feat({rng.choice(WORDS)}): {subject}"
+        if kind < 0.5:
+            subject += f" (LP: #{rng.randint(1000000, 2099999)})"
+        elif kind < 0.55:
+            subject = rng.choice(
+                ("update changelog", "refresh patches against main")
+            )
+        commits.append(
+            {
+                "id": f"{rng.getrandbits(160):040x}",
+                "subject": subject,
+                "body": "",
+                "author": GitModifier(rng.choice(AUTHORS), "a@example.com"),
+                "files": {},
+            }
+        )
+    return commits
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="Formatter to compare against, instead of the previous one",
+    )
+    args = parser.parse_args()
+
+    if args.baseline:
+        baseline = load_formatter(args.baseline, "baseline")
+    else:
+        with tempfile.NamedTemporaryFile("w", suffix="_formatter") as f:
+            f.write(baseline_source())
+            f.flush()
+            baseline = load_formatter(f.name, "baseline")
+    current = load_formatter(FORMATTER)
+    options = gbp_dch.parse_args(["gbp dch", "--ignore-branch"])[0]
+    commits = generate_commits(args.count)
+
+    def run_baseline():
+        return [
+            baseline.format_changelog_entry(
+                commit, options, last_commit=i == len(commits) - 1
+            )
+            for i, commit in enumerate(commits)
+        ]
+
+    def run_current():
+        return current.format_changelog_entries(commits, options)
+
+    expected = run_baseline()
+    if expected != run_current():
+        raise SystemExit("format_changelog_entries() output differs")
+    print(f"{args.count} commits, identical entries, best of {args.repeat}")
+    timings = {}
+    for label, func in (
+        ("format_changelog_entry() per commit", run_baseline),
+        ("format_changelog_entries()", run_current),
+    ):
+        best = min(_time_once(func) for _ in range(args.repeat))
+        timings[label] = best
+        print(
+            f"{label:<40}{best * 1000:>10.2f} ms"
+            f"{args.count / best:>12.0f} commits/s"
+        )
+    baseline_time, current_time = timings.values()
+    print(f"{'speedup':<40}{baseline_time / current_time:>10.2f} x")
+
+
+def _time_once(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
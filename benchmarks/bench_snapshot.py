@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Benchmark new_upstream_snapshot() on synthetic packaging repositories.
+
+One axis of the repository shape is swept while the others keep their
+defaults. For each size, every pipeline stage is timed and the
+subprocesses it spawns are counted, giving time and subprocess count
+scaling curves. Run from the top of the repository:
+
+    python3 -m benchmarks.bench_snapshot --sweep commits=100,1000,10000
+    python3 -m benchmarks.bench_snapshot --save baseline.json
+    python3 -m benchmarks.bench_snapshot --compare baseline.json
+
+Refreshing quilt patches needs quilt installed; pass --patches 0 without.
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from typing import Dict, List
+from unittest import mock
+
+from benchmarks.synthetic_repo import RepoShape, distro_info, generate_repo
+from scripts import new_upstream_snapshot as snapshot
+
+ENVIRONMENT = {
+    "DEBFULLNAME": "J Doe",
+    "DEBEMAIL": "j.doe@example.com",
+    "GIT_AUTHOR_NAME": "J Doe",
+    "GIT_AUTHOR_EMAIL": "j.doe@example.com",
+    "GIT_COMMITTER_NAME": "J Doe",
+    "GIT_COMMITTER_EMAIL": "j.doe@example.com",
+}
+
+
+def _top_level_stages(events: List[snapshot.TraceEvent]):
+    """Return the stage events that aren't nested inside another stage."""
+    stages = [event for event in events if event.category == "stage"]
+    return [
+        event
+        for event in stages
+        if not any(
+            other is not event
+            and other.start_ns <= event.start_ns
+            and event.start_ns + event.duration_ns
+            <= other.start_ns + other.duration_ns
+            for other in stages
+        )
+    ]
+
+
+@contextmanager
+def quiet():
+    """Silence output, including that of subprocesses."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    try:
+        with open(os.devnull, "w") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            with redirect_stdout(io.StringIO()):
+                yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def measure_snapshot(repo) -> Dict:
+    """Snapshot main into the ubuntu/devel branch of repo once.
+
+    Return the wall time and number of subprocesses spawned, in total
+    and per stage. Anything spawned outside a stage is counted as "other".
+    """
+    spawned: List[int] = []
+    real_popen = subprocess.Popen
+
+    def counting_popen(*args, **kwargs):
+        spawned.append(time.perf_counter_ns())
+        return real_popen(*args, **kwargs)
+
+    cwd = os.getcwd()
+    os.chdir(repo)
+    snapshot.PROFILER.enabled = True
+    snapshot.PROFILER.events = []
+    try:
+        with quiet(), mock.patch(
+            "subprocess.Popen", side_effect=counting_popen
+        ):
+            start = time.perf_counter_ns()
+            snapshot.new_upstream_snapshot(
+                "main", interactive=False, fetch=False
+            )
+            snapshot.GIT.close()
+            total = time.perf_counter_ns() - start
+    finally:
+        snapshot.PROFILER.enabled = False
+        os.chdir(cwd)
+
+    stages = {}
+    remaining = set(spawned)
+    top_level = _top_level_stages(snapshot.PROFILER.events)
+    for event in top_level:
+        end = event.start_ns + event.duration_ns
+        inside = {t for t in remaining if event.start_ns <= t <= end}
+        remaining -= inside
+        stages[event.name] = {
+            "seconds": event.duration_ns / 1e9,
+            "spawns": len(inside),
+        }
+    stages["other"] = {
+        "seconds": (total - sum(e.duration_ns for e in top_level)) / 1e9,
+        "spawns": len(remaining),
+    }
+    return {"seconds": total / 1e9, "spawns": len(spawned), "stages": stages}
+
+
+def reset_repo(repo, head: str):
+    """Undo a snapshot, so the next run starts from the same state."""
+    for command in (
+        ["git", "reset", "-q", "--hard", head],
+        ["git", "clean", "-qfdx"],
+    ):
+        subprocess.run(command, cwd=repo, check=True)
+
+
+def benchmark(shape: RepoShape, repeat: int) -> Dict:
+    """Return the fastest of repeat snapshots of a repository of shape."""
+    with tempfile.TemporaryDirectory() as directory:
+        repo = os.path.join(directory, "repo")
+        start = time.perf_counter()
+        generate_repo(repo, shape)
+        generated = time.perf_counter() - start
+        head = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=repo,
+            check=True,
+            capture_output=True,
+            universal_newlines=True,
+        ).stdout.strip()
+        snapshot.DISTRO_INFO = distro_info(directory)
+        runs = []
+        for _ in range(repeat):
+            runs.append(measure_snapshot(repo))
+            reset_repo(repo, head)
+    result = min(runs, key=lambda run: run["seconds"])
+    result["shape"] = shape._asdict()
+    result["generate seconds"] = generated
+    return result
+
+
+def format_report(axis: str, results: List[Dict]) -> str:
+    """Return a table of seconds (and spawns) per stage for each size."""
+    names: List[str] = []
+    for result in results:
+        for name in result["stages"]:
+            if name not in names:
+                names.append(name)
+    width = 18
+    lines = [
+        f"{axis:<20}"
+        + "".join(f"{r['shape'][axis]:>{width}}" for r in results)
+    ]
+
+    def cell(stage):
+        if not stage:
+            return f"{'-':>{width}}"
+        return f"{stage['seconds']:>10.3f}s ({stage['spawns']:>3})"
+
+    for name in names:
+        lines.append(
+            f"{name[:19]:<20}"
+            + "".join(cell(r["stages"].get(name)) for r in results)
+        )
+    lines.append(f"{'total':<20}" + "".join(cell(r) for r in results))
+    return "\n".join(lines)
+
+
+def compare(baseline: List[Dict], results: List[Dict], tolerance: float):
+    """Print how results differ from a baseline. Return the regressions.
+
+    Spawning more subprocesses is always a regression. Taking longer is
+    one when a stage is over tolerance slower and by more than 10 ms.
+    """
+    regressions = []
+    by_shape = {json.dumps(r["shape"], sort_keys=True): r for r in baseline}
+    for result in results:
+        old = by_shape.get(json.dumps(result["shape"], sort_keys=True))
+        if not old:
+            print(f"No baseline for {result['shape']}")
+            continue
+        print(f"Compared to baseline for {result['shape']}:")
+        stages = dict(result["stages"], total=result)
+        old_stages = dict(old["stages"], total=old)
+        for name, new in stages.items():
+            previous = old_stages.get(name)
+            if not previous:
+                print(f"  {name:<20} new stage")
+                continue
+            ratio = new["seconds"] / max(previous["seconds"], 1e-9)
+            spawns = new["spawns"] - previous["spawns"]
+            slower = (
+                ratio > 1 + tolerance
+                and new["seconds"] - previous["seconds"] > 0.01
+            )
+            flag = " REGRESSION" if slower or spawns > 0 else ""
+            print(
+                f"  {name[:19]:<20}{ratio:>8.2f}x time{spawns:>+6} spawns"
+                f"{flag}"
+            )
+            if flag:
+                regressions.append((result["shape"], name))
+    return regressions
+
+
+def parse_sweep(value: str):
+    axis, _, sizes = value.partition("=")
+    if axis not in RepoShape._fields or not sizes:
+        raise argparse.ArgumentTypeError(
+            f"expected AXIS=SIZE,... with AXIS one of "
+            f"{', '.join(RepoShape._fields)}"
+        )
+    field_type = type(getattr(RepoShape(), axis))
+    return axis, [field_type(size) for size in sizes.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--sweep",
+        type=parse_sweep,
+        default=parse_sweep("commits=100,1000,5000"),
+        help="The axis to vary and its sizes (default commits=100,1000,5000)",
+    )
+    for field, default in RepoShape._field_defaults.items():
+        parser.add_argument(
+            f"--{field.replace('_', '-')}",
+            type=type(default),
+            default=default,
+            help=f"Default {default}",
+        )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="FILE", help="Write results JSON")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Diff against a saved baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction slower a stage may be before it regresses",
+    )
+    args = parser.parse_args()
+
+    axis, sizes = args.sweep
+    base = RepoShape(**{f: getattr(args, f) for f in RepoShape._fields})
+    patches = sizes if axis == "patches" else [base.patches]
+    if max(patches) and not shutil.which("quilt"):
+        parser.error("quilt is needed to refresh patches, or use --patches 0")
+    os.environ.update(ENVIRONMENT)
+
+    results = []
+    for size in sizes:
+        shape = base._replace(**{axis: size})
+        print(f"Benchmarking {axis}={size}", file=sys.stderr)
+        results.append(benchmark(shape, args.repeat))
+    print(f"Best of {args.repeat}, seconds (subprocesses spawned)")
+    print(format_report(axis, results))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"sweep": axis, "results": results}, f, indent=1)
+        print(f"Wrote results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Micro-benchmark VersionInfo parsing, sorting and hashing.
+
+Run from the top of the repository:
+
+    python3 -m benchmarks.bench_version_info --count 10000
+"""
+
+import argparse
+import random
+import time
+
+from scripts.new_upstream_snapshot import VersionInfo
+
+
+def generate_versions(count, seed=0):
+    """Generate a corpus of cloud-init style archive versions."""
+    rng = random.Random(seed)
+    versions = []
+    for _ in range(count):
+        upstream = f"{rng.randint(17, 25)}.{rng.randint(1, 4)}"
+        kind = rng.choice(["release", "hotfix", "snapshot"])
+        if kind == "hotfix":
+            upstream += f".{rng.randint(0, 5)}"
+        elif kind == "snapshot":
+            upstream += f"~{rng.randint(1, 40)}g{rng.getrandbits(32):08x}"
+        version = f"{upstream}-0ubuntu{rng.randint(0, 9)}"
+        if kind != "snapshot" and rng.random() < 0.6:
+            series = rng.choice(["18.04", "20.04", "22.04", "24.04"])
+            version += f"~{series}.{rng.randint(1, 5)}"
+        versions.append(version)
+    return versions
+
+
+def timed(label, func, repeat):
+    """Print and return the best wall time of repeat calls to func."""
+    best = min(_time_once(func) for _ in range(repeat))
+    print(f"{label:<40}{best * 1000:>10.2f} ms")
+    return best
+
+
+def _time_once(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    versions = generate_versions(args.count)
+    print(f"{args.count} versions, best of {args.repeat}")
+    from_string = timed(
+        "from_string() per version",
+        lambda: [VersionInfo.from_string(v) for v in versions],
+        args.repeat,
+    )
+    parse_many = timed(
+        "parse_many()",
+        lambda: VersionInfo.parse_many(versions),
+        args.repeat,
+    )
+    print(f"{'parse_many() speedup':<40}{from_string / parse_many:>10.2f} x")
+    timed(
+        "parse_many() + sorted(key=sort_key)",
+        lambda: sorted(
+            VersionInfo.parse_many(versions), key=VersionInfo.sort_key
+        ),
+        args.repeat,
+    )
+    parsed = VersionInfo.parse_many(versions)
+    sorted(parsed)  # Sort keys are now cached on the instances
+    timed("sorted() with cached keys", lambda: sorted(parsed), args.repeat)
+    timed(
+        "sorted(key=sort_key) with cached keys",
+        lambda: sorted(parsed, key=VersionInfo.sort_key),
+        args.repeat,
+    )
+    timed("set() of parsed versions", lambda: set(parsed), args.repeat)
+    candidate = max(parsed).replace(epoch=1)
+    timed(
+        "check a new version sorts above all",
+        lambda: all(v < candidate for v in parsed),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Generate synthetic packaging repositories for benchmarking.
+
+The repositories mirror the layout new_upstream_snapshot.py expects: an
+upstream main branch with an annotated release tag, and a ubuntu/devel
+packaging branch holding debian/changelog, quilt patches and cpicks of
+upstream commits. History is written with a single 'git fast-import', so
+repositories with many thousands of commits take seconds to build.
+"""
+
+import subprocess
+from datetime import date
+from pathlib import Path
+from random import Random
+from typing import Dict, List, NamedTuple
+
+from scripts.new_upstream_snapshot import DistroInfo
+
+PACKAGE = "synthetic"
+PACKAGED_VERSION = "1.0"
+DEVEL_SERIES = "bseries"
+AUTHOR = "J Doe <j.doe@example.com>"
+EPOCH = 1262304000  # 2010-01-01
+INITIAL_LINES = 10
+
+DISTRO_INFO_CSV = """\
+version,codename,series,created,release,eol,eol-server
+10.04 LTS,Aseries,aseries,2009-10-29,2010-04-29,2013-05-09,2015-04-30
+10.10,Bseries,bseries,2010-04-29,2010-10-10,2012-04-10
+"""
+DISTRO_INFO_TODAY = date(2010, 6, 1)  # bseries is in development
+
+
+class RepoShape(NamedTuple):
+    """The size of a synthetic repository along each benchmarked axis."""
+
+    commits: int = 200  # upstream commits after the packaged release
+    changelog_entries: int = 50
+    patches: int = 10  # quilt patches that aren't cpicks
+    cpicks: int = 5
+    lp_density: float = 0.3  # fraction of commits with an LP: trailer
+    files: int = 50
+    seed: int = 0
+
+
+def distro_info(directory) -> DistroInfo:
+    """Write release data matching the generated changelog."""
+    path = Path(directory, "ubuntu.csv")
+    path.write_text(DISTRO_INFO_CSV)
+    return DistroInfo(path, today=DISTRO_INFO_TODAY)
+
+
+class _FastImport:
+    """Write a git fast-import stream for one repository."""
+
+    def __init__(self, path: Path):
+        self.marks = path / ".git" / "synthetic-marks"
+        self.process = subprocess.Popen(
+            ["git", "fast-import", "--quiet", f"--export-marks={self.marks}"],
+            cwd=path,
+            stdin=subprocess.PIPE,
+        )
+        self.time = EPOCH
+        self.mark = 0
+
+    def _data(self, text: str) -> bytes:
+        data = text.encode()
+        return b"data %d\n%s\n" % (len(data), data)
+
+    def commit(self, ref, message, files: Dict[str, str], parent=None) -> int:
+        self.mark += 1
+        self.time += 60
+        ident = f"{AUTHOR} {self.time} +0000"
+        chunks = [
+            f"commit {ref}\nmark :{self.mark}\n"
+            f"author {ident}\ncommitter {ident}\n".encode(),
+            self._data(message),
+        ]
+        if parent:
+            chunks.append(f"from {parent}\n".encode())
+        for path, content in files.items():
+            chunks.append(f"M 100644 inline {path}\n".encode())
+            chunks.append(self._data(content))
+        self.write(b"".join(chunks))
+        return self.mark
+
+    def tag(self, name, mark, message):
+        ident = f"{AUTHOR} {self.time} +0000"
+        self.write(
+            f"tag {name}\nfrom :{mark}\ntagger {ident}\n".encode()
+            + self._data(message)
+        )
+
+    def write(self, chunk: bytes):
+        assert self.process.stdin
+        self.process.stdin.write(chunk)
+
+    def close(self) -> Dict[int, str]:
+        """Finish the import, returning the commit id of every mark."""
+        self.process.communicate()
+        if self.process.returncode:
+            raise subprocess.CalledProcessError(
+                self.process.returncode, "git fast-import"
+            )
+        marks = {}
+        for line in self.marks.read_text().splitlines():
+            mark, sha = line.split()
+            marks[int(mark[1:])] = sha
+        self.marks.unlink()
+        return marks
+
+
+def _changelog(entries: int, rng: Random) -> str:
+    stanzas = []
+    for i in range(entries):
+        version = f"{PACKAGED_VERSION}-0ubuntu1"
+        if i:
+            version = f"0.{entries - i}-0ubuntu1"
+        changes = "".join(
+            f"  * Synthetic change {rng.getrandbits(32):08x}"
+            f" (LP: #{rng.randint(100000, 999999)})\n"
+            for _ in range(rng.randint(1, 5))
+        )
+        stamp = date.fromordinal(DISTRO_INFO_TODAY.toordinal() - i * 7)
+        stanzas.append(
+            f"{PACKAGE} ({version}) {DEVEL_SERIES}; urgency=medium\n\n"
+            f"{changes}\n"
+            f" -- {AUTHOR}  {stamp.strftime('%a, %d %b %Y')} 12:00:00 +0000\n"
+        )
+    return "\n".join(stanzas)
+
+
+def _hunk(path, lines: List[str], start: int, old: str, new: str) -> str:
+    """Return a quilt style patch replacing old with new at line start."""
+    before = lines[max(0, start - 3) : start]
+    after = lines[start + 1 : start + 4]
+    old_lines = [f" {line}" for line in before] + [f"-{old}"]
+    new_lines = [f" {line}" for line in before] + [f"+{new}"]
+    context = [f" {line}" for line in after]
+    first = start - len(before) + 1
+    return (
+        f"--- a/{path}\n+++ b/{path}\n"
+        f"@@ -{first},{len(old_lines) + len(context)} "
+        f"+{first},{len(new_lines) + len(context)} @@\n"
+        + "\n".join(old_lines + new_lines[len(before) :] + context)
+        + "\n"
+    )
+
+
+def generate_repo(path, shape: RepoShape = RepoShape()) -> None:
+    """Create a synthetic packaging repository of the given shape at path.
+
+    ubuntu/devel is left checked out, ready for a snapshot of main.
+    """
+    rng = Random(shape.seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    subprocess.run(["git", "init", "-q", path], check=True)
+    importer = _FastImport(path)
+
+    # Upstream: the packaged release, followed by appends to random files
+    # Every quilt patch gets a file of its own
+    files = max(shape.files, shape.patches, 1)
+    paths = [f"src/file_{i}.txt" for i in range(files)]
+    contents = {
+        p: [f"{p} line {j}" for j in range(INITIAL_LINES)] for p in paths
+    }
+    release = importer.commit(
+        "refs/heads/main",
+        f"Release {PACKAGED_VERSION}\n",
+        {p: "\n".join(lines) + "\n" for p, lines in contents.items()},
+    )
+    importer.tag(PACKAGED_VERSION, release, f"release {PACKAGED_VERSION}\n")
+    appends = []  # (path, line number before the append) per commit
+    for i in range(shape.commits):
+        changed = rng.choice(paths)
+        appends.append((changed, len(contents[changed])))
+        contents[changed].append(f"{changed} line {len(contents[changed])}")
+        message = f"Change {i} to {changed}\n"
+        if rng.random() < shape.lp_density:
+            message += f"\nLP: #{200000 + i}\n"
+        importer.commit(
+            "refs/heads/main",
+            message,
+            {changed: "\n".join(contents[changed]) + "\n"},
+        )
+    marks = importer.close()
+
+    # Packaging: cpicks of some upstream commits, then the quilt patches
+    importer = _FastImport(path)
+    debian = {
+        "debian/changelog": _changelog(max(shape.changelog_entries, 1), rng)
+    }
+    series = []
+    cpicked = sorted(
+        rng.sample(range(shape.commits), min(shape.cpicks, shape.commits))
+    )
+    for index in cpicked:
+        changed, line = appends[index]
+        name = f"cpick-{marks[release + 1 + index][:8]}-Change-{index}"
+        lines = [f"{changed} line {j}" for j in range(line)]
+        debian[f"debian/patches/{name}"] = (
+            f"--- a/{changed}\n+++ b/{changed}\n"
+            f"@@ -{line - 2},3 +{line - 2},4 @@\n"
+            + "".join(f" {text}\n" for text in lines[-3:])
+            + f"+{changed} line {line}\n"
+        )
+        series.append(name)
+    for i in range(shape.patches):
+        patched = paths[i]
+        base = [f"{patched} line {j}" for j in range(INITIAL_LINES)]
+        name = f"synthetic-change-{i}.patch"
+        debian[
+            f"debian/patches/{name}"
+        ] = f"Description: Synthetic change {i}\nAuthor: {AUTHOR}\n\n" + _hunk(
+            patched, base, 0, base[0], f"{base[0]} (patched)"
+        )
+        series.append(name)
+    debian["debian/patches/series"] = "".join(f"{s}\n" for s in series)
+    importer.commit(
+        "refs/heads/ubuntu/devel",
+        "Add packaging\n",
+        debian,
+        parent=marks[release],
+    )
+    importer.close()
+    subprocess.run(
+        ["git", "checkout", "-q", "ubuntu/devel"], cwd=path, check=True
+    )
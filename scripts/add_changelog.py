@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """add_changelog: add unreleased commits to debian/changelog
 
-Use gbp-dch and dch tooling to inject time-ordered changelog comments
-for each commit into the package's debian/changelog.
+Inject time-ordered changelog comments for each commit into the package's
+debian/changelog, formatted by gbp-dch's customizations as 'gbp dch' and
+'dch' would.
 
 This script is typically invoked from new-upstream-snapshot when pulling
 down all upstream commits into a packaging branch.
@@ -12,16 +13,28 @@ https://github.com/canonical/uss-tableflip/blob/main/doc/ubuntu_release_process.
 """
 
 import argparse
+import hashlib
+import importlib.util
+import json
 import os
 import re
+import runpy
+import shutil
 import sys
-from subprocess import check_output
+import tempfile
+import textwrap
+from contextlib import contextmanager
+from email.utils import formatdate
+from subprocess import DEVNULL, CalledProcessError, check_output
+from typing import Callable, Dict, List, Optional, Tuple
 
 NEW_UPSTREAM_MSG = "New upstream"
-PKG_RELEASE_RE = (
+PKG_RELEASE_RE = re.compile(
     r"(?P<pkg_name>[^ ]+) \((?P<version>[^)]+)\) (?P<dist>[^;]+);"
     r" urgency=(?P<urgency>\w+).*"
 )
+# A "+ ..." line of a previous snapshot's upstream changes
+SNAPSHOT_ITEM_RE = re.compile(r"^ +\+ ?")
 CHANGELOG_FILE = "debian/changelog"
 GIT_GBP_CONF = ".git/gbp.conf"
 PACKAGE_GBP_CONF = "debian/gbp.conf"
@@ -39,6 +52,35 @@ DEFAULT_GBP_CONF = os.path.join(os.path.dirname(__file__), "gbp.conf")
 DEFAULT_GBP_CUSTOMIZATION = os.path.join(
     os.path.dirname(__file__), "gbp_format_changelog"
 )
+# Formatted commit entries from the previous run, kept in the git directory,
+# see format_commits()
+ENTRY_CACHE = "add_changelog_entries.json"
+
+# Formatting artifacts from gbp_format_changelog when lines are wrapped or
+# indented for scope, fixed in order on each line of the new stanza.
+FORMAT_FIXES = (
+    # Redact indented scope marker from "* +" to " +"
+    (re.compile(r" \* \+"), "   + "),
+    # Redact multi-line leading marker "* "
+    (re.compile(r"\*       "), "    "),
+    # Prepend the 6th leading space for multi-line wrapped entries if only
+    # 5 are present. Occurs when text-wrapping [Author Name] or (LP #<ID)
+    (re.compile(r"^(?=     [^ ])"), " "),
+)
+
+# dch wraps each item it adds with Text::Wrap at 80 columns, letting words
+# that don't fit on a line, like URLs, overflow
+DCH_WRAPPER = textwrap.TextWrapper(
+    width=79,
+    initial_indent="  * ",
+    subsequent_indent="    ",
+    break_long_words=False,
+    break_on_hyphens=False,
+)
+MAINTAINER_RE = re.compile(r"^\s*(?P<name>.*?)\s*<(?P<email>[^<>]+)>\s*$")
+
+# gbp dch customization modules, by path, loaded once per process
+_customizations: Dict[str, dict] = {}
 
 
 def get_parser():
@@ -74,12 +116,331 @@ def _get_gbp_env():
     return gbp_env
 
 
+@contextmanager
+def atomic_write(filename):
+    """Open a temporary file that replaces filename once closed cleanly."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(filename)}."
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_name)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def fix_line(line: str) -> str:
+    """Fix any gbp_format_changelog artifacts in a line of the new stanza."""
+    for pattern, replacement in FORMAT_FIXES:
+        line = pattern.sub(replacement, line, count=1)
+    return line
+
+
+def get_maintainer() -> str:
+    """Return the 'Name <email>' to sign changelog entries with.
+
+    Like dch, use DEBFULLNAME (or NAME) and DEBEMAIL (or EMAIL), which may
+    hold 'Name <email>'. Anything not set there comes from git's author
+    identity, as in new_upstream_snapshot.py, so both sign alike.
+    """
+    name = os.environ.get("DEBFULLNAME") or os.environ.get("NAME")
+    email = os.environ.get("DEBEMAIL") or os.environ.get("EMAIL")
+    match = MAINTAINER_RE.match(email or "")
+    if match:
+        name, email = name or match["name"], match["email"]
+    if not (name and email):
+        try:
+            ident = check_output(
+                ["git", "var", "GIT_AUTHOR_IDENT"],
+                stderr=DEVNULL,
+                universal_newlines=True,
+            )
+        except (OSError, CalledProcessError):
+            ident = ""
+        match = MAINTAINER_RE.match(ident.rpartition(">")[0] + ">")
+        if match:
+            name, email = name or match["name"], email or match["email"]
+    if not (name and email):
+        raise ValueError(
+            "Could not determine who to sign the changelog entry as. Set "
+            "DEBFULLNAME and DEBEMAIL, or git's user.name and user.email."
+        )
+    return f"{name} <{email}>"
+
+
+def format_dch_item(text: str) -> List[str]:
+    """Return the lines 'dch text' adds for text."""
+    return DCH_WRAPPER.wrap(text)
+
+
+def format_gbp_item(entry: List[str]) -> List[str]:
+    """Return the lines 'gbp dch' adds for a formatted commit entry."""
+    return [f"  * {entry[0]}"] + [f"    {line}" for line in entry[1:]]
+
+
+def add_to_top_stanza(
+    changelog: List[str], version: str, items: List[str]
+) -> List[str]:
+    """Return changelog with items added at version, as dch -v would.
+
+    An UNRELEASED top stanza gets items appended and its version set.
+    Otherwise a new UNRELEASED stanza is started. Either way, the stanza
+    is signed by get_maintainer() with the current date. Adding every
+    item at once rewrites the changelog once rather than once per item.
+    Like dch, nothing is added when there are no items.
+    """
+    if not items:
+        return changelog
+    header = PKG_RELEASE_RE.match(changelog[0])
+    for end, line in enumerate(changelog):
+        if line.startswith(" -- "):
+            break
+    else:
+        raise ValueError(f"No end found to the first {CHANGELOG_FILE} entry")
+    trailer = f" -- {get_maintainer()}  {formatdate(localtime=True)}"
+    if header["dist"] == "UNRELEASED":
+        body = "\n".join(changelog[1:end]).strip("\n")
+        return [
+            changelog[0][: header.start("version")]
+            + version
+            + changelog[0][header.end("version") :],
+            "",
+            *(body.splitlines() if body else []),
+            *items,
+            "",
+            trailer,
+            *changelog[end + 1 :],
+        ]
+    return [
+        f"{header['pkg_name']} ({version}) UNRELEASED; urgency=medium",
+        "",
+        *items,
+        "",
+        trailer,
+        "",
+        *changelog,
+    ]
+
+
+def adds_maintainer_markers(changelog: List[str]) -> bool:
+    """Return whether dch -v would mark who added items to changelog.
+
+    Unless run with --nomultimaint, dch adds "[ Name ]" markers when
+    items are appended to an UNRELEASED top stanza signed by someone else.
+    add_to_top_stanza() doesn't, so dch itself is left to add those.
+    """
+    if PKG_RELEASE_RE.match(changelog[0])["dist"] != "UNRELEASED":
+        return False
+    trailer = next(line for line in changelog if line.startswith(" -- "))
+    return not trailer.startswith(f" -- {get_maintainer()}  ")
+
+
+def read_top_stanza(filename: str = CHANGELOG_FILE) -> Tuple[List[str], int]:
+    """Return the lines of the top stanza of filename, and where it ends.
+
+    Reading stops at the top stanza's " -- " trailer, so the cost doesn't
+    depend on the length of the changelog.
+    """
+    lines = []
+    # Newlines aren't translated, so rest is where write_changelog() copies
+    # the older stanzas from as they are, line endings included
+    with open(filename, newline="") as f:
+        for line in iter(f.readline, ""):
+            lines.append(line.rstrip("\r\n"))
+            if line.startswith(" -- "):
+                break
+        return lines, f.tell()
+
+
+def write_changelog(top: List[str], rest: int):
+    """Replace the top stanza of the changelog, which ended at rest.
+
+    Formatting artifacts are fixed in the new top stanza, and the rest of
+    the changelog is copied unchanged.
+    """
+    with open(CHANGELOG_FILE, newline="") as source, atomic_write(
+        CHANGELOG_FILE
+    ) as f:
+        in_top_stanza = True
+        for line in top:
+            if line.startswith(" -- "):
+                in_top_stanza = False
+            f.write(f"{fix_line(line) if in_top_stanza else line}\n")
+        source.seek(rest)
+        shutil.copyfileobj(source, f)
+
+
+def _load_customizations(path: Optional[str]) -> dict:
+    """Return the globals of a gbp dch customization file, loaded once."""
+    if not path:
+        return {}
+    path = os.path.abspath(path)
+    if path not in _customizations:
+        _customizations[path] = runpy.run_path(path)
+    return _customizations[path]
+
+
+def get_gbp_entries(
+    gbp_args: List[str], changelog: List[str], gbp_env: Dict[str, str]
+) -> Optional[List[List[str]]]:
+    """Return the commit entries 'gbp dch <gbp_args>' would add.
+
+    gbp is used in process: commits are fed straight to the customized
+    format_changelog_entry, sparing a Python interpreter start and a
+    reimport of gbp and the customizations for every run. Return None if
+    gbp can't be imported by this interpreter, or if it is configured to
+    mark multiple maintainers, which only its dch calls lay out.
+    """
+    try:
+        import gbp.dch
+        from gbp.deb.changelog import ChangeLog
+        from gbp.deb.git import DebianGitRepository
+        from gbp.scripts import dch as gbp_dch
+    except ImportError:
+        return None
+
+    environ = dict(os.environ)
+    os.environ.update(gbp_env)
+    try:
+        # argv[0] names the gbp.conf section, as the gbp command passes it
+        options, _, _, _ = gbp_dch.parse_args(["dch", *gbp_args])
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+    if options.multimaint:
+        return None
+    repo = DebianGitRepository(".")
+    since = options.since or gbp_dch.guess_documented_commit(
+        ChangeLog(contents="\n".join(changelog) + "\n"),
+        repo,
+        options.debian_tag,
+    )
+    commits = repo.get_commits(
+        since=since, until="HEAD", options=options.git_log.split(" ")
+    )
+    # git log lists the newest first, unless told otherwise. Either way,
+    # gbp dch reverses what it lists
+    commits.reverse()
+    customizations = _load_customizations(options.customization_file)
+    format_entries = customizations.get("format_changelog_entries")
+    if format_entries is None:
+        format_entry = customizations.get(
+            "format_changelog_entry", gbp.dch.format_changelog_entry
+        )
+
+        def format_entries(commits, options, last_commit=True):
+            last = len(commits) - 1 if last_commit else -1
+            return [
+                format_entry(commit_info, options, last_commit=i == last)
+                for i, commit_info in enumerate(commits)
+            ]
+
+    # Entries depend on the customizations, gbp and how it is configured
+    # but not on the range of commits being added
+    settings = dict(vars(options))
+    settings.pop("since", None)
+    settings.pop("new_version", None)
+    formatter = hash_formatter(
+        [
+            options.customization_file,
+            PACKAGE_GBP_CUSTOMIZATION,
+            DEFAULT_GBP_CUSTOMIZATION,
+        ],
+        getattr(gbp, "__version__", ""),
+        json.dumps(settings, sort_keys=True, default=str),
+    )
+    return format_commits(
+        commits,
+        lambda batch, last_commit: format_entries(
+            [repo.get_commit_info(commit) for commit in batch],
+            options,
+            last_commit=last_commit,
+        ),
+        formatter,
+    )
+
+
+def hash_formatter(paths: List[Optional[str]], *settings: str) -> str:
+    """Return a digest of the formatter files at paths and settings."""
+    digest = hashlib.sha256()
+    for path in paths:
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        digest.update(b"\0")
+    for setting in settings:
+        digest.update(setting.encode() + b"\0")
+    return digest.hexdigest()
+
+
+def get_entry_cache() -> Optional[str]:
+    """Return the path of ENTRY_CACHE, or None outside of a git repo.
+
+    Ask git where its directory is: .git is a file in worktrees. Each
+    worktree gets its own cache, as they snapshot different branches.
+    """
+    try:
+        git_dir = check_output(
+            ["git", "rev-parse", "--git-dir"],
+            stderr=DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, CalledProcessError):
+        return None
+    return os.path.join(git_dir, ENTRY_CACHE)
+
+
+def format_commits(
+    commits: List[str],
+    format_batch: Callable[[List[str], bool], List[Optional[List[str]]]],
+    formatter: str,
+) -> List[List[str]]:
+    """Return the entries format_batch gives commits, oldest first.
+
+    format_batch(batch, last_commit) formats a list of commits in one go,
+    last_commit telling whether the last of them is the newest commit.
+
+    Daily snapshots add mostly the same commits again, so entries are
+    cached in ENTRY_CACHE by commit id and only the others are formatted.
+    The cache only holds this run's commits, and is dropped when the
+    formatter digest changes.
+    """
+    cache_file = get_entry_cache()
+    cached: Dict[str, Optional[List[str]]] = {}
+    if cache_file:
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache["formatter"] == formatter:
+                cached = cache["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    # The newest commit may be formatted differently
+    keys = [*commits[:-1], f"{commits[-1]} last"] if commits else []
+    formatted: Dict[str, Optional[List[str]]] = {
+        key: cached[key] for key in keys if key in cached
+    }
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if missing:
+        batch = format_batch(
+            [commits[i] for i in missing], missing[-1] == len(commits) - 1
+        )
+        formatted.update(zip((keys[i] for i in missing), batch))
+    if cache_file and formatted != cached:
+        with atomic_write(cache_file) as f:
+            json.dump({"formatter": formatter, "entries": formatted}, f)
+    return [formatted[key] for key in keys if formatted[key]]
+
+
 def add_changelog(msg: str, version: str, include_bugs: str = "false"):
-    with open(CHANGELOG_FILE) as stream:
-        full_changelog = stream.read().splitlines()
+    top_stanza, rest = read_top_stanza()
     unreleased_snapshot_messages = []  # Upstream snapshot commit messages
-    changelog_lines = []
-    pkg_info = re.match(PKG_RELEASE_RE, full_changelog[0]).groupdict()
+    pkg_info = PKG_RELEASE_RE.match(top_stanza[0]).groupdict()
     unreleased_commitish = None
     if pkg_info["dist"] == "UNRELEASED":
         # Reconstruct top changelog entry
@@ -87,33 +448,26 @@ def add_changelog(msg: str, version: str, include_bugs: str = "false"):
         if len(pkg_commitish) == 8:  # Then we have the commitish
             unreleased_commitish = pkg_commitish
         found_snapshot = False
-        changelog_count = 0
-        for line in full_changelog:
-            if re.match(
-                rf"{pkg_info['pkg_name']} .*urgency={pkg_info['urgency']}",
-                line,
-            ):
-                changelog_count += 1
-            if NEW_UPSTREAM_MSG in line and changelog_count == 1:
+        changelog_lines = []
+        for line in top_stanza:
+            if NEW_UPSTREAM_MSG in line:
                 found_snapshot = True
                 continue
-            if found_snapshot and changelog_count == 1:
-                if line and not line.startswith(" -- "):
-                    if NEW_UPSTREAM_MSG not in line:
-                        unreleased_snapshot_messages.append(
-                            re.sub(r"^ +\+ ?", "+", line)
-                        )
-                else:
-                    changelog_lines.append(line)
+            if found_snapshot and line and not line.startswith(" -- "):
+                unreleased_snapshot_messages.append(
+                    SNAPSHOT_ITEM_RE.sub("+", line)
+                )
             else:
                 changelog_lines.append(line)
-        if changelog_lines != full_changelog:
-            with open(CHANGELOG_FILE, "w") as stream:
-                stream.write("\n".join(changelog_lines) + "\n")
+    else:
+        changelog_lines = top_stanza
     # Add current msg comment
-    gbp_cmd = ["gbp", "dch", "--ignore-branch", f"--new-version={version}"]
-    for msg_line in msg.splitlines():
-        check_output(["dch", "--nomultimaint", "-b", "-v", version, msg_line])
+    changelog = add_to_top_stanza(
+        changelog_lines,
+        version,
+        [item for line in msg.splitlines() for item in format_dch_item(line)],
+    )
+    gbp_args = ["--ignore-branch", f"--new-version={version}"]
     if pkg_info["dist"] == "UNRELEASED":
         if not unreleased_commitish:
             _, _, pkg_commitish = pkg_info["version"].partition("g")
@@ -124,34 +478,48 @@ def add_changelog(msg: str, version: str, include_bugs: str = "false"):
             f"NOTICE: no {PACKAGE_GBP_CUSTOMIZATION} found. "
             f"Using: {DEFAULT_GBP_CUSTOMIZATION}"
         )
-        gbp_cmd += ["--customizations", DEFAULT_GBP_CUSTOMIZATION]
+        gbp_args += ["--customizations", DEFAULT_GBP_CUSTOMIZATION]
     if unreleased_commitish:
-        gbp_cmd += ["-s", unreleased_commitish]
+        gbp_args += ["-s", unreleased_commitish]
     if include_bugs == "false":
         # Skip any bug matches due in changelog entries
-        gbp_cmd += ["--meta-closes-bugnum='MATCHNOBUGS'"]
+        gbp_args += ["--meta-closes-bugnum='MATCHNOBUGS'"]
     if NEW_UPSTREAM_MSG in msg:
-        check_output(gbp_cmd, env=_get_gbp_env())
-    for msg in unreleased_snapshot_messages:
-        check_output(["dch", "-v", version, msg])
-
-    # Post-process some formatting artifacts from gbp_format_changelog
-    # when lines are wrapped or indented for scope.
-    # Redact ndented scope marker from "* +" to " +"
-    check_output(["sed", "-i", "s/ \\* +/   + /", CHANGELOG_FILE])
-    # Redact multi-line leading marker "* "
-    check_output(["sed", "-i", "s/\\*       /    /", CHANGELOG_FILE])
-    # Prepend the 6th leading space for multi-line wrapped entries if only
-    # 5 are present. Occurs when text-wrapping [Author Name] or (LP #<ID)
-    check_output(["sed", "-i", "/^     [^ ]/{s/^/ /}", CHANGELOG_FILE])
+        gbp_env = _get_gbp_env()
+        entries = get_gbp_entries(gbp_args, changelog, gbp_env)
+        if entries is None:
+            # Let gbp dch add the entries itself
+            write_changelog(changelog, rest)
+            check_output(["gbp", "dch", *gbp_args], env=gbp_env)
+            changelog, rest = read_top_stanza()
+        else:
+            changelog = add_to_top_stanza(
+                changelog,
+                version,
+                [item for entry in entries for item in format_gbp_item(entry)],
+            )
+    if unreleased_snapshot_messages and adds_maintainer_markers(changelog):
+        write_changelog(changelog, rest)
+        for message in unreleased_snapshot_messages:
+            check_output(["dch", "-v", version, message])
+        changelog, rest = read_top_stanza()
+        unreleased_snapshot_messages = []
+    changelog = add_to_top_stanza(
+        changelog,
+        version,
+        [
+            item
+            for message in unreleased_snapshot_messages
+            for item in format_dch_item(message)
+        ],
+    )
+    write_changelog(changelog, rest)
 
 
 if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
-    try:
-        check_output(["gbp", "--help"])
-    except Exception:
+    if not (importlib.util.find_spec("gbp") or shutil.which("gbp")):
         print(
             f"ERROR: {os.path.basename(__file__)} requires gbp. Run:"
             " sudo apt install git-buildpackage"
@@ -14,15 +14,341 @@ The commitish defaults to 'main'
 """
 
 import argparse
+import csv
+import hashlib
+import io
+import json
+import os
 import re
+import shutil
 import subprocess
 import sys
-from functools import partial
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager, redirect_stdout
+from datetime import date
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from functools import lru_cache, partial, total_ordering
 from pathlib import Path
 from subprocess import CalledProcessError
-from typing import NamedTuple, Optional, Tuple
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+class TraceEvent(NamedTuple):
+    name: str
+    category: str  # "stage" or "command"
+    start_ns: int
+    duration_ns: int
+    args: Dict[str, Any]
+
+
+class Profiler:
+    """Record how long each pipeline stage and subprocess takes.
+
+    Disabled by default, in which case span() costs next to nothing.
+    Events can be summarized as a table or exported in the Chrome trace
+    event format, viewable in chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: List[TraceEvent] = []
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", **args):
+        """Time the enclosed block. Yields a dict for extra trace args."""
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            self.events.append(
+                TraceEvent(
+                    name,
+                    category,
+                    start,
+                    time.perf_counter_ns() - start,
+                    args,
+                )
+            )
+
+    def summary(self) -> str:
+        """Return a table of total time per stage and per command."""
+        rows: Dict[Tuple[str, str], List[int]] = {}
+        for event in self.events:
+            name = event.name
+            if event.category == "command":
+                # Group by program and subcommand, e.g. "git merge"
+                name = " ".join(name.split()[:2])
+            row = rows.setdefault((event.category, name), [0, 0, 0])
+            row[0] += 1
+            row[1] += event.duration_ns
+            row[2] = max(row[2], event.duration_ns)
+        lines = [f"{'':<8}{'name':<40}{'count':>6}{'total s':>10}{'max s':>9}"]
+        for (category, name), (count, total, longest) in sorted(
+            rows.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                f"{category:<8}{name[:39]:<40}{count:>6}"
+                f"{total / 1e9:>10.3f}{longest / 1e9:>9.3f}"
+            )
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        """Write all events as complete ("X") Chrome trace events."""
+        trace = [
+            {
+                "name": event.name,
+                "cat": event.category,
+                "ph": "X",
+                "ts": event.start_ns / 1000,
+                "dur": event.duration_ns / 1000,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": event.args,
+            }
+            for event in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace}, f, indent=1)
+
+
+PROFILER = Profiler()
+
+
+def _to_text(output) -> Optional[str]:
+    if isinstance(output, bytes):
+        return output.decode(errors="surrogateescape")
+    return output
+
+
+class Cassette:
+    """Record the results of commands to a file, or replay them from one.
+
+    When recording, every command run through sh(), capture(), stream()
+    and GIT is written to the cassette along with its cwd, any env
+    passed, its output and exit code. When replaying, nothing is run:
+    each command is answered with the next result recorded for it, so
+    the pipeline runs in milliseconds with no git, quilt or devscripts.
+
+    Only results are replayed, not side effects: files a command would
+    have written aren't, so replay in a copy of the recorded checkout.
+    The script only reads debian/ from the checkout, so that is saved
+    with the commands and restore() can make such a copy anywhere.
+    Cassettes are per process; snapshot_branches() workers aren't
+    recorded.
+    """
+
+    def __init__(self):
+        self.mode: Optional[str] = None  # None, "record" or "replay"
+        self.path: Optional[Path] = None
+        self.root = ""  # Recorded cwds are relative to it
+        self.entries: List[Dict[str, Any]] = []
+        self.files: Dict[str, Optional[str]] = {}
+        self._pending: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, path) -> None:
+        """Start recording commands, to be saved to path with debian/."""
+        self.mode = "record"
+        self.path = Path(path).absolute()
+        self.root = os.getcwd()
+        self.entries = []
+        self.files = {
+            str(file): _to_text(file.read_bytes())
+            for file in sorted(Path("debian").rglob("*"))
+            if file.is_file()
+        }
+
+    def replay(self, path) -> None:
+        """Answer commands from the cassette at path instead of running."""
+        self.mode = "replay"
+        self.path = Path(path)
+        self.root = os.getcwd()
+        cassette = json.loads(self.path.read_text())
+        self.entries = cassette["commands"]
+        self.files = cassette.get("files", {})
+        self._pending = {}
+        for entry in self.entries:
+            key = (entry["kind"], entry["command"])
+            self._pending.setdefault(key, []).append(entry)
+
+    def stop(self) -> None:
+        """Save a recording, then run commands normally again."""
+        if self.mode == "record" and self.path:
+            with atomic_write(self.path) as f:
+                json.dump(
+                    {"files": self.files, "commands": self.entries},
+                    f,
+                    indent=1,
+                )
+        self.mode = None
+
+    def restore(self, directory) -> None:
+        """Write the debian/ the recording started from to directory.
+
+        An empty .git is made too, for the snapshot journal.
+        """
+        for name, content in self.files.items():
+            path = Path(directory, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes((content or "").encode(errors="surrogateescape"))
+        Path(directory, ".git").mkdir(exist_ok=True)
+
+    def add(self, kind: str, command: str, **result) -> None:
+        with self._lock:
+            self.entries.append(
+                {
+                    "kind": kind,
+                    "command": command,
+                    "cwd": os.path.relpath(os.getcwd(), self.root),
+                    **{name: _to_text(v) for name, v in result.items()},
+                }
+            )
+
+    def next(self, kind: str, command: str) -> Dict[str, Any]:
+        """Return the next recorded result of command."""
+        with self._lock:
+            pending = self._pending.get((kind, command))
+            if not pending:
+                raise CliError(
+                    f"'{command}' was not recorded in {self.path}, or not "
+                    "as many times"
+                )
+            return pending.pop(0)
 
-sh = partial(subprocess.run, check=True, shell=True)
+
+CASSETTE = Cassette()
+# Where commands send the output they don't capture, when not to stdout.
+# Each snapshot_branches() worker points it at a log of its own.
+COMMAND_OUTPUT: Optional[IO[str]] = None
+
+
+def _replay_run(command, name: str, **kwargs) -> subprocess.CompletedProcess:
+    entry = CASSETTE.next("run", name)
+    stdout, stderr = entry["stdout"], entry["stderr"]
+    if not (kwargs.get("universal_newlines") or kwargs.get("text")):
+        stdout, stderr = (
+            None if output is None else output.encode(errors="surrogateescape")
+            for output in (stdout, stderr)
+        )
+    if kwargs.get("check") and entry["returncode"]:
+        raise CalledProcessError(entry["returncode"], command, stdout, stderr)
+    return subprocess.CompletedProcess(
+        command, entry["returncode"], stdout, stderr
+    )
+
+
+def _run(command, **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run(), recording the command with PROFILER and CASSETTE."""
+    name = command if isinstance(command, str) else " ".join(command)
+    if COMMAND_OUTPUT is not None and not kwargs.get("capture_output"):
+        COMMAND_OUTPUT.flush()
+        kwargs = {
+            "stdout": COMMAND_OUTPUT,
+            "stderr": subprocess.STDOUT,
+            **kwargs,
+        }
+    with PROFILER.span(name, "command", cwd=os.getcwd()) as trace_args:
+        if CASSETTE.mode == "replay":
+            try:
+                result = _replay_run(command, name, **kwargs)
+            except CalledProcessError as e:
+                trace_args["returncode"] = e.returncode
+                raise
+            trace_args["returncode"] = result.returncode
+            return result
+        try:
+            result = subprocess.run(command, **kwargs)
+        except CalledProcessError as e:
+            trace_args["returncode"] = e.returncode
+            if CASSETTE.mode == "record":
+                CASSETTE.add(
+                    "run",
+                    name,
+                    env=kwargs.get("env"),
+                    returncode=e.returncode,
+                    stdout=e.stdout,
+                    stderr=e.stderr,
+                )
+            raise
+        trace_args["returncode"] = result.returncode
+        if CASSETTE.mode == "record":
+            CASSETTE.add(
+                "run",
+                name,
+                env=kwargs.get("env"),
+                returncode=result.returncode,
+                stdout=result.stdout,
+                stderr=result.stderr,
+            )
+        return result
+
+
+def stream(command: str, separator: str = "\0") -> Iterator[str]:
+    """Run a shell command, yielding its output split on separator.
+
+    Output is consumed as it is produced rather than held in memory.
+    Like sh(), a non-zero exit raises CalledProcessError.
+    """
+    with PROFILER.span(command, "command", cwd=os.getcwd()) as trace_args:
+        if CASSETTE.mode == "replay":
+            entry = CASSETTE.next("stream", command)
+            chunks = [entry["stdout"]]
+            returncode = entry["returncode"]
+        else:
+            process = subprocess.Popen(
+                command,
+                shell=True,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            assert process.stdout
+            chunks = iter(partial(process.stdout.read, 65536), "")
+        recorded = []
+        try:
+            pending = ""
+            for chunk in chunks:
+                recorded.append(chunk)
+                *records, pending = (pending + chunk).split(separator)
+                yield from records
+            if pending:
+                yield pending
+        finally:
+            if CASSETTE.mode != "replay":
+                with process:
+                    pass
+                returncode = process.returncode
+            if CASSETTE.mode == "record":
+                # A consumer stopping early records only what was read
+                CASSETTE.add(
+                    "stream",
+                    command,
+                    returncode=returncode,
+                    stdout="".join(recorded),
+                )
+        trace_args["returncode"] = returncode
+        if returncode:
+            raise CalledProcessError(returncode, command)
+
+
+sh = partial(_run, check=True, shell=True)
 capture = partial(sh, capture_output=True, universal_newlines=True)
 
 QUILT_COMMAND = "quilt --quiltrc -"
@@ -36,18 +362,148 @@ QUILT_ENV = {
     "LANG": "C",
 }
 
+# These mirror the patterns used by dpkg's Dpkg::Changelog::Entry::Debian
+CHANGELOG_HEADER_RE = re.compile(
+    r"^(?P<source>\w[-+0-9a-z.]*) \((?P<version>[^() \t]+)\)"
+    r"(?P<distro>(?:\s+[-+0-9a-z.]+)+);\s*(?P<options>.*?)\s*$",
+    re.IGNORECASE,
+)
+CHANGELOG_TRAILER_RE = re.compile(
+    r"^ -- (?P<name>.*) <(?P<email>.*)>  ?"
+    r"(?P<date>(?:\w+,\s*)?\d{1,2}\s+\w+\s+\d{4}\s+"
+    r"\d{1,2}:\d\d:\d\d\s+[-+]\d{4})\s*$"
+)
+MAINTAINER_RE = re.compile(r"^\s*(?P<name>.*?)\s*<(?P<email>[^<>]+)>\s*$")
+LP_BUGS_RE = re.compile(r"lp:\s+#\d+(?:,\s*#\d+)*", re.IGNORECASE)
+# "LP: #1" or "LP: #1, #2" lines in commit messages
+LP_TRAILER_RE = re.compile(r"^\s*LP:\s*(?P<bugs>#\d+(?:\s*,\s*#\d+)*)")
+LP_TRAILER_GREP = "^[[:space:]]*LP:[[:space:]]*#"
+DISTRO_INFO_CSV = "/usr/share/distro-info/ubuntu.csv"
+# How many upstream files changed by a merge to report
+UPSTREAM_FILES_REPORTED = 10
+# "--- a/path" and "+++ b/path" lines of a (-p1 style) quilt patch
+PATCH_FILE_RE = re.compile(r"^(?:---|\+\+\+) (?P<path>\S+)", re.MULTILINE)
+HUNK_HEADER_RE = re.compile(
+    r"^@@ -(?P<old_start>\d+)(?:,(?P<old_count>\d+))? "
+    r"\+(?P<new_start>\d+)(?:,(?P<new_count>\d+))? @@"
+)
+
 
 class CliError(Exception):
     pass
 
 
+# One run of non-digits followed by one run of digits, as dpkg splits them
+VERSION_SEGMENT_RE = re.compile(r"(\D*)(\d*)")
+# The key of an empty ("" or "0") version segment
+EMPTY_SEGMENT_KEY = ((0,), 0)
+# dpkg's order(): '~' first, then letters, then everything else
+VERSION_CHAR_WEIGHTS = {
+    c: -1 if c == "~" else ord(c) if c.isalpha() else ord(c) + 256
+    for c in map(chr, range(128))
+}
+
+
+@lru_cache(maxsize=4096)
+def _version_part_key(part: str) -> tuple:
+    """Return a key that orders a version part like dpkg's verrevcmp().
+
+    Each segment becomes (weights of its non-digit characters, number).
+    '~' sorts before the end of a string, which sorts before letters,
+    which sort before everything else. The key is normalized so plain
+    tuple comparison matches dpkg, which compares missing segments as
+    empty ones: trailing empty segments are dropped and one is appended
+    (two for an empty part, as only the first segment can be empty).
+    """
+    key = []
+    for non_digits, digits in VERSION_SEGMENT_RE.findall(part):
+        if not non_digits and not digits:
+            continue
+        weights = tuple(
+            VERSION_CHAR_WEIGHTS.get(c, ord(c) + 256) for c in non_digits
+        )
+        key.append((weights + (0,), int(digits or 0)))
+    while key and key[-1] == EMPTY_SEGMENT_KEY:
+        key.pop()
+    key.append(EMPTY_SEGMENT_KEY)
+    if len(key) == 1:
+        key.append(EMPTY_SEGMENT_KEY)
+    return tuple(key)
+
+
+def version_sort_key(version: str) -> tuple:
+    """Return a key that sorts Debian version strings like dpkg does."""
+    epoch, sep, rest = version.partition(":")
+    if not sep:
+        epoch, rest = "", version
+    upstream, _, revision = rest.rpartition("-")
+    if not upstream:
+        # No revision
+        upstream, revision = revision, ""
+    return (
+        int(epoch or 0),
+        _version_part_key(upstream),
+        _version_part_key(revision),
+    )
+
+
+def compare_versions(a: str, b: str) -> int:
+    """Compare like 'dpkg --compare-versions', returning -1, 0 or 1."""
+    key_a, key_b = version_sort_key(a), version_sort_key(b)
+    return (key_a > key_b) - (key_a < key_b)
+
+
+@total_ordering
 class VersionInfo:
+    """A cloud-init packaging version.
+
+    Instances compare, sort and hash by Debian version ordering.
+    """
+
+    __slots__ = (
+        "major",
+        "minor",
+        "hotfix",
+        "epoch",
+        "debian",
+        "ubuntu",
+        "series",
+        "series_revision",
+        "pre_revision",
+        "pre_commit",
+        "_sort_key",
+    )
+    # Something like 23.1.1-0ubuntu1~22.04.1
+    # or 23.1~1g111f1a6e-0ubuntu1
+    PATTERN = re.compile(
+        r"((?P<epoch>\d+):)?"
+        r"(?P<major>\d+)"
+        r"\."
+        r"(?P<minor>\d+)"
+        r"((\.(?P<hotfix>\d+))|(~(?P<pre_revision>\d+)g(?P<pre_commit>\S{8})))?"  # noqa: E501
+        r"(-(?P<debian>\d+))"
+        r"(ubuntu(?P<ubuntu>\d+))"
+        r"(~(?P<series>\d+.\d+))?"
+        r"(\.(?P<series_revision>\d+))?"
+    )
+    INT_FIELDS = (
+        "epoch",
+        "major",
+        "minor",
+        "hotfix",
+        "debian",
+        "ubuntu",
+        "series_revision",
+        "pre_revision",
+    )
+
     def __init__(
         self,
         major: int,
         minor: int,
         hotfix: Optional[int] = None,
         *,
+        epoch: Optional[int] = None,
         debian: Optional[int] = None,
         ubuntu: Optional[int] = None,
         series: Optional[str] = None,
@@ -57,62 +513,94 @@ class VersionInfo:
     ):
         if any((series, series_revision)) and any((pre_revision, pre_commit)):
             raise RuntimeError("Cannot contain both series and pre_version")
-        self.major = major
-        self.minor = minor
-        self.hotfix = hotfix
-        self.debian = debian
-        self.ubuntu = ubuntu
-        self.series = series
-        self.series_revision = series_revision
-        self.pre_revision = pre_revision
-        self.pre_commit = pre_commit
+        # Skip our __setattr__, there is no sort key to reset yet
+        setattr_ = object.__setattr__
+        setattr_(self, "major", major)
+        setattr_(self, "minor", minor)
+        setattr_(self, "hotfix", hotfix)
+        setattr_(self, "epoch", epoch)
+        setattr_(self, "debian", debian)
+        setattr_(self, "ubuntu", ubuntu)
+        setattr_(self, "series", series)
+        setattr_(self, "series_revision", series_revision)
+        setattr_(self, "pre_revision", pre_revision)
+        setattr_(self, "pre_commit", pre_commit)
+        setattr_(self, "_sort_key", None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != "_sort_key":
+            object.__setattr__(self, "_sort_key", None)
 
     @classmethod
     def from_string(cls, version):
-        # Something like 23.1.1-0ubuntu1~22.04.1
-        # or 23.1~1g111f1a6e-0ubuntu1
-        pattern = (
-            r"(?P<major>\d+)"
-            r"\."
-            r"(?P<minor>\d+)"
-            r"((\.(?P<hotfix>\d+))|(~(?P<pre_revision>\d+)g(?P<pre_commit>\S{8})))?"  # noqa: E501
-            r"(-(?P<debian>\d+))"
-            r"(ubuntu(?P<ubuntu>\d+))"
-            r"(~(?P<series>\d+.\d+))?"
-            r"(\.(?P<series_revision>\d+))?"
-        )
-        match = re.search(
-            pattern,
-            version,
-        )
+        match = cls.PATTERN.search(version)
         if not match:
             if "-" not in version and "~" not in version:
                 # It's just an upstream tag
                 return cls(*version.split("."))
             raise RuntimeError(f"Cannot parse version string {version}")
         matches: dict = match.groupdict()
-        for some_int in [
-            "major",
-            "minor",
-            "hotfix",
-            "debian",
-            "ubuntu",
-            "series_revision",
-            "pre_revision",
-        ]:
+        for some_int in cls.INT_FIELDS:
             if matches[some_int]:
                 matches[some_int] = int(matches[some_int])
         return cls(**matches)
 
+    @classmethod
+    def parse_many(cls, versions: Iterable[str]) -> List["VersionInfo"]:
+        """Parse many version strings, e.g. for sorting an archive's."""
+        search = cls.PATTERN.search
+        from_string = cls.from_string
+        int_fields = cls.INT_FIELDS
+        parsed = []
+        for version in versions:
+            match = search(version)
+            if not match:
+                parsed.append(from_string(version))
+                continue
+            matches = match.groupdict()
+            for some_int in int_fields:
+                if matches[some_int]:
+                    matches[some_int] = int(matches[some_int])
+            parsed.append(cls(**matches))
+        return parsed
+
+    def sort_key(self) -> tuple:
+        """Return version_sort_key() of this version, computed once.
+
+        Passing this as the key to sorted() is faster than relying on
+        the comparison operators.
+        """
+        if self._sort_key is None:
+            object.__setattr__(self, "_sort_key", version_sort_key(str(self)))
+        return self._sort_key
+
+    def __eq__(self, other):
+        if not isinstance(other, VersionInfo):
+            return NotImplemented
+        return self.sort_key() == other.sort_key()
+
+    def __lt__(self, other):
+        if not isinstance(other, VersionInfo):
+            return NotImplemented
+        return self.sort_key() < other.sort_key()
+
+    def __hash__(self):
+        return hash(self.sort_key())
+
+    def __repr__(self):
+        return f"VersionInfo.from_string({str(self)!r})"
+
     def __str__(self):
         parts = [
+            f"{self.epoch}:" if self.epoch is not None else "",
             f"{self.major}.{self.minor}",
             f".{self.hotfix}" if self.hotfix else "",
             f"~{self.pre_revision}g{self.pre_commit}"
             if self.pre_revision
             else "",
-            f"-{self.debian}",
-            f"ubuntu{self.ubuntu}",
+            f"-{self.debian}" if self.debian is not None else "",
+            f"ubuntu{self.ubuntu}" if self.ubuntu is not None else "",
             f"~{self.series}.{self.series_revision}" if self.series else "",
         ]
         return "".join(parts)
@@ -123,6 +611,7 @@ class VersionInfo:
         major=None,
         minor=None,
         hotfix=None,
+        epoch=None,
         debian=None,
         ubuntu=None,
         series=None,
@@ -134,6 +623,7 @@ class VersionInfo:
             major=major or self.major,
             minor=minor or self.minor,
             hotfix=hotfix if hotfix or any((major, minor)) else self.hotfix,
+            epoch=epoch if epoch is not None else self.epoch,
             debian=debian if debian is not None else self.debian,
             ubuntu=ubuntu if ubuntu is not None else self.ubuntu,
             series=series if series is not None else self.series,
@@ -178,59 +668,368 @@ class ChangelogDetails(NamedTuple):
     changes: str
 
     @classmethod
-    def get(cls, offset=0):
-        results = capture(
-            f"dpkg-parsechangelog --count=1 --offset={offset}"
-        ).stdout.strip()
-        source = version = distro = urgency = ""
-        maintainer = timestamp = date = bugs_fixed = changes = ""
-        for line in results.splitlines():
-            if line.startswith("Source"):
-                source = line.split(": ")[1]
-            elif line.startswith("Version"):
-                version_str = line.split(": ")[1]
-                version = VersionInfo.from_string(version_str)
-            elif line.startswith("Distribution"):
-                distro = line.split(": ")[1]
-            elif line.startswith("Urgency"):
-                urgency = line.split(": ")[1]
-            elif line.startswith("Maintainer"):
-                maintainer = line.split(": ")[1]
-            elif line.startswith("Timestamp"):
-                timestamp = line.split(": ")[1]
-            elif line.startswith("Date"):
-                date = line.split(": ")[1]
-            elif line.startswith("Launchpad-Bugs-Fixed"):
-                bugs_fixed = line.split(": ")[1]
-            elif line.startswith("Changes"):
-                index = results.index("Changes:")
-                changes = results[index + len(line) + 1 :]
+    def get(cls, offset=0) -> "ChangelogDetails":
+        """Return the details of the changelog entry at offset.
+
+        Equivalent to 'dpkg-parsechangelog --count=1 --offset=<offset>'.
+        """
+        return ChangelogIndex().get(offset)
+
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> "ChangelogDetails":
+        """Parse a single changelog entry, header line first."""
+        header = CHANGELOG_HEADER_RE.match(lines[0])
+        if not header:
+            raise CliError(
+                f"Could not parse 'debian/changelog' line: {lines[0]}"
+            )
+        options = {}
+        for option in header["options"].split(","):
+            key, _, value = option.partition("=")
+            options[key.strip().lower()] = value.strip()
+
+        maintainer = timestamp = date = ""
+        body = []
+        for line in lines[1:]:
+            trailer = CHANGELOG_TRAILER_RE.match(line)
+            if trailer:
+                maintainer = f"{trailer['name']} <{trailer['email']}>"
+                date = trailer["date"]
+                timestamp = str(mktime_tz(parsedate_tz(date)))
                 break
-            else:
-                raise CliError(
-                    f"Could not parse 'debian/changelog' line: {line}"
-                )
+            body.append(line.rstrip())
+        while body and not body[0].strip():
+            body.pop(0)
+        while body and not body[-1].strip():
+            body.pop()
+
+        bugs = set()
+        for bug_list in LP_BUGS_RE.findall("\n".join(body)):
+            bugs.update(int(bug) for bug in re.findall(r"\d+", bug_list))
+        changes = [f" {lines[0].rstrip()}", " ."]
+        changes.extend(f" {line}" if line.strip() else " ." for line in body)
         return cls(
-            source,
-            version,
-            distro,
-            urgency,
-            maintainer,
-            timestamp,
-            date,
-            bugs_fixed,
-            changes,
+            source=header["source"],
+            version=VersionInfo.from_string(header["version"]),
+            distro=" ".join(header["distro"].split()),
+            urgency=options.get("urgency", ""),
+            maintainer=maintainer,
+            timestamp=timestamp,
+            date=date,
+            bugs_fixed=" ".join(str(bug) for bug in sorted(bugs)),
+            changes="\n".join(changes),
         )
 
 
-def get_changelog_distro():
+class ChangelogIndex:
+    """Random access to the entries of a debian/changelog.
+
+    The file is streamed once to record where every entry header starts.
+    Entries are only decoded when asked for, so looking at the top few
+    entries of a very long changelog does not parse the whole file.
+    """
+
+    def __init__(self, path="debian/changelog"):
+        self.path = Path(path)
+        self._offsets: List[int] = []
+        position = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                # Entry headers are the only lines without leading space
+                if line[:1].strip() and CHANGELOG_HEADER_RE.match(
+                    line.decode(errors="replace")
+                ):
+                    self._offsets.append(position)
+                position += len(line)
+        self._offsets.append(position)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get(self, offset=0) -> ChangelogDetails:
+        """Return the details of entry number offset (0 is the newest).
+
+        Like dpkg-parsechangelog, an offset past the end of the changelog
+        gives empty details rather than an error.
+        """
+        if offset >= len(self):
+            return ChangelogDetails("", "", "", "", "", "", "", "", "")
+        start, end = self._offsets[offset], self._offsets[offset + 1]
+        with self.path.open("rb") as f:
+            f.seek(start)
+            text = f.read(end - start).decode(errors="replace")
+        return ChangelogDetails.from_lines(text.splitlines())
+
+
+class GitObject(NamedTuple):
+    sha: str
+    type: str
+    content: bytes
+
+    @property
+    def parents(self) -> List[str]:
+        """Parent commit ids, in order, of a commit object."""
+        headers = self.content.split(b"\n\n", 1)[0]
+        return [
+            line.split()[1].decode()
+            for line in headers.splitlines()
+            if line.startswith(b"parent ")
+        ]
+
+
+class GitSession:
+    """Answer read-only git queries without forking git for each one.
+
+    Objects are read through long-lived 'git cat-file --batch' and
+    '--batch-check' processes. Answers about immutable objects are kept
+    for the life of the session; answers that depend on refs (HEAD,
+    branches, tags) are kept until invalidate() is called, which must
+    happen whenever the repository is modified.
+    """
+
+    def __init__(self):
+        self._processes: Dict[str, subprocess.Popen] = {}
+        self._cwd: Optional[str] = None
+        self._resolved: Dict[str, str] = {}
+        self._described: Dict[Tuple[str, int], str] = {}
+        self._branch: Optional[str] = None
+        self._objects: Dict[str, GitObject] = {}
+
+    def _follow_cwd(self) -> None:
+        if self._cwd != os.getcwd():
+            # Sessions follow the current repo, not the one they started in
+            self.invalidate()
+            self._cwd = os.getcwd()
+
+    def _process(self, mode: str) -> subprocess.Popen:
+        self._follow_cwd()
+        if mode not in self._processes:
+            self._processes[mode] = subprocess.Popen(
+                ["git", "cat-file", mode],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        return self._processes[mode]
+
+    def _query(self, mode: str, rev: str) -> Tuple[List[str], IO[bytes]]:
+        if CASSETTE.mode == "replay":
+            entry = CASSETTE.next("git", f"git cat-file {mode} {rev}")
+            header = entry["stdout"].split()
+            content = entry.get("content") or ""
+            stream = io.BytesIO(content.encode(errors="surrogateescape"))
+        else:
+            process = self._process(mode)
+            assert process.stdin and process.stdout
+            process.stdin.write(f"{rev}\n".encode())
+            process.stdin.flush()
+            header = process.stdout.readline().decode().split()
+            stream = process.stdout
+            if CASSETTE.mode == "record":
+                content = b""
+                if mode == "--batch" and len(header) == 3:
+                    content = stream.read(int(header[2]) + 1)
+                    stream = io.BytesIO(content)
+                CASSETTE.add(
+                    "git",
+                    f"git cat-file {mode} {rev}",
+                    stdout=" ".join(header),
+                    content=content,
+                )
+        if len(header) != 3:
+            raise CliError(f"Unknown git revision '{rev}'")
+        return header, stream
+
+    def resolve(self, rev: str) -> str:
+        """Return the full commit id rev points to, like 'git rev-parse'."""
+        self._follow_cwd()
+        if rev not in self._resolved:
+            header, _ = self._query("--batch-check", f"{rev}^{{commit}}")
+            self._resolved[rev] = header[0]
+        return self._resolved[rev]
+
+    def get_object(self, rev: str) -> GitObject:
+        """Return the (commit) object rev points to."""
+        sha = self.resolve(rev)
+        if sha not in self._objects:
+            (sha, object_type, size), stream = self._query("--batch", sha)
+            content = stream.read(int(size) + 1)[:-1]
+            self._objects[sha] = GitObject(sha, object_type, content)
+        return self._objects[sha]
+
+    def parent_count(self, rev: str) -> int:
+        return len(self.get_object(rev).parents)
+
+    def read_tree(self, rev: str) -> Dict[str, Tuple[str, str]]:
+        """Return {name: (mode, object id)} for the top level of rev's tree."""
+        (sha, _, size), stream = self._query("--batch", f"{rev}^{{tree}}")
+        content = stream.read(int(size) + 1)[:-1]
+        oid_length = len(sha) // 2
+        entries = {}
+        start = 0
+        while start < len(content):
+            # Each entry is "<mode> <name>\0<binary object id>"
+            space = content.index(b" ", start)
+            nul = content.index(b"\0", space)
+            end = nul + 1 + oid_length
+            entries[content[space + 1 : nul].decode()] = (
+                content[start:space].decode(),
+                content[nul + 1 : end].hex(),
+            )
+            start = end
+        return entries
+
+    def read_file(self, rev: str, path: str) -> Optional[bytes]:
+        """Return the content of path in the tree of rev, if it exists."""
+        try:
+            (sha, object_type, size), stream = self._query(
+                "--batch", f"{rev}:{path}"
+            )
+        except CliError:
+            return None
+        content = stream.read(int(size) + 1)[:-1]
+        return content if object_type == "blob" else None
+
+    def describe(self, rev: str, abbrev: int = 8) -> str:
+        """Return 'git describe --abbrev=<abbrev> <rev>'."""
+        self._follow_cwd()
+        if (rev, abbrev) not in self._described:
+            self._described[(rev, abbrev)] = capture(
+                f"git describe --abbrev={abbrev} {rev}"
+            ).stdout.strip()
+        return self._described[(rev, abbrev)]
+
+    def current_branch(self) -> str:
+        """Return the short name of the checked out branch."""
+        self._follow_cwd()
+        if self._branch is None:
+            self._branch = capture(
+                "git rev-parse --abbrev-ref HEAD"
+            ).stdout.strip()
+        return self._branch
+
+    def invalidate(self):
+        """Forget everything that depends on refs or the object store.
+
+        The cat-file processes are restarted too, as they may not notice
+        objects written by other processes after they started.
+        """
+        self._resolved.clear()
+        self._described.clear()
+        self._branch = None
+        self.close()
+
+    def close(self):
+        for process in self._processes.values():
+            if process.stdin:
+                process.stdin.close()
+            process.wait()
+        self._processes.clear()
+
+
+GIT = GitSession()
+
+
+class DistroRelease(NamedTuple):
+    version: str
+    codename: str
+    series: str
+    created: date
+    release: date
+    eol: date
+    eol_server: Optional[date]
+    lts: bool
+
+
+class DistroInfo:
+    """Ubuntu release data, answering what 'distro-info' would.
+
+    The distro-info CSV file is read once, on first use. Pass today to
+    answer as of a fixed date rather than the current one.
+    """
+
+    def __init__(self, path=DISTRO_INFO_CSV, today: Optional[date] = None):
+        self.path = Path(path)
+        self.today = today
+        self._releases: Optional[List[DistroRelease]] = None
+
+    @property
+    def releases(self) -> List[DistroRelease]:
+        """Every release, oldest first."""
+        if self._releases is None:
+            try:
+                with self.path.open(newline="") as f:
+                    rows = list(csv.DictReader(f))
+            except OSError as e:
+                raise CliError(f"Can't read distro-info data: {e}") from e
+            self._releases = [
+                DistroRelease(
+                    version=row["version"].split()[0],
+                    codename=row["codename"],
+                    series=row["series"],
+                    created=date.fromisoformat(row["created"]),
+                    release=date.fromisoformat(row["release"]),
+                    eol=date.fromisoformat(row["eol"]),
+                    eol_server=(
+                        date.fromisoformat(row["eol-server"])
+                        if row.get("eol-server")
+                        else None
+                    ),
+                    lts=row["version"].endswith(" LTS"),
+                )
+                for row in rows
+            ]
+        return self._releases
+
+    def _today(self, today: Optional[date]) -> date:
+        return today or self.today or date.today()
+
+    def devel(self, today: Optional[date] = None) -> DistroRelease:
+        """Return the release in development, like 'distro-info --devel'."""
+        today = self._today(today)
+        for release in reversed(self.releases):
+            if release.created <= today < release.release:
+                return release
+        raise CliError(f"Distro-info data in {self.path} is outdated")
+
+    def stable(self, today: Optional[date] = None) -> DistroRelease:
+        """Return the latest stable release, like 'distro-info --stable'."""
+        today = self._today(today)
+        for release in reversed(self.releases):
+            if release.release <= today <= release.eol:
+                return release
+        raise CliError(f"Distro-info data in {self.path} is outdated")
+
+    def supported(self, today: Optional[date] = None) -> List[DistroRelease]:
+        """Return the supported releases, including the devel release."""
+        today = self._today(today)
+        return [
+            release
+            for release in self.releases
+            if release.created <= today
+            and today <= max(release.eol, release.eol_server or release.eol)
+        ]
+
+    def get(self, name: str) -> DistroRelease:
+        """Return the release with a series name or version like 22.04."""
+        for release in self.releases:
+            if name in (release.series, release.version):
+                return release
+        raise CliError(f"Unknown Ubuntu release '{name}'")
+
+
+DISTRO_INFO = DistroInfo()
+
+
+def get_changelog_distro(changelog: Optional[ChangelogIndex] = None):
     """Get the distro represented by this changelog.
 
     The first line of d/changelog displays the distro. Since it can be
     UNRELEASED, check the most recent entries until we find one.
     """
+    if changelog is None:
+        changelog = ChangelogIndex()
     for i in range(5):
-        details = ChangelogDetails.get(offset=i)
+        details = changelog.get(offset=i)
         changelog_distro = details.distro
         if changelog_distro != "UNRELEASED":
             break
@@ -239,43 +1038,267 @@ def get_changelog_distro():
     return changelog_distro
 
 
-def remove_line_from_file(filename, text):
-    """Utility function to remove a single line from a file."""
+class SnapshotContext:
+    """Facts needed by one snapshot run, each computed at most once.
+
+    A context is created per run and passed through the pipeline. Facts
+    already known can be passed in. Stages that rewrite debian/changelog
+    must call invalidate_changelog().
+    """
+
+    def __init__(self, **facts):
+        self._facts: Dict[str, Any] = facts
+
+    def _memoize(self, name, compute):
+        if name not in self._facts:
+            self._facts[name] = compute()
+        return self._facts[name]
+
+    @property
+    def changelog(self) -> ChangelogIndex:
+        return self._memoize("changelog", ChangelogIndex)
+
+    @property
+    def changelog_details(self) -> ChangelogDetails:
+        """Details of the newest debian/changelog entry."""
+        return self._memoize("changelog_details", self.changelog.get)
+
+    @property
+    def changelog_distro(self) -> str:
+        """The newest distro in debian/changelog that isn't UNRELEASED."""
+        return self._memoize(
+            "changelog_distro", partial(get_changelog_distro, self.changelog)
+        )
+
+    @property
+    def devel_distro(self) -> str:
+        """The current devel series, or UNKNOWN."""
+
+        def devel_distro():
+            try:
+                return DISTRO_INFO.devel().series
+            except CliError:
+                return "UNKNOWN"
+
+        return self._memoize("devel_distro", devel_distro)
+
+    @property
+    def stable_series_number(self) -> str:
+        """The version number of the latest stable series, e.g. 22.04."""
+        return self._memoize(
+            "stable_series_number",
+            lambda: DISTRO_INFO.stable().version,
+        )
+
+    @property
+    def original_head(self) -> str:
+        """The commit HEAD was at before the snapshot merge."""
+        return self._memoize(
+            "original_head", lambda: GIT.resolve(get_original_head())
+        )
+
+    def invalidate_changelog(self) -> None:
+        """Forget everything read from debian/changelog."""
+        for name in ("changelog", "changelog_details", "changelog_distro"):
+            self._facts.pop(name, None)
+
+
+@contextmanager
+def atomic_write(filename):
+    """Open a temporary file that replaces filename once closed cleanly.
+
+    The temporary file lives in the same directory so the final rename
+    is atomic; on error the original file is left untouched.
+    """
+    path = Path(filename)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        if path.exists():
+            os.chmod(tmp_name, path.stat().st_mode)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def get_git_dir() -> Path:
+    """Return the git directory of the checkout in the current directory."""
+    git = Path(".git")
+    if git.is_file():  # A worktree or submodule
+        return Path(git.read_text().partition("gitdir:")[2].strip())
+    return git
+
+
+def hash_paths(*paths: str) -> str:
+    """Return a digest of the files at paths, or in directories at paths."""
+    digest = hashlib.sha256()
+    for path in paths:
+        files = (
+            sorted(p for p in Path(path).rglob("*") if p.is_file())
+            if Path(path).is_dir()
+            else [Path(path)]
+        )
+        for file in files:
+            digest.update(f"{file}\0".encode())
+            if file.exists():
+                digest.update(file.read_bytes())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SnapshotJournal:
+    """The stages an unfinished snapshot has completed, kept in .git/.
+
+    Each completed stage is recorded with the commit HEAD was at after
+    it, and digests of what it produced. A rerun for the same commitish
+    skips a stage when what it produced is still in place, so it resumes
+    where the previous run stopped. The journal is keyed on the commit
+    the commitish resolves to and the HEAD the snapshot started from: it
+    is ignored if the commitish has moved on, if HEAD moved before any
+    stage completed, or if the branch no longer contains the commits it
+    recorded, e.g. after a reset. It is removed once the snapshot finishes.
+
+    A merge committed without the merge stage completing, like a merge
+    whose conflicts were resolved by hand, isn't counted as HEAD moving:
+    the journal resumes from it, and merged is True.
+    """
+
+    FILENAME = "new_upstream_snapshot.json"
+
+    def __init__(self, commitish: str, path=None):
+        self.path = Path(path or get_git_dir() / self.FILENAME)
+        self.commitish = commitish
+        self.commit: Optional[str] = None
+        self.original_head: Optional[str] = None
+        self.stages: Dict[str, Dict[str, str]] = {}
+        self.merged = False
+        try:
+            journal = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        try:
+            commit = GIT.resolve(commitish)
+        except CliError:
+            return
+        if (journal.get("commitish"), journal.get("commit")) != (
+            commitish,
+            commit,
+        ):
+            return
+        heads = [journal["original_head"]] + [
+            stage["head"] for stage in journal["stages"].values()
+        ]
+        if len(heads) == 1:
+            if heads[0] != GIT.resolve("HEAD"):
+                if heads[0] != get_merged_head(commit):
+                    return
+                self.merged = True
+        elif capture(
+            f"git merge-base --is-ancestor {heads[-1]} HEAD", check=False
+        ).returncode:
+            return
+        self.commit = commit
+        self.original_head = journal["original_head"]
+        self.stages = journal["stages"]
+
+    def start(self, original_head: str = "HEAD") -> None:
+        """Start a new journal for a snapshot of original_head."""
+        self.commit = GIT.resolve(self.commitish)
+        self.original_head = GIT.resolve(original_head)
+        self.stages = {}
+        self.merged = False
+        self._save()
+
+    def update_commit(self) -> None:
+        """Record the commit the commitish resolves to now."""
+        self.commit = GIT.resolve(self.commitish)
+        self._save()
+
+    def finish(self) -> None:
+        """Forget the journal, as the snapshot is complete."""
+        self.path.unlink()
+        self.commit = self.original_head = None
+        self.stages = {}
+        self.merged = False
+
+    def is_done(self, stage: str, **digests: str) -> bool:
+        """Return whether stage completed and produced digests."""
+        record = self.stages.get(stage)
+        return record is not None and all(
+            record.get(name) == digest for name, digest in digests.items()
+        )
+
+    def done(self, stage: str, **digests: str) -> None:
+        """Record that stage completed and produced digests."""
+        # Merging upstream/main fetches it first
+        self.commit = GIT.resolve(self.commitish)
+        self.stages[stage] = {"head": GIT.resolve("HEAD"), **digests}
+        self._save()
+
+    def _save(self) -> None:
+        with atomic_write(self.path) as f:
+            json.dump(
+                {
+                    "commitish": self.commitish,
+                    "commit": self.commit,
+                    "original_head": self.original_head,
+                    "stages": self.stages,
+                },
+                f,
+                indent=2,
+            )
+
+
+def remove_lines_from_file(filename, texts: Iterable[str]):
+    """Utility function to remove every line matching texts from a file."""
+    texts = {text.strip() for text in texts}
     with open(filename, "r") as f:
         lines = f.readlines()
-    with open(filename, "w") as f:
+    with atomic_write(filename) as f:
         for line in lines:
-            if line.strip() != text.strip():
+            if line.strip() not in texts:
                 f.write(line)
 
 
-def merge_commitish(to: str) -> None:
-    """Perform 'git merge <commitish>' along with some error checking."""
+def merge_commitish(to: str, fetch: bool = True) -> None:
+    """Perform 'git merge <commitish>' along with some error checking.
+
+    When merging upstream/main, upstream is fetched first unless fetch
+    is False.
+    """
     try:
-        ref_name = capture(f"git describe --abbrev=8 {to}").stdout.strip()
+        ref_name = GIT.describe(to)
     except CalledProcessError as e:
         raise CliError(
             f"'git describe' failed for {to}. "
             "Is it a valid commitish or annotated tag?"
         ) from e
 
-    if to == "upstream/main":
+    if to == "upstream/main" and fetch:
         capture("git fetch upstream")
+        GIT.invalidate()
     command = (
         f"git merge --strategy-option=theirs {to} "
         f'-m "merge from {to} at {ref_name}"'
     )
     print(f"Running: {command}")
     capture(command)
+    GIT.invalidate()
+    check_upstream_files(to)
 
-    # Ensure that our merge strategy didn't do anything unexpected
-    upstream_files = []
-    for entry in (
-        capture(f"git diff --name-only {to}").stdout.strip().splitlines()
-    ):
-        if not entry.startswith("debian/"):
-            upstream_files.append(entry)
+
+def check_upstream_files(to: str) -> None:
+    """Ensure that merging to didn't change any upstream files."""
+    with PROFILER.span("upstream file check"):
+        # One more than reported tells whether there are more
+        upstream_files = get_upstream_file_changes(
+            to, limit=UPSTREAM_FILES_REPORTED + 1
+        )
     if upstream_files:
+        if len(upstream_files) > UPSTREAM_FILES_REPORTED:
+            upstream_files[UPSTREAM_FILES_REPORTED:] = ["..."]
         raise CliError(
             "Merge resulted in changes to upstream files: "
             f"{', '.join(upstream_files)}. Fix the merge and rerun this "
@@ -283,31 +1306,117 @@ def merge_commitish(to: str) -> None:
         )
 
 
-def drop_cpicks(commitish):
+def get_upstream_file_changes(
+    commitish, rev="HEAD", limit: Optional[int] = UPSTREAM_FILES_REPORTED
+) -> List[str]:
+    """Return paths outside of debian/ that differ between rev and commitish.
+
+    The top-level trees are compared first: when every entry other than
+    debian is the same object in both, they can't differ. Otherwise
+    the diff stops after limit paths.
+    """
+    ours = GIT.read_tree(rev)
+    theirs = GIT.read_tree(commitish)
+    ours.pop("debian", None)
+    theirs.pop("debian", None)
+    if ours == theirs:
+        return []
+    changed = []
+    with closing(
+        stream(
+            f"git diff-tree -r -z --name-only {commitish} {rev} "
+            "-- . ':(exclude)debian'"
+        )
+    ) as paths:
+        for path in paths:
+            if path:
+                changed.append(path)
+            if len(changed) == limit:
+                break
+    return changed
+
+
+def get_ancestor_hashes(
+    git_hashes: Iterable[str], commitish, since: str = "HEAD"
+) -> Set[str]:
+    """Return the subset of (possibly abbreviated) git_hashes in commitish.
+
+    See get_first_containing() for how since limits the search.
+    """
+    return set(get_first_containing(git_hashes, [commitish], since))
+
+
+def get_first_containing(
+    git_hashes: Iterable[str], commits: List[str], since: str = "HEAD"
+) -> Dict[str, int]:
+    """Map the (possibly abbreviated) git_hashes in commits[-1] to the index
+    of the first of commits that contains them.
+
+    commits are a first-parent chain, oldest first. A single 'git rev-list'
+    walks the commits in commits[-1] but not in since, usually just what
+    is being merged, rather than the whole history. Any hashes not found
+    there are checked against commits[0] with 'git merge-base
+    --is-ancestor', one at a time.
+    """
+    pending = set(git_hashes)
+    if not pending or not commits:
+        return {}
+    parents: Dict[str, List[str]] = {}
+    for line in capture(
+        f"git rev-list --parents {commits[-1]} ^{since}"
+    ).stdout.splitlines():
+        commit, *parents[commit] = line.split()
+    first: Dict[str, int] = {}
+    for index, commit in enumerate(commits):
+        todo = [GIT.resolve(commit)]
+        while todo:
+            commit = todo.pop()
+            if commit in parents and commit not in first:
+                first[commit] = index
+                todo.extend(parents[commit])
+    lengths = {len(git_hash) for git_hash in pending}
+    found = {}
+    for commit, index in first.items():
+        for length in lengths:
+            if commit[:length] in pending:
+                found[commit[:length]] = index
+    for git_hash in sorted(pending - found.keys()):
+        if not capture(
+            f"git merge-base --is-ancestor {git_hash} {commits[0]}",
+            check=False,
+        ).returncode:
+            found[git_hash] = 0
+    return found
+
+
+def drop_cpicks(commitish, context: Optional[SnapshotContext] = None):
     """Drop any cpick files in d/p that we've pulled in from main.
 
-    Cpick files have their commit specified in the filename.
+    Cpick files have their commit specified in the filename. Given the
+    context of a snapshot, only the commits it merged are searched.
     """
     print("Dropping any cpicks that we've pulled in from main")
+    cpicks = {
+        cpick: cpick.name.split("-")[1]
+        for cpick in sorted(Path("debian/patches").glob("cpick*"))
+    }
+    ancestors = get_ancestor_hashes(
+        cpicks.values(),
+        commitish,
+        context.original_head if context else "HEAD",
+    )
     dropped_cpicks = []
-    for cpick in Path("debian/patches").glob("cpick*"):
-        git_hash = cpick.name.split("-")[1]
-        is_ancestor = (
-            sh(
-                f"git merge-base --is-ancestor {git_hash} {commitish}",
-                check=False,
-            ).returncode
-            == 0
-        )
-        if is_ancestor:
+    for cpick, git_hash in cpicks.items():
+        if git_hash in ancestors:
             print(
                 f"Dropping file {cpick.name} as it is contained in the "
                 "upstream snapshot"
             )
             dropped_cpicks.append(cpick.name)
-            remove_line_from_file("debian/patches/series", cpick.name)
-            cpick.unlink()
     if dropped_cpicks:
+        remove_lines_from_file("debian/patches/series", dropped_cpicks)
+        for cpick_name in dropped_cpicks:
+            Path("debian/patches", cpick_name).unlink()
         commit_msg = (
             f"drop cherry picks included in {commitish}.\n\n"
             "drop the following cherry picks:\n" + "\n".join(dropped_cpicks)
@@ -316,9 +1425,14 @@ def drop_cpicks(commitish):
             "git add debian/patches && git commit --no-verify "
             f"-m '{commit_msg}'"
         )
+        GIT.invalidate()
 
 
-def refresh_patches(commitish) -> bool:
+def refresh_patches(
+    commitish,
+    incremental: bool = True,
+    context: Optional[SnapshotContext] = None,
+) -> bool:
     """Refresh any non-cpick quilt patches.
 
     For every quilt patch run:
@@ -326,24 +1440,63 @@ def refresh_patches(commitish) -> bool:
       quilt push
       quilt refresh
 
+    When incremental, only patches touching files changed by the merge are
+    refreshed: for each of them run 'quilt push <patch>' followed by
+    'quilt refresh'. Any other patch applies exactly as it did before the
+    merge, so refreshing it would not change it.
+
     Changes from refresh will automatically be committed without prompting.
 
-    If automatic refresh fails, the script will exit with failure. It
-    is up to the user to manually fix the quilt patches and then rerun
-    the script with the '--post quilt' argument.
+    Before pushing anything, every patch is checked in memory against
+    HEAD, and hunks that look like they no longer apply are listed. quilt
+    has the final say: the check is only advisory. If automatic refresh
+    fails, the script will exit with failure. It is up to the user to
+    manually fix the quilt patches and then rerun the script with the
+    '--post quilt' argument.
 
     :return: True when patches were refreshed
     """
+    with PROFILER.span("patch precheck"):
+        failures = check_patches_apply("HEAD")
+    if failures:
+        print(
+            "The following patches may no longer apply:\n"
+            + "\n".join(f"  {failure}" for failure in failures)
+        )
     print("Attempting to automatically refresh quilt patches")
+    affected_patches = None
+    if incremental:
+        try:
+            original_head = (
+                context.original_head if context else get_original_head()
+            )
+        except CliError:
+            print("No merge found, refreshing all patches")
+        else:
+            affected_patches = get_affected_patches(
+                get_changed_files(original_head, "HEAD")
+            )
+            skipped = len(get_series()) - len(affected_patches)
+            if skipped:
+                print(f"Skipping {skipped} patch(es) unaffected by the merge")
     did_push = False
     try:
-        while (
-            sh(f"{QUILT_COMMAND} next", check=False, env=QUILT_ENV).returncode
-            == 0
-        ):
-            sh(f"{QUILT_COMMAND} push", env=QUILT_ENV)
-            sh(f"{QUILT_COMMAND} refresh", env=QUILT_ENV)
-            did_push = True
+        with PROFILER.span("quilt push/refresh"):
+            if affected_patches is not None:
+                for patch in affected_patches:
+                    sh(f"{QUILT_COMMAND} push {patch}", env=QUILT_ENV)
+                    sh(f"{QUILT_COMMAND} refresh", env=QUILT_ENV)
+                    did_push = True
+            else:
+                while (
+                    sh(
+                        f"{QUILT_COMMAND} next", check=False, env=QUILT_ENV
+                    ).returncode
+                    == 0
+                ):
+                    sh(f"{QUILT_COMMAND} push", env=QUILT_ENV)
+                    sh(f"{QUILT_COMMAND} refresh", env=QUILT_ENV)
+                    did_push = True
     except CalledProcessError as e:
         failed_patch = capture(
             f"{QUILT_COMMAND} next", env=QUILT_ENV
@@ -374,12 +1527,405 @@ def refresh_patches(commitish) -> bool:
         f"patches: \n" + "\n".join(patches)
     )
     sh(f"git commit --no-verify -m '{commit_msg}' {' '.join(patches)}")
+    GIT.invalidate()
     patch_texts = [p.replace("debian/patches/", "d/p/") for p in patches]
     patch_lines = "\n    - ".join(patch_texts)
     add_msg_to_changelog(f"  * refresh patches:\n    - {patch_lines}")
+    if context:
+        context.invalidate_changelog()
     return True
 
 
+def get_series_entries(rev: Optional[str] = None) -> List[Tuple[str, int]]:
+    """Return the patches listed in debian/patches/series and their -p level.
+
+    quilt applies a patch with 'patch -p1' unless the series says otherwise
+    after its name, e.g. 'fix.patch -p0'.
+
+    Read from the tree of rev when given, otherwise from the checkout.
+    """
+    if rev is None:
+        path = Path("debian/patches/series")
+        series = path.read_text() if path.exists() else ""
+    else:
+        series = (GIT.read_file(rev, "debian/patches/series") or b"").decode()
+    entries = []
+    for line in split_lines(series):
+        line = line.split("#", 1)[0].strip()
+        if line:
+            patch, *options = line.split()
+            strip = 1
+            for option in options:
+                if re.fullmatch(r"-p\d+", option):
+                    strip = int(option[2:])
+            entries.append((patch, strip))
+    return entries
+
+
+def get_series(rev: Optional[str] = None) -> List[str]:
+    """Return the patch names listed in debian/patches/series.
+
+    Read from the tree of rev when given, otherwise from the checkout.
+    """
+    return [patch for patch, _ in get_series_entries(rev)]
+
+
+def split_lines(text: str) -> List[str]:
+    """Split text at newlines only, as patch does.
+
+    Unlike str.splitlines(), form feeds, \\u2028 and the like stay in their
+    line. A final newline doesn't start another line.
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def strip_path(path: str, strip: int) -> str:
+    """Return path without its first strip components, like 'patch -p'."""
+    return path.split("/", strip)[-1] if strip else path
+
+
+def get_patch_files(patch: str, strip: int = 1) -> Set[str]:
+    """Return the upstream files a -p<strip> quilt patch touches."""
+    files = set()
+    for match in PATCH_FILE_RE.finditer(patch):
+        path = match["path"]
+        if path != "/dev/null":
+            files.add(strip_path(path, strip))
+    return files
+
+
+def get_changed_files(old, new) -> Set[str]:
+    """Return the files that differ between the trees of old and new."""
+    diff = capture(f"git diff-tree -r --name-only {old} {new}").stdout
+    return set(diff.splitlines())
+
+
+def get_affected_patches(
+    changed_files: Set[str], rev: Optional[str] = None
+) -> List[str]:
+    """Return the series patches touching any of changed_files, in order.
+
+    Read the patches from the tree of rev when given, otherwise from the
+    checkout.
+    """
+    affected = []
+    for patch, strip in get_series_entries(rev):
+        path = Path("debian/patches", patch)
+        if rev is None:
+            content = path.read_bytes() if path.exists() else b""
+        else:
+            content = GIT.read_file(rev, str(path)) or b""
+        files = get_patch_files(content.decode(errors="replace"), strip)
+        if files & changed_files:
+            affected.append(patch)
+    return affected
+
+
+class Hunk(NamedTuple):
+    header: str
+    old_start: int
+    lines: List[Tuple[str, str]]  # (" ", "-" or "+", text)
+
+    @property
+    def old(self) -> List[str]:
+        return [text for op, text in self.lines if op != "+"]
+
+    @property
+    def new(self) -> List[str]:
+        return [text for op, text in self.lines if op != "-"]
+
+    def context(self) -> Tuple[int, int]:
+        """Return the number of leading and trailing context lines."""
+        ops = [op for op, _ in self.lines]
+        leading = next((i for i, op in enumerate(ops) if op != " "), len(ops))
+        trailing = next(
+            (i for i, op in enumerate(reversed(ops)) if op != " "), len(ops)
+        )
+        return leading, trailing
+
+
+class FilePatch(NamedTuple):
+    path: str
+    hunks: List[Hunk]
+    creates: bool
+    deletes: bool
+
+
+class HunkFailure(NamedTuple):
+    patch: str
+    path: str
+    hunk: str
+    reason: str
+
+    def __str__(self):
+        hunk = f"{self.hunk} " if self.hunk else ""
+        return f"{self.patch}: {self.path}: {hunk}{self.reason}"
+
+
+def parse_patch(text: str, strip: int = 1) -> List[FilePatch]:
+    """Parse the unified diff sections of a quilt patch.
+
+    Paths lose their first strip components, as with 'patch -p<strip>'.
+    Anything before, between or after the diffs, like DEP-3 headers or
+    'Index:' lines, is ignored.
+    """
+    lines = split_lines(text)
+    file_patches = []
+    i = 0
+    while i < len(lines) - 1:
+        if not (
+            lines[i].startswith("--- ") and lines[i + 1].startswith("+++ ")
+        ):
+            i += 1
+            continue
+        old_path = lines[i][4:].split("\t")[0].strip()
+        new_path = lines[i + 1][4:].split("\t")[0].strip()
+        path = new_path if new_path != "/dev/null" else old_path
+        i += 2
+        hunks = []
+        while i < len(lines):
+            match = HUNK_HEADER_RE.match(lines[i])
+            if not match:
+                break
+            old_count = int(match["old_count"] or 1)
+            new_count = int(match["new_count"] or 1)
+            hunk_lines = []
+            i += 1
+            while (old_count > 0 or new_count > 0) and i < len(lines):
+                line = lines[i]
+                i += 1
+                if line.startswith("\\"):  # \ No newline at end of file
+                    continue
+                op, text = (line[0], line[1:]) if line else (" ", "")
+                if op not in " -+":
+                    i -= 1
+                    break
+                if op != "+":
+                    old_count -= 1
+                if op != "-":
+                    new_count -= 1
+                hunk_lines.append((op, text))
+            while i < len(lines) and lines[i].startswith("\\"):
+                i += 1
+            hunks.append(
+                Hunk(match.group(0), int(match["old_start"]), hunk_lines)
+            )
+        file_patches.append(
+            FilePatch(
+                strip_path(path, strip),
+                hunks,
+                creates=old_path == "/dev/null",
+                deletes=new_path == "/dev/null",
+            )
+        )
+    return file_patches
+
+
+def _locate_hunk(
+    lines: List[str], hunk: Hunk, offset: int, frozen: int, fuzz: int
+) -> Optional[Tuple[int, int, int]]:
+    """Find where hunk applies in lines, following GNU patch's rules.
+
+    offset is how far earlier hunks were moved and frozen the number of
+    lines they consumed. Returns the 0-based line the hunk applies at and
+    how many leading and trailing context lines were ignored, or None.
+    A hunk with less leading (trailing) context than trailing (leading)
+    context can only apply at the start (end) of the file.
+    """
+    old = hunk.old
+    leading, trailing = hunk.context()
+    context = max(leading, trailing)
+    prefix_fuzz = fuzz + leading - context
+    suffix_fuzz = fuzz + trailing - context
+    # 1-based, as in patch. An empty hunk is added after old_start.
+    first_guess = hunk.old_start + (0 if old else 1) + offset
+    if not old:
+        return first_guess - 1, 0, 0
+    max_pos_offset = len(lines) - (len(old) - suffix_fuzz) + 1 - first_guess
+    max_neg_offset = first_guess - (frozen + 1 - (leading - prefix_fuzz))
+    max_neg_offset = min(max_neg_offset, first_guess - 1)
+
+    def matches(where, prefix, suffix):
+        start = where - 1 + max(prefix, 0)
+        end = where - 1 + len(old) - max(suffix, 0)
+        return (
+            0 <= start
+            and end <= len(lines)
+            and lines[start:end] == old[start - where + 1 : end - where + 1]
+        )
+
+    if prefix_fuzz < 0 and hunk.old_start <= 1:
+        # Can only match the start of the file, or all of it
+        if suffix_fuzz < 0 and (len(old) != len(lines) or leading < frozen):
+            return None
+        if (
+            frozen <= leading
+            and 1 - first_guess <= max_pos_offset
+            and matches(1, 0, suffix_fuzz)
+        ):
+            return 0, 0, max(suffix_fuzz, 0)
+        return None
+    prefix_fuzz = max(prefix_fuzz, 0)
+    if suffix_fuzz < 0:
+        # Can only match the end of the file
+        where = len(lines) - len(old) + 1
+        if first_guess - where <= max_neg_offset and matches(
+            where, prefix_fuzz, 0
+        ):
+            return where - 1, prefix_fuzz, 0
+        return None
+    for distance in range(max(max_pos_offset, max_neg_offset) + 1):
+        for where, limit in (
+            (first_guess + distance, max_pos_offset),
+            (first_guess - distance, max_neg_offset),
+        ):
+            if distance <= limit and matches(where, prefix_fuzz, suffix_fuzz):
+                return where - 1, prefix_fuzz, suffix_fuzz
+    return None
+
+
+def apply_hunks(
+    lines: List[str], hunks: List[Hunk], max_fuzz: int = 2
+) -> Tuple[List[str], List[Tuple[Hunk, str]]]:
+    """Apply hunks to lines the way 'patch --fuzz=<max_fuzz>' would.
+
+    Hunks may apply at an offset and, with fuzz, ignoring some of their
+    context. Returns the patched lines and the hunks that failed, each
+    with a reason. Failed hunks are skipped, like rejects.
+    """
+    patched: List[str] = []
+    failed = []
+    offset = 0
+    frozen = 0
+    for hunk in hunks:
+        for fuzz in range(min(max_fuzz, max(hunk.context())) + 1):
+            found = _locate_hunk(lines, hunk, offset, frozen, fuzz)
+            if found is not None:
+                break
+        else:
+            failed.append((hunk, "does not apply"))
+            continue
+        start, prefix, suffix = found
+        old, new = hunk.old, hunk.new
+        patched.extend(lines[frozen : start + prefix])
+        patched.extend(new[prefix : len(new) - suffix])
+        frozen = start + len(old) - suffix
+        offset = start - (hunk.old_start - (1 if old else 0))
+    patched.extend(lines[frozen:])
+    return patched, failed
+
+
+def _check_patch_group(
+    patches: List[Tuple[str, List[FilePatch]]],
+    files: Dict[str, Optional[List[str]]],
+) -> List[HunkFailure]:
+    """Apply patches touching the same files in order, collecting failures."""
+    files = dict(files)
+    failures = []
+    for name, file_patches in patches:
+        for file_patch in file_patches:
+            lines = files.get(file_patch.path)
+            if file_patch.creates and lines is not None:
+                failures.append(
+                    HunkFailure(
+                        name, file_patch.path, "", "creates an existing file"
+                    )
+                )
+                continue
+            if lines is None and not file_patch.creates:
+                if any(hunk.old for hunk in file_patch.hunks):
+                    failures.append(
+                        HunkFailure(
+                            name, file_patch.path, "", "patches a missing file"
+                        )
+                    )
+                    continue
+            lines, failed = apply_hunks(lines or [], file_patch.hunks)
+            failures.extend(
+                HunkFailure(name, file_patch.path, hunk.header, reason)
+                for hunk, reason in failed
+            )
+            files[file_patch.path] = None if file_patch.deletes else lines
+    return failures
+
+
+def check_patches_apply(
+    rev: str,
+    patches_rev: Optional[str] = None,
+    skip: Iterable[str] = (),
+    jobs: Optional[int] = None,
+) -> List[HunkFailure]:
+    """Check that the quilt series applies to the tree of rev, in memory.
+
+    Patches are read from the tree of patches_rev when given, otherwise
+    from the checkout, and those in skip are left out. Nothing is
+    checked out: the files patched are read from the object database.
+
+    Patches sharing no files are independent, so each group of patches
+    touching the same files is checked on a thread pool. Every hunk that
+    fails is reported, in series order.
+    """
+    parsed = []
+    for patch, strip in get_series_entries(patches_rev):
+        if patch in skip:
+            continue
+        path = Path("debian/patches", patch)
+        if patches_rev is None:
+            content = path.read_bytes() if path.exists() else b""
+        else:
+            content = GIT.read_file(patches_rev, str(path)) or b""
+        parsed.append(
+            (patch, parse_patch(content.decode(errors="replace"), strip))
+        )
+
+    # Group patches touching the same files, keeping series order
+    groups: List[List[Tuple[str, List[FilePatch]]]] = []
+    file_groups: Dict[str, int] = {}
+    for patch in parsed:
+        indexes = sorted(
+            {file_groups[f.path] for f in patch[1] if f.path in file_groups}
+        )
+        if indexes:
+            group = indexes[0]
+            for index in indexes[1:]:
+                groups[group].extend(groups[index])
+                groups[index] = []
+                for path, owner in file_groups.items():
+                    if owner == index:
+                        file_groups[path] = group
+            groups[group].append(patch)
+        else:
+            group = len(groups)
+            groups.append([patch])
+        for file_patch in patch[1]:
+            file_groups[file_patch.path] = group
+    order = {name: i for i, (name, _) in enumerate(parsed)}
+    groups = [
+        sorted(group, key=lambda patch: order[patch[0]])
+        for group in groups
+        if group
+    ]
+
+    # The cat-file session isn't thread safe, so read every file up front
+    files = {}
+    for path in file_groups:
+        content = GIT.read_file(rev, path)
+        files[path] = (
+            None
+            if content is None
+            else split_lines(content.decode(errors="replace"))
+        )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            lambda group: _check_patch_group(group, files), groups
+        )
+        failures = [failure for result in results for failure in result]
+    return sorted(failures, key=lambda failure: order[failure.patch])
+
 
 def is_commitish_upstream_tag(commitish):
     """Return true if the commitish is an upstream tag.
@@ -425,7 +1971,9 @@ def format_devel_bugs_fixed(bugs_fixed):
     return "\n".join(bugs_fixed_lines)
 
 
-def get_changelog_message(commitish, bug, is_upstream_tag, is_devel):
+def get_changelog_message(
+    commitish, bug, is_upstream_tag, is_devel, rev_range=None
+):
     """Get the "changes" message for d/changelog.
 
     This will vary based on if the commitish is an upstream tag, if there's
@@ -439,6 +1987,9 @@ def get_changelog_message(commitish, bug, is_upstream_tag, is_devel):
     and something like this for devel uploads:
     * Upstream snapshot based on <commitish>
       - Bugs fixed in this snapshot: (LP: #1111111, #2222222, #3333333)
+
+    Bugs are searched for in rev_range, which defaults to the commits
+    brought in by the most recent merge.
     """
     if is_upstream_tag:
         target = commitish
@@ -448,7 +1999,7 @@ def get_changelog_message(commitish, bug, is_upstream_tag, is_devel):
             f"{commitish}/ChangeLog"
         )
     else:
-        commit = capture(f"git rev-parse --short=8 {commitish}").stdout.strip()
+        commit = GIT.resolve(commitish)[:8]
         target = (
             commit
             if commitish.startswith(commit)
@@ -457,7 +2008,7 @@ def get_changelog_message(commitish, bug, is_upstream_tag, is_devel):
         release_text = ""
     bug_text = f" (LP: #{bug})." if bug else ""
     bugs_fixed_msg = ""
-    bugs_fixed = list(get_bugs_fixed_devel())
+    bugs_fixed = list(get_bugs_fixed_devel(rev_range))
     if is_devel and bugs_fixed:
         bugs_fixed_msg = format_devel_bugs_fixed(bugs_fixed)
     return (
@@ -468,24 +2019,53 @@ def get_changelog_message(commitish, bug, is_upstream_tag, is_devel):
 
 def get_original_head():
     """Get the original head before the upstream snapshot merge"""
-    for i in range(5):
-        commitish = f"HEAD~{i}"
-        if capture(f"git cat-file -p {commitish}").stdout.count("parent") > 1:
+    first_parents = capture(
+        "git rev-list --first-parent --parents --max-count=5 HEAD"
+    ).stdout.splitlines()
+    for i, line in enumerate(first_parents):
+        if len(line.split()) > 2:  # commit, first parent, other parent(s)
             return f"HEAD~{i+1}"
     raise CliError("No recent merge. Can't continue")
 
 
-def get_bugs_fixed_devel():
+def get_merged_head(commitish: str) -> Optional[str]:
+    """Return the commit HEAD was at before it recently merged commitish.
+
+    None if HEAD doesn't contain commitish or has no recent merge.
+    """
+    if capture(
+        f"git merge-base --is-ancestor {commitish} HEAD", check=False
+    ).returncode:
+        return None
+    try:
+        return GIT.resolve(get_original_head())
+    except CliError:
+        return None
+
+
+def get_bugs_fixed_devel(rev_range: Optional[str] = None) -> Iterator[str]:
     """Get all bugs fixed in this upstream snapshot.
 
-    Search for any `LP: #` in the git log for commits between the original
-    branch HEAD and the new branch HEAD.
+    Search for any `LP: #` lines in the git log for commits between the
+    original branch HEAD and the new branch HEAD, or in rev_range if given.
+    Lines may list several bugs, like `LP: #1, #2`. Each bug is only
+    reported once, newest commit first.
     """
-    orig_head = get_original_head()
-    commit_msgs = capture(f"git log {orig_head}..HEAD").stdout.strip()
-    for line in commit_msgs.splitlines():
-        if line.strip().startswith("LP: #"):
-            yield line.split("LP: #")[1].strip()
+    if rev_range is None:
+        rev_range = f"{get_original_head()}..HEAD"
+    seen = set()
+    # Let git skip commits without LP lines and only send message bodies
+    for message in stream(
+        f"git log -z --format=%B -E --grep='{LP_TRAILER_GREP}' {rev_range}"
+    ):
+        for line in message.splitlines():
+            match = LP_TRAILER_RE.match(line)
+            if not match:
+                continue
+            for bug in re.findall(r"\d+", match["bugs"]):
+                if bug not in seen:
+                    seen.add(bug)
+                    yield bug
 
 
 def get_new_version(
@@ -493,7 +2073,10 @@ def get_new_version(
     commitish: str,
     commitish_is_upstream_tag: bool,
     is_devel: bool,
+    context: Optional[SnapshotContext] = None,
 ) -> VersionInfo:
+    if context is None:
+        context = SnapshotContext()
     old_version = changelog_details.version
     previously_unreleased = changelog_details.distro.upper() == "UNRELEASED"
     changelog_version: VersionInfo
@@ -516,9 +2099,8 @@ def get_new_version(
         else:
             # If it's not devel and it doesn't have a series suffix, then
             # this is the first SRU to a series
-            series_number = capture("distro-info --stable -r").stdout.strip()
             changelog_version = VersionInfo.from_string(
-                f"{commitish}-0ubuntu1~{series_number}.1"
+                f"{commitish}-0ubuntu1~{context.stable_series_number}.1"
             )
         if tag_info.hotfix:
             # This is unfortunately only a heuristic. If devel is in
@@ -532,9 +2114,7 @@ def get_new_version(
         # Note that even if the version stays unreleased, we're going to
         # increment the ~<num> as it's intended to be less of a significant
         # version number and more a way to ensure newer releases sort higher
-        git_hash = capture(
-            f"git rev-parse --short=8 {commitish}"
-        ).stdout.strip()
+        git_hash = GIT.resolve(commitish)[:8]
         if old_version.pre_revision:
             major = old_version.major
             pre_revision = old_version.pre_revision + 1
@@ -577,73 +2157,164 @@ def update_changelog(
     bug,
     changelog_details: ChangelogDetails,
     is_devel,
+    context: Optional[SnapshotContext] = None,
 ):
     """Update the changelog with the new details.
 
-    Specifically, get the changelog message, determine the new version, then
-    use `dch` to write out a blank message and fill it in ourselves, then
-    commit.. We fill it in ourselves because the `dch` formatting sucks.
+    Specifically, get the changelog message, determine the new version,
+    write them to debian/changelog, then commit.
     """
     print("Updating changelog")
     commitish_is_upstream_tag = is_commitish_upstream_tag(commitish)
 
-    msg = get_changelog_message(
-        commitish, bug, commitish_is_upstream_tag, is_devel
-    )
+    with PROFILER.span("changelog message"):
+        msg = get_changelog_message(
+            commitish,
+            bug,
+            commitish_is_upstream_tag,
+            is_devel,
+            rev_range=f"{context.original_head}..HEAD" if context else None,
+        )
 
-    changelog_version = get_new_version(
-        changelog_details,
-        commitish,
-        commitish_is_upstream_tag,
-        is_devel,
-    )
+    with PROFILER.span("new version"):
+        changelog_version = get_new_version(
+            changelog_details,
+            commitish,
+            commitish_is_upstream_tag,
+            is_devel,
+            context,
+        )
 
     # Fill in the changelog message
-    add_msg_to_changelog(msg, changelog_version=changelog_version)
+    with PROFILER.span("write changelog"):
+        add_msg_to_changelog(msg, changelog_version=changelog_version)
 
     # Commit the changelog
     sh(
         "git commit --no-verify -m 'update changelog (new upstream snapshot)' "
         "debian/changelog"
     )
+    GIT.invalidate()
+    if context:
+        context.invalidate_changelog()
 
 
-def add_msg_to_changelog(
-    msg, *, changelog_version: Optional[VersionInfo] = None
-):
-    """Add a new message to the changelog.
+def get_maintainer() -> str:
+    """Return the 'Name <email>' to sign changelog entries with.
 
-    We do this roundabout way of calling dch and then manually editing the
-    file because dch doesn't allow for newlines in the message. Instead,
-    use dch to give us a placeholder and then manually insert our message
+    Like dch, use DEBFULLNAME (or NAME) and DEBEMAIL (or EMAIL), which may
+    hold 'Name <email>'. Anything not set there comes from git's author
+    identity, i.e. user.name and user.email.
     """
-    version_string = (
-        f"--newversion '{str(changelog_version)}'" if changelog_version else ""
-    )
-    dch_command = f"dch --no-multimaint {version_string} ' '"
-    sh(dch_command)
-
-    changelog_path = Path("debian/changelog")
-    changelog = changelog_path.read_text()
-    if changelog.count("  *\n") != 1:
+    name = os.environ.get("DEBFULLNAME") or os.environ.get("NAME")
+    email = os.environ.get("DEBEMAIL") or os.environ.get("EMAIL")
+    match = MAINTAINER_RE.match(email or "")
+    if match:
+        name, email = name or match["name"], match["email"]
+    if not (name and email):
+        ident = capture("git var GIT_AUTHOR_IDENT", check=False).stdout
+        match = MAINTAINER_RE.match(ident.rpartition(">")[0] + ">")
+        if match:
+            name, email = name or match["name"], email or match["email"]
+    if not (name and email):
         raise CliError(
-            "debian/changelog has more than one blank changelog entry. "
-            "Not sure how to proceed."
+            "Could not determine who to sign the changelog entry as. Set "
+            "DEBFULLNAME and DEBEMAIL, or git's user.name and user.email."
         )
-    with changelog_path.open("w") as f:
-        for line in changelog.splitlines():
-            if line == "  *":
-                line = msg
-            f.write(f"{line}\n")
+    return f"{name} <{email}>"
 
 
-def show_release_steps(changelog_details, devel_distro, is_devel):
+def add_msg_to_changelog(
+    msg, *, changelog_version: Optional[VersionInfo] = None
+):
+    """Add a new message to the changelog, as 'dch' would.
+
+    If the newest entry is UNRELEASED, msg is appended to its changes and
+    its version set to changelog_version, if given. Otherwise a new
+    UNRELEASED entry is started at changelog_version, or at the previous
+    version with its last number incremented. Either way the entry is
+    signed by get_maintainer() with the current date. msg is written as
+    is, so it can span several lines.
+    """
+    changelog_path = Path("debian/changelog")
+    # Only the newest entry is read: the rest is copied as it is, line
+    # endings included
+    with open(changelog_path, newline="") as source:
+        lines = []
+        for line in iter(source.readline, ""):
+            lines.append(line)
+            if CHANGELOG_TRAILER_RE.match(line.rstrip("\r\n")):
+                break
+        header = (
+            CHANGELOG_HEADER_RE.match(lines[0].rstrip("\r\n"))
+            if lines
+            else None
+        )
+        if not header:
+            raise CliError(
+                "Could not parse the first line of debian/changelog"
+            )
+        if not CHANGELOG_TRAILER_RE.match(lines[-1].rstrip("\r\n")):
+            raise CliError(
+                "Could not find the end of the debian/changelog entry"
+            )
+        trailer = f" -- {get_maintainer()}  {formatdate(localtime=True)}"
+
+        if header["distro"].split() == ["UNRELEASED"]:
+            version = str(changelog_version or header["version"])
+            body = lines[1:-1]
+            while body and not body[0].rstrip("\r\n"):
+                body.pop(0)
+            while body and not body[-1].rstrip("\r\n"):
+                body.pop()
+            entry = [
+                lines[0][: header.start("version")]
+                + version
+                + lines[0][header.end("version") :],
+                "\n",
+                *body,
+                f"{msg}\n",
+                "\n",
+                f"{trailer}\n",
+            ]
+            rest = source.tell()
+        else:
+            version = str(changelog_version or "")
+            if not version:
+                version, count = re.subn(
+                    r"\d+$", lambda m: str(int(m[0]) + 1), header["version"]
+                )
+                if not count:
+                    raise CliError(f"Don't know how to increment {version}")
+            entry = [
+                f"{header['source']} ({version}) UNRELEASED; urgency=medium\n",
+                "\n",
+                f"{msg}\n",
+                "\n",
+                f"{trailer}\n",
+                "\n",
+            ]
+            rest = 0
+        source.seek(rest)
+        with atomic_write(changelog_path) as f:
+            f.writelines(entry)
+            shutil.copyfileobj(source, f)
+
+
+def show_release_steps(
+    changelog_details,
+    devel_distro,
+    is_devel,
+    context: Optional[SnapshotContext] = None,
+):
     """Because we all like automation telling us to do more things."""
+    if context is None:
+        context = SnapshotContext()
     series = devel_distro if is_devel else changelog_details.distro
     if series.upper() == "UNRELEASED":
-        series = get_changelog_distro()
-    new_version = str(ChangelogDetails.get().version)
-    git_branch_name = capture("git rev-parse --abbrev-ref HEAD").stdout.strip()
+        series = context.changelog_distro
+    new_version = str(context.changelog_details.version)
+    git_branch_name = GIT.current_branch()
     new_tag = new_version.replace("~", "_")
     if "ubuntu" in new_tag and not new_tag.startswith("ubuntu/"):
         new_tag = f"ubuntu/{new_tag}"
@@ -669,20 +2340,22 @@ def get_possible_devel_options(
     known_first_devel_upload,
     known_first_sru,
     changelog_details: ChangelogDetails,
+    interactive: bool = True,
+    context: Optional[SnapshotContext] = None,
 ) -> Tuple[str, bool, bool, bool]:
     """Determine if we're on devel and our options for the devel branch.
 
     If we're on a devel branch and the changelog distro doesn't match
     the current devel release, we have no way of determining whether this
     is a new devel upload or a new SRU. If the user provided no flags telling
-    us what to do, we have to ask.
+    us what to do, we have to ask, unless interactive is False in which
+    case CliError is raised.
     """
+    if context is None:
+        context = SnapshotContext()
     is_devel = is_first_devel_upload = known_first_devel_upload
     is_first_sru = known_first_sru
-    try:
-        devel_distro = capture("distro-info --devel").stdout.strip()
-    except Exception:
-        devel_distro = "UNKNOWN"
+    devel_distro = context.devel_distro
     if is_first_devel_upload and is_first_sru:
         raise CliError(
             "Can't simultaneously be first SRU and first devel upload"
@@ -692,17 +2365,24 @@ def get_possible_devel_options(
         and not known_first_sru
         and not changelog_details.version.series_revision
     ):
-        changelog_distro = get_changelog_distro()
+        changelog_distro = context.changelog_distro
         is_devel = True
         if devel_distro != changelog_distro:
             # Changelog shows devel release numbers, but not the current devel
             # release. We need to know whether this is a new devel upload
             # or the first SRU upload for a series.
-            print(
+            mismatch = (
                 f"d/changelog shows current devel distro as "
                 f"{changelog_distro}, yet `distro-info` says it is "
                 f"{devel_distro}."
             )
+            if not interactive:
+                raise CliError(
+                    f"{mismatch} Snapshot this branch with -d if this is the "
+                    f"first devel upload for {devel_distro}, or with -s if "
+                    f"this is the first SRU for series {changelog_distro}."
+                )
+            print(mismatch)
             if (
                 input(
                     f"Is this the first devel upload for {devel_distro} "
@@ -745,6 +2425,9 @@ def new_upstream_snapshot(
     no_sru_bug: bool = False,
     known_first_sru: bool = False,
     post_stage: Optional[str] = None,
+    interactive: bool = True,
+    fetch: bool = True,
+    full_refresh: bool = False,
 ) -> None:
     """Perform a new upstream snapshot.
 
@@ -754,42 +2437,483 @@ def new_upstream_snapshot(
      - Refresh all quilt patches on the branch
      - Update the changelog accordingly
      - Tell user how to release this update
+
+    Completed stages are recorded in a SnapshotJournal until the snapshot
+    finishes. If a stage fails, fix things up and rerun: stages whose
+    results are still in place are skipped. post_stage forces skipping
+    stages without a journal.
+
+    When interactive is False, nothing is asked: CliError is raised if
+    the devel options can't be told from the changelog, and a missing SRU
+    bug is left out. Unless full_refresh is True, only patches affected
+    by the merge are refreshed.
     """
     if not Path("debian/changelog").exists():
         raise CliError(
             "No debian/changelog found. Are we in the right dir or branch?"
         )
 
-    old_changelog_details = ChangelogDetails.get()
-    skip_past_merge = post_stage in {"merge", "quilt"}
-    skip_past_quilt = post_stage == "quilt"
-
-    if not skip_past_merge:
-        merge_commitish(commitish)
-    if not skip_past_quilt:
-        drop_cpicks(commitish)
-        refresh_patches(commitish)
-
-    # If arguments haven't been passed, we have a few things to determine
-    (
-        devel_distro,
-        is_devel,
-        is_first_devel_upload,
-        first_sru,
-    ) = get_possible_devel_options(
-        known_first_devel_upload=known_first_devel_upload,
-        known_first_sru=known_first_sru,
-        changelog_details=old_changelog_details,
-    )
-    bug = None if is_devel else get_sru_bug(bug, no_sru_bug)
-    update_changelog(
-        commitish,
-        bug,
-        old_changelog_details,
-        is_devel,
+    try:
+        journal = SnapshotJournal(commitish)
+        with PROFILER.span("read changelog"):
+            if journal.original_head:
+                print(
+                    f"Resuming the snapshot of {commitish} started at "
+                    f"{journal.original_head[:8]}"
+                )
+                changelog = GIT.read_file(
+                    journal.original_head, "debian/changelog"
+                )
+                old_changelog_details = ChangelogDetails.from_lines(
+                    (changelog or b"").decode(errors="replace").splitlines()
+                )
+            else:
+                old_changelog_details = ChangelogDetails.get()
+        skip_past_merge = post_stage in {"merge", "quilt"} or (
+            journal.is_done("merge")
+        )
+        skip_past_quilt = post_stage == "quilt"
+        if not journal.original_head:
+            journal.start(get_original_head() if skip_past_merge else "HEAD")
+        context = SnapshotContext(original_head=journal.original_head)
+
+        # If arguments haven't been passed, we have a few things to
+        # determine before the branch is changed
+        with PROFILER.span("devel options"):
+            (
+                devel_distro,
+                is_devel,
+                is_first_devel_upload,
+                first_sru,
+            ) = get_possible_devel_options(
+                known_first_devel_upload=known_first_devel_upload,
+                known_first_sru=known_first_sru,
+                changelog_details=old_changelog_details,
+                interactive=interactive,
+                context=context,
+            )
+
+        if journal.merged:
+            print(f"{commitish} was already merged")
+            check_upstream_files(commitish)
+            journal.done("merge")
+        elif not skip_past_merge:
+            with PROFILER.span("merge"):
+                try:
+                    merge_commitish(commitish, fetch=fetch)
+                finally:
+                    # Merging upstream/main fetches it first
+                    journal.update_commit()
+            journal.done("merge")
+        if not skip_past_quilt:
+            series = "debian/patches/series"
+            if journal.is_done("drop cpicks", series=hash_paths(series)):
+                print("Cherry picks were already dropped")
+            else:
+                with PROFILER.span("drop cpicks"):
+                    drop_cpicks(commitish, context)
+                journal.done("drop cpicks", series=hash_paths(series))
+            patches = "debian/patches"
+            if journal.is_done("refresh patches", patches=hash_paths(patches)):
+                print("Patches were already refreshed")
+            else:
+                with PROFILER.span("refresh patches"):
+                    refresh_patches(
+                        commitish,
+                        incremental=not full_refresh,
+                        context=context,
+                    )
+                journal.done("refresh patches", patches=hash_paths(patches))
+
+        if is_devel:
+            bug = None
+        elif interactive:
+            bug = get_sru_bug(bug, no_sru_bug)
+        changelog = hash_paths("debian/changelog")
+        if journal.is_done("update changelog", changelog=changelog):
+            print("The changelog was already updated")
+        else:
+            with PROFILER.span("update changelog"):
+                update_changelog(
+                    commitish,
+                    bug,
+                    old_changelog_details,
+                    is_devel,
+                    context,
+                )
+            journal.done(
+                "update changelog", changelog=hash_paths("debian/changelog")
+            )
+
+        with PROFILER.span("release steps"):
+            show_release_steps(
+                old_changelog_details, devel_distro, is_devel, context
+            )
+        journal.finish()
+    finally:
+        GIT.invalidate()
+
+
+class BranchResult(NamedTuple):
+    branch: str
+    version: Optional[str]
+    error: Optional[str]
+    output: str
+
+
+def _snapshot_worktree(
+    worktree: str,
+    branch: str,
+    commitish: str,
+    bug: Optional[str],
+    no_sru_bug: bool,
+) -> BranchResult:
+    """Run a non-interactive snapshot in worktree. Used by worker processes.
+
+    What the snapshot prints, and the output of the commands it runs, is
+    logged to a file returned as the result's output.
+    """
+    global COMMAND_OUTPUT
+    os.chdir(worktree)
+    with tempfile.TemporaryFile("w+") as output:
+        COMMAND_OUTPUT = output
+        version, error = None, None
+        try:
+            with redirect_stdout(output):
+                new_upstream_snapshot(
+                    commitish,
+                    bug,
+                    no_sru_bug=no_sru_bug,
+                    interactive=False,
+                    fetch=False,
+                )
+            version = str(ChangelogDetails.get().version)
+        except (CliError, CalledProcessError) as e:
+            error = str(e)
+        except Exception as e:  # Reported with the other branches' results
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc(file=output)
+        finally:
+            COMMAND_OUTPUT = None
+        output.seek(0)
+        return BranchResult(branch, version, error, output.read())
+
+
+def snapshot_branches(
+    branches: List[str],
+    commitish: str,
+    bug: Optional[str] = None,
+    no_sru_bug: bool = False,
+    jobs: Optional[int] = None,
+) -> List[BranchResult]:
+    """Snapshot commitish onto several packaging branches in parallel.
+
+    Every branch gets its own temporary 'git worktree' so the snapshots
+    can't interfere with each other; the branch currently checked out is
+    snapshotted in place. Upstream is fetched once, up front. Results are
+    returned in the order of branches, failures included.
+    """
+    if commitish == "upstream/main":
+        capture("git fetch upstream")
+    current_branch = GIT.current_branch()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="snapshot-") as tmpdir:
+        worktrees = {}
+        try:
+            for branch in branches:
+                if branch == current_branch:
+                    worktrees[branch] = os.getcwd()
+                    continue
+                path = os.path.join(tmpdir, branch.replace("/", "_"))
+                try:
+                    capture(f"git worktree add {path} {branch}")
+                except CalledProcessError as e:
+                    results[branch] = BranchResult(
+                        branch, None, e.stderr.strip(), ""
+                    )
+                    continue
+                worktrees[branch] = path
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = {
+                    branch: pool.submit(
+                        _snapshot_worktree,
+                        path,
+                        branch,
+                        commitish,
+                        bug,
+                        no_sru_bug,
+                    )
+                    for branch, path in worktrees.items()
+                }
+                for branch, future in futures.items():
+                    results[branch] = future.result()
+        finally:
+            for branch, path in worktrees.items():
+                if branch != current_branch:
+                    sh(f"git worktree remove --force {path}", check=False)
+            GIT.invalidate()
+    return [results[branch] for branch in branches]
+
+
+def format_batch_report(results: List[BranchResult]) -> str:
+    """Summarize snapshot_branches() results, then show each branch's log."""
+    width = max((len(result.branch) for result in results), default=0)
+    summary = []
+    details = []
+    for result in results:
+        status = result.version or f"FAILED: {result.error}"
+        summary.append(f"{result.branch:<{width}}  {status}")
+        details.append(f"===== {result.branch} =====\n{result.output}")
+    return "\n".join(summary + [""] + details)
+
+
+class SnapshotPlan(NamedTuple):
+    commitish: str
+    merge_tree: str
+    conflicts: List[str]
+    upstream_files: List[str]
+    dropped_cpicks: List[str]
+    patches_to_refresh: List[str]
+    failing_hunks: List[HunkFailure]
+    version: VersionInfo
+    changelog_entry: str
+
+    def __str__(self):
+        def listing(items):
+            return "".join(f"\n    {item}" for item in items) or " none"
+
+        upstream_check = (
+            f"would fail for:{listing(self.upstream_files)}"
+            if self.upstream_files
+            else "ok"
+        )
+        return "\n".join(
+            [
+                f"Snapshot plan for {self.commitish}:",
+                f"  Merge result tree: {self.merge_tree}",
+                f"  Merge conflicts (taken from {self.commitish}):"
+                f"{listing(self.conflicts)}",
+                f"  Upstream file check: {upstream_check}",
+                f"  Cherry picks to drop:{listing(self.dropped_cpicks)}",
+                "  Patches touching changed upstream files:"
+                f"{listing(self.patches_to_refresh)}",
+                "  Patches that may no longer apply:"
+                f"{listing(self.failing_hunks)}",
+                f"  New version: {self.version}",
+                "  Changelog entry:",
+                self.changelog_entry,
+            ]
+        )
+
+
+def merge_tree(commitish) -> Tuple[str, List[str]]:
+    """Merge commitish into HEAD in memory.
+
+    Returns the resulting tree id and any conflicted paths. Older gits
+    can't apply '--strategy-option=theirs' to 'git merge-tree', so there
+    conflicted paths are reported and assumed to be resolved to the
+    commitish side, as the real merge would do.
+    """
+    command = (
+        f"git merge-tree --write-tree --name-only -X theirs HEAD {commitish}"
     )
+    result = capture(command, check=False)
+    if result.returncode == 129:  # Unknown option
+        command = command.replace(" -X theirs", "")
+        result = capture(command, check=False)
+    if result.returncode not in (0, 1):
+        raise CliError(
+            f"'git merge-tree' failed for {commitish}: {result.stderr}"
+        )
+    tree, _, rest = result.stdout.partition("\n")
+    conflicts = rest.split("\n\n", 1)[0].splitlines()
+    return tree, conflicts
 
-    show_release_steps(old_changelog_details, devel_distro, is_devel)
+
+def plan_upstream_snapshot(
+    commitish: str,
+    bug: Optional[str] = None,
+    known_first_devel_upload: bool = False,
+    known_first_sru: bool = False,
+) -> SnapshotPlan:
+    """Work out what new_upstream_snapshot() would do, without doing it.
+
+    Nothing in the checkout, index or refs is modified: the merge is done
+    with 'git merge-tree' and everything else is read from git objects
+    or the current debian/changelog. Nothing is asked interactively.
+    """
+    if not Path("debian/changelog").exists():
+        raise CliError(
+            "No debian/changelog found. Are we in the right dir or branch?"
+        )
+    try:
+        context = SnapshotContext()
+        changelog_details = context.changelog_details
+        try:
+            GIT.resolve(commitish)
+        except CliError as e:
+            raise CliError(
+                f"{commitish} is not a valid commitish or annotated tag"
+            ) from e
+
+        tree, conflicts = merge_tree(commitish)
+        upstream_files = [
+            path
+            for path in get_upstream_file_changes(commitish, tree, limit=None)
+            if path not in conflicts
+        ]
+
+        series = get_series("HEAD")
+        cpicks = {p: p.split("-")[1] for p in series if p.startswith("cpick")}
+        ancestors = get_ancestor_hashes(cpicks.values(), commitish)
+        dropped_cpicks = [p for p, h in cpicks.items() if h in ancestors]
+
+        merge_base = capture(f"git merge-base HEAD {commitish}").stdout.strip()
+        changed_files = get_changed_files(merge_base, commitish)
+        patches_to_refresh = [
+            patch
+            for patch in get_affected_patches(changed_files, "HEAD")
+            if patch not in dropped_cpicks
+        ]
+
+        devel_distro, is_devel, _, _ = get_possible_devel_options(
+            known_first_devel_upload=known_first_devel_upload,
+            known_first_sru=known_first_sru,
+            changelog_details=changelog_details,
+            interactive=False,
+            context=context,
+        )
+        commitish_is_upstream_tag = is_commitish_upstream_tag(commitish)
+        msg = get_changelog_message(
+            commitish,
+            None if is_devel else bug,
+            commitish_is_upstream_tag,
+            is_devel,
+            rev_range=f"HEAD..{commitish}",
+        )
+        version = get_new_version(
+            changelog_details,
+            commitish,
+            commitish_is_upstream_tag,
+            is_devel,
+            context,
+        )
+        entry = [
+            f"{changelog_details.source} ({version}) UNRELEASED; "
+            f"urgency={changelog_details.urgency or 'medium'}",
+            "",
+        ]
+        if patches_to_refresh:
+            entry.append("  * refresh patches:")
+            entry.extend(f"    - d/p/{p}" for p in patches_to_refresh)
+        entry.append(msg)
+        return SnapshotPlan(
+            commitish=commitish,
+            merge_tree=tree,
+            conflicts=conflicts,
+            upstream_files=upstream_files,
+            dropped_cpicks=dropped_cpicks,
+            patches_to_refresh=patches_to_refresh,
+            failing_hunks=check_patches_apply(tree, "HEAD", dropped_cpicks),
+            version=version,
+            changelog_entry="\n".join(entry),
+        )
+    finally:
+        GIT.invalidate()
+
+
+class ApplicableCommit(NamedTuple):
+    commitish: str
+    commit: Optional[str]
+    breaking_commit: Optional[str]
+    failures: List[HunkFailure]
+    probes: int
+
+    def __str__(self):
+        if self.commit is None:
+            lines = [
+                "The patches don't apply to any first-parent commit between "
+                f"the packaged version and {self.commitish}."
+            ]
+        else:
+            lines = [
+                f"Newest commit the patches apply to: {self.commit}",
+                f"Snapshot it with: new_upstream_snapshot.py -c {self.commit}",
+            ]
+        if self.breaking_commit:
+            lines.append(
+                f"The patches no longer apply to {self.breaking_commit}:"
+            )
+            lines.extend(f"    {failure}" for failure in self.failures)
+        lines.append(f"({self.probes} commits checked)")
+        return "\n".join(lines)
+
+
+def find_applicable_commitish(commitish: str) -> ApplicableCommit:
+    """Find the newest upstream commit the quilt series still applies to.
+
+    Binary search the first-parent history from the upstream commit last
+    merged into HEAD to commitish, checking the patches on HEAD in memory
+    at each probe as check_patches_apply() does. Cherry picks already in
+    a probed commit are left out, as drop_cpicks() would do. Applying is
+    assumed to keep failing once it has failed.
+    """
+    try:
+        GIT.resolve(commitish)
+    except CliError as e:
+        raise CliError(
+            f"{commitish} is not a valid commitish or annotated tag"
+        ) from e
+    try:
+        merge_base = capture(f"git merge-base HEAD {commitish}").stdout.strip()
+        candidates = capture(
+            f"git rev-list --first-parent --reverse {merge_base}..{commitish}"
+        ).stdout.split()
+        cpicks = {
+            patch: patch.split("-")[1]
+            for patch in get_series("HEAD")
+            if patch.startswith("cpick")
+        }
+        # Found once for every probe
+        first_containing = get_first_containing(cpicks.values(), candidates)
+        probes = 0
+
+        def check(index):
+            nonlocal probes
+            probes += 1
+            skip = [
+                patch
+                for patch, h in cpicks.items()
+                if first_containing.get(h, index + 1) <= index
+            ]
+            return check_patches_apply(candidates[index], "HEAD", skip)
+
+        # Invariant: the patches apply to candidates[:low] and don't
+        # apply to candidates[high:]
+        low, high = 0, len(candidates)
+        failures = check(len(candidates) - 1) if candidates else []
+        if failures:
+            high -= 1
+        else:
+            low = high
+        while low < high:
+            middle = (low + high) // 2
+            middle_failures = check(middle)
+            if middle_failures:
+                high, failures = middle, middle_failures
+            else:
+                low = middle + 1
+        return ApplicableCommit(
+            commitish=commitish,
+            commit=candidates[low - 1] if low else None,
+            breaking_commit=(
+                candidates[high] if high < len(candidates) else None
+            ),
+            failures=failures,
+            probes=probes,
+        )
+    finally:
+        GIT.invalidate()
 
 
 def parse_args() -> argparse.Namespace:
@@ -846,7 +2970,92 @@ def parse_args() -> argparse.Namespace:
             "to manually fix the branch due to a merge or having to refresh "
             "quilt patches. It assumes the steps prior to and including "
             "this stage have already been run and will run the remaining "
-            "steps accordingly."
+            "steps accordingly. Rerunning without it resumes from the "
+            "last completed stage recorded in .git."
+        ),
+    )
+    parser.add_argument(
+        "--full-refresh",
+        required=False,
+        default=False,
+        action="store_true",
+        help=(
+            "Push and refresh every quilt patch, not only those touching "
+            "files changed by the merge."
+        ),
+    )
+    parser.add_argument(
+        "--branches",
+        required=False,
+        nargs="+",
+        metavar="BRANCH",
+        help=(
+            "Snapshot each of these packaging branches in parallel, each in "
+            "its own temporary git worktree, without prompting. Devel "
+            "options are determined automatically and --bug applies to "
+            "every SRU branch."
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        default=None,
+        type=int,
+        help="Number of branches to snapshot at once with --branches",
+    )
+    parser.add_argument(
+        "--plan",
+        required=False,
+        default=False,
+        action="store_true",
+        help=(
+            "Report what the snapshot would do (merge result, cherry picks "
+            "dropped, patches to refresh, new version and changelog) "
+            "without modifying the checkout."
+        ),
+    )
+    parser.add_argument(
+        "--find-applicable",
+        required=False,
+        default=False,
+        action="store_true",
+        help=(
+            "Find the newest commit in the first-parent history of the "
+            "commitish that the quilt patches still apply to, without "
+            "modifying the checkout."
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        required=False,
+        default=None,
+        metavar="TRACE_FILE",
+        help=(
+            "Time every stage and command, print a summary table and write "
+            "a Chrome trace (JSON) of the run to TRACE_FILE."
+        ),
+    )
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        "--record",
+        required=False,
+        default=None,
+        metavar="CASSETTE",
+        help=(
+            "Record every command run, with its output and exit code, to "
+            "the CASSETTE file."
+        ),
+    )
+    recording.add_argument(
+        "--replay",
+        required=False,
+        default=None,
+        metavar="CASSETTE",
+        help=(
+            "Answer commands from a CASSETTE written by --record instead "
+            "of running them. Files the commands changed are not "
+            "restored, so run this in a copy of the recorded checkout."
         ),
     )
     parser.add_argument(
@@ -866,7 +3075,36 @@ def parse_args() -> argparse.Namespace:
 
 if __name__ == "__main__":
     args = parse_args()
+    PROFILER.enabled = bool(args.profile)
+    if args.record:
+        CASSETTE.record(args.record)
+    elif args.replay:
+        CASSETTE.replay(args.replay)
     try:
+        if args.plan:
+            print(
+                plan_upstream_snapshot(
+                    args.commitish,
+                    args.bug,
+                    args.first_devel_upload,
+                    args.first_sru,
+                )
+            )
+            sys.exit(0)
+        if args.find_applicable:
+            result = find_applicable_commitish(args.commitish)
+            print(result)
+            sys.exit(0 if result.commit else 1)
+        if args.branches:
+            results = snapshot_branches(
+                args.branches,
+                args.commitish,
+                args.bug,
+                args.no_sru_bug,
+                args.jobs,
+            )
+            print(format_batch_report(results))
+            sys.exit(1 if any(result.error for result in results) else 0)
         new_upstream_snapshot(
             args.commitish,
             args.bug,
@@ -874,7 +3112,14 @@ if __name__ == "__main__":
             args.no_sru_bug,
             args.first_sru,
             args.post_stage,
+            full_refresh=args.full_refresh,
         )
     except CliError as e:
         print(e)
         sys.exit(1)
+    finally:
+        CASSETTE.stop()
+        if args.profile:
+            print(PROFILER.summary())
+            PROFILER.write_chrome_trace(args.profile)
+            print(f"Wrote trace to {args.profile}")
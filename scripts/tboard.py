@@ -12,10 +12,13 @@
 
 # Example call python /tboard.py --board-name 'Daily Cloud-init/curtin'
 #    --list-name 'Done' --label-name cloud-init
+# Add --bulk to fetch each board's cards and their details in one request
 
 import argparse
+import itertools
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from trello import TrelloClient
@@ -32,6 +35,25 @@ COMMENT_DOC_PREFIX = "DOC:"
 
 CREDS_FILE = ".trello-creds"  # Where we cache our oauth creds
 
+# How many card attachment and comment requests to make at once
+DEFAULT_JOBS = 8
+
+# Comment actions, as fetched by Card.fetch_comments()
+COMMENT_ACTIONS = "commentCard,copyCommentCard"
+# Trello only nests the newest 50 actions of each card unless asked for
+# more, up to this many
+ACTIONS_LIMIT = 1000
+
+
+def positive_int(value):
+    """Parse a command line count, which must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "must be at least 1, not {}".format(value)
+        )
+    return number
+
 
 def get_parser():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -66,6 +88,21 @@ def get_parser():
         help="Only print the documentation lines for cards."
         " Default behavior is <linked_bugs>: <doc:_comment>",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help="How many card details to fetch from Trello at once."
+        " Default: {}".format(DEFAULT_JOBS),
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        default=False,
+        help="Fetch all cards of a board, with their attachments and"
+        " comments, in one request instead of two requests per card",
+    )
     return parser
 
 
@@ -87,9 +124,100 @@ URL: {url}
 """
 
 
-def format_card_content(card, docs_only=False):
+def card_labels(card):
+    """Return the labels of card.
+
+    py-trello renamed Card.list_labels to Card.labels.
+    """
+    return getattr(card, "list_labels", None) or card.labels
+
+
+def prefetch_card_details(cards, jobs=DEFAULT_JOBS):
+    """Fetch the attachments and comments of cards concurrently.
+
+    Yield (card, attachments, comments) in the order of cards, each as soon
+    as it and the cards before it are fetched.
+    """
+    if not cards:
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        fetches = [
+            (
+                card,
+                executor.submit(card.fetch_attachments, force=True),
+                executor.submit(card.fetch_comments, force=True),
+            )
+            for card in cards
+        ]
+        try:
+            for card, attachments, comments in fetches:
+                yield card, attachments.result(), comments.result()
+        finally:
+            # Don't wait for the remaining cards after an error
+            for _, attachments, comments in fetches:
+                attachments.cancel()
+                comments.cancel()
+
+
+def board_card_details(board, list_name=None, label=None):
+    """Return the open cards of board with their attachments and comments.
+
+    Return (card, attachments, comments) for each card in list_name, if set,
+    with label, if set, in list and card order. This takes two requests, for
+    the lists and for the cards, whatever the number of cards. Up to
+    ACTIONS_LIMIT comments are returned for each card.
+    """
+    lists = [
+        board_list.id
+        for board_list in board.list_lists()
+        if not list_name or list_name == board_list.name
+    ]
+    if not lists:
+        return []
+    cards = board.get_cards(
+        {
+            "attachments": "true",
+            "attachment_fields": "url",
+            "actions": COMMENT_ACTIONS,
+            "actions_limit": str(ACTIONS_LIMIT),
+        },
+        card_filter="open",
+    )
+    cards = sorted(
+        (
+            card
+            for card in cards
+            if card.idList in lists and label_matches(label, card)
+        ),
+        key=lambda card: (lists.index(card.idList), card.pos),
+    )
+    return [
+        (
+            card,
+            card.attachments,
+            sorted(
+                getattr(card, "actions", []),
+                key=lambda comment: comment["date"],
+            ),
+        )
+        for card in cards
+    ]
+
+
+def format_card_content(
+    card, docs_only=False, attachments=None, comments=None
+):
+    """Format card as markdown.
+
+    Attachments and comments are fetched from Trello unless given, as
+    from prefetch_card_details().
+    """
+    if attachments is None:
+        attachments = card.fetch_attachments(force=True)
+    if comments is None:
+        comments = card.fetch_comments(force=True)
     bug_prefix = ""
-    for attachment in card.fetch_attachments(force=True):
+    for attachment in attachments:
         if "+bug" in attachment["url"]:
             bug_id = attachment["url"].split("bug/")[-1]
             if bug_prefix:
@@ -98,7 +226,7 @@ def format_card_content(card, docs_only=False):
     if bug_prefix:
         bug_prefix += ": "
     doc = ""
-    for comment in card.fetch_comments(force=True):
+    for comment in comments:
         comment_text = comment.get("data", {}).get("text", "")
         if comment_text.startswith(COMMENT_DOC_PREFIX):
             doc = comment_text.replace(COMMENT_DOC_PREFIX, "")
@@ -113,7 +241,7 @@ def format_card_content(card, docs_only=False):
         return CARD_TEMPLATE.format(
             **{
                 "name": card.name,
-                "labels": card.list_labels,
+                "labels": card_labels(card),
                 "desc": card.desc,
                 "doc": doc,
                 "url": card.url,
@@ -127,10 +255,7 @@ def label_matches(label, card):
     """Return True if label is unset or matches any part of card labels"""
     if not label:
         return True
-    if card.list_labels:
-        label_names = [line.name for line in card.list_labels]
-    else:
-        label_names = []
+    label_names = [line.name for line in card_labels(card)]
     for label_name in label_names:
         if label in label_name:
             return True
@@ -182,21 +307,32 @@ def main():
 
     client = get_trello_client()
     boards = client.list_boards()
+    details = []
+    cards = []
     for board in boards:
         if args.list_boards:
             print(format_board_content(board))
             continue
         if args.board_name and args.board_name != board.name:
             continue
+        if args.bulk:
+            details.extend(
+                board_card_details(board, args.list_name, args.label_name)
+            )
+            continue
         for board_list in board.list_lists():
             if args.list_name and args.list_name != board_list.name:
                 continue
             for card in board_list.list_cards():
-                if not label_matches(args.label_name, card):
-                    continue
-                content = format_card_content(card, args.doc)
-                if content:
-                    print(content)
+                if label_matches(args.label_name, card):
+                    cards.append(card)
+    # Only one of details or cards is filled, depending on --bulk
+    for card, attachments, comments in itertools.chain(
+        details, prefetch_card_details(cards, args.jobs)
+    ):
+        content = format_card_content(card, args.doc, attachments, comments)
+        if content:
+            print(content)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,484 @@
+"""Tests for add_changelog.py
+
+Requires pytest
+"""
+import os
+import re
+import shutil
+import sys
+from pathlib import Path
+from subprocess import check_output
+from types import ModuleType, SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from scripts.add_changelog import (
+    add_changelog,
+    add_to_top_stanza,
+    atomic_write,
+    format_commits,
+    format_dch_item,
+    get_gbp_entries,
+    get_maintainer,
+    hash_formatter,
+    read_top_stanza,
+    write_changelog,
+)
+
+OLD_STANZA = """\
+cloud-init (22.1-0ubuntu1) jammy; urgency=medium
+
+  * +  left as it was
+     five spaces
+
+ -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200
+"""
+
+
+def test_write_changelog_fixes_formatting(changelog_dir):
+    changelog = changelog_dir / "debian" / "changelog"
+    changelog.write_text(
+        "cloud-init (22.2~1g12345678-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * Upstream snapshot based on main at 12345678.\n"
+        "    - Bugs fixed in this snapshot: (LP: #1)\n"
+        "    - List of changes from upstream can be found at\n"
+        "  * +  feat(scope): change [Author Name]\n"
+        "  *       wrapped with a marker\n"
+        "     wrapped with five spaces (LP: #1)\n"
+        "      wrapped with six spaces\n"
+        "\n"
+        " -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200\n"
+        "\n" + OLD_STANZA
+    )
+    changelog.chmod(0o640)
+    write_changelog(*read_top_stanza())
+    assert (
+        "cloud-init (22.2~1g12345678-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * Upstream snapshot based on main at 12345678.\n"
+        "    - Bugs fixed in this snapshot: (LP: #1)\n"
+        "    - List of changes from upstream can be found at\n"
+        "    +   feat(scope): change [Author Name]\n"
+        "      wrapped with a marker\n"
+        "      wrapped with five spaces (LP: #1)\n"
+        "      wrapped with six spaces\n"
+        "\n"
+        " -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200\n"
+        "\n" + OLD_STANZA
+    ) == changelog.read_text()
+    assert 0o640 == changelog.stat().st_mode & 0o777
+    assert ["changelog"] == [path.name for path in changelog.parent.iterdir()]
+
+
+RELEASED = """\
+cloud-init (22.1-0ubuntu1) jammy; urgency=medium
+
+  * Release
+
+ -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200
+"""
+
+UNRELEASED = (
+    """\
+cloud-init (22.2~1g12345678-0ubuntu1) UNRELEASED; urgency=medium
+
+  * d/control: keep this
+  * New upstream snapshot.
+    + feat: one [Author Name]
+    + fix: two (LP: #1)
+
+ -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200
+
+"""
+    + RELEASED
+)
+
+
+@pytest.fixture()
+def changelog_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DEBFULLNAME", "A Packager")
+    monkeypatch.setenv("DEBEMAIL", "a.packager@example.com")
+    (tmp_path / "debian").mkdir()
+    return tmp_path
+
+
+def without_dates(changelog: str):
+    return re.sub(r"(?m)^( -- A Packager .*>  ).*$", r"\1DATE", changelog)
+
+
+def test_add_to_top_stanza(changelog_dir):
+    long_item = "word " * 20
+    items = format_dch_item("first") + format_dch_item(long_item)
+    assert [
+        "  * first",
+        "  * word word word word word word word word word word word word "
+        "word word word",
+        "    word word word word word",
+    ] == items
+    added = add_to_top_stanza(RELEASED.splitlines(), "22.2-0ubuntu1", items)
+    assert (
+        "cloud-init (22.2-0ubuntu1) UNRELEASED; urgency=medium\n\n"
+        + "\n".join(items)
+        + "\n\n -- A Packager <a.packager@example.com>  DATE\n\n"
+        + RELEASED
+    ) == without_dates("\n".join(added) + "\n")
+
+    appended = add_to_top_stanza(added, "22.3-0ubuntu1", ["  * more"])
+    assert (
+        "cloud-init (22.3-0ubuntu1) UNRELEASED; urgency=medium\n\n"
+        + "\n".join(items)
+        + "\n  * more\n\n -- A Packager <a.packager@example.com>  DATE\n\n"
+        + RELEASED
+    ) == without_dates("\n".join(appended) + "\n")
+    assert added == add_to_top_stanza(added, "22.3-0ubuntu1", [])
+
+
+def test_get_maintainer(monkeypatch):
+    for name in ("DEBFULLNAME", "NAME", "DEBEMAIL", "EMAIL"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "Git Author")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "git@example.com")
+    assert "Git Author <git@example.com>" == get_maintainer()
+    monkeypatch.setenv("EMAIL", "email@example.com")
+    assert "Git Author <email@example.com>" == get_maintainer()
+    monkeypatch.setenv("NAME", "Name")
+    monkeypatch.setenv("DEBEMAIL", "Deb Name <deb@example.com>")
+    assert "Name <deb@example.com>" == get_maintainer()
+
+
+def test_format_dch_item_keeps_urls_whole():
+    url = (
+        "https://github.com/canonical/cloud-init/blob/main/ChangeLog"
+        "#L1-L100000"
+    )
+    assert [
+        "  * List of changes from upstream can be found at",
+        f"    {url}",
+    ] == format_dch_item(
+        f"List of changes from upstream can be found at {url}"
+    )
+
+
+def test_add_changelog_writes_once(changelog_dir):
+    changelog = Path("debian/changelog")
+    changelog.write_text(UNRELEASED)
+    with mock.patch(
+        "scripts.add_changelog.atomic_write", wraps=atomic_write
+    ) as writes, mock.patch("scripts.add_changelog.check_output") as spawn:
+        add_changelog("d/control: and this", "22.2~1g23456789-0ubuntu1")
+    spawn.assert_not_called()
+    assert 1 == writes.call_count
+    assert (
+        "cloud-init (22.2~1g23456789-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * d/control: keep this\n"
+        "  * d/control: and this\n"
+        "    + feat: one [Author Name]\n"
+        "    + fix: two (LP: #1)\n"
+        "\n"
+        " -- A Packager <a.packager@example.com>  DATE\n\n" + RELEASED
+    ) == without_dates(changelog.read_text())
+
+
+def test_add_changelog_keeps_older_stanzas(changelog_dir):
+    older = (
+        "cloud-init (22.1~1gabcdef12-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * New upstream snapshot.\n"
+        "  * +  not reformatted\n"
+        "     nor reindented\n"
+        "\n"
+        " -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200\n"
+    )
+    tail = "\n" + (older + "\n") * 1000 + RELEASED
+    changelog = Path("debian/changelog")
+    changelog.write_text(UNRELEASED.replace("\n" + RELEASED, tail))
+    top, rest = read_top_stanza()
+    assert UNRELEASED.index(RELEASED) - 1 == rest
+    assert UNRELEASED[:rest].splitlines() == top
+
+    add_changelog("d/control: and this", "22.2~1g23456789-0ubuntu1")
+    assert changelog.read_text().endswith(tail)
+    assert 1 == changelog.read_text().count("feat: one")
+
+
+def test_add_changelog_keeps_older_line_endings(changelog_dir):
+    tail = RELEASED.replace("\n", "\r\n")
+    changelog = Path("debian/changelog")
+    changelog.write_bytes(UNRELEASED.replace(RELEASED, tail).encode())
+    add_changelog("d/control: and this", "22.2~1g23456789-0ubuntu1")
+    content = changelog.read_bytes()
+    assert content.endswith(b"\n\n" + tail.encode())
+    assert 1 == content.count(b"feat: one")
+
+
+def test_format_commits_cache(changelog_dir):
+    check_output(["git", "init", "-q"])
+    batches = []
+
+    def format_batch(batch, last_commit):
+        batches.append((batch, last_commit))
+        return [
+            None
+            if commit == "noise"
+            else [f"+{commit}{' (last)' if last_commit else ''}"]
+            if commit == batch[-1]
+            else [f"+{commit}"]
+            for commit in batch
+        ]
+
+    assert [["+a"], ["+b (last)"]] == format_commits(
+        ["a", "noise", "b"], format_batch, "v1"
+    )
+    assert [(["a", "noise", "b"], True)] == batches
+
+    # Only new commits, and the previous newest one, are formatted
+    batches.clear()
+    assert [["+a"], ["+b"], ["+c (last)"]] == format_commits(
+        ["a", "noise", "b", "c"], format_batch, "v1"
+    )
+    assert [(["b", "c"], True)] == batches
+
+    # A batch without the newest commit
+    batches.clear()
+    assert [["+a"], ["+b"], ["+d"], ["+c (last)"]] == format_commits(
+        ["a", "b", "d", "c"], format_batch, "v1"
+    )
+    assert [(["d"], False)] == batches
+
+    # Everything is formatted again by a new formatter
+    batches.clear()
+    assert [["+a"], ["+c (last)"]] == format_commits(
+        ["a", "c"], format_batch, "v2"
+    )
+    assert [(["a", "c"], True)] == batches
+
+
+def test_format_commits_cache_in_worktree(changelog_dir):
+    check_output(["git", "init", "-q", "main"])
+    check_output(
+        ["git", "-C", "main", "commit", "-q", "--allow-empty", "-m", "a"]
+    )
+    check_output(["git", "-C", "main", "worktree", "add", "-q", "../tree"])
+    os.chdir("tree")
+    assert Path(".git").is_file()
+
+    def format_batch(batch, last_commit):
+        return [[f"+{commit}"] for commit in batch]
+
+    format_commits(["a"], format_batch, "v1")
+    git_dir = check_output(
+        ["git", "rev-parse", "--git-dir"], universal_newlines=True
+    ).strip()
+    assert (Path(git_dir) / "add_changelog_entries.json").exists()
+    assert [["+a"]] == format_commits(["a"], mock.Mock(), "v1")
+    # The main worktree has a cache of its own
+    os.chdir("../main")
+    assert [["+a"]] == format_commits(["a"], format_batch, "v1")
+    assert Path(".git/add_changelog_entries.json").exists()
+
+
+def test_format_commits_outside_git(changelog_dir):
+    format_batch = mock.Mock(return_value=[["+a"]])
+    format_commits(["a"], format_batch, "v1")
+    assert [["+a"]] == format_commits(["a"], format_batch, "v1")
+    assert 2 == format_batch.call_count
+
+
+def test_hash_formatter(changelog_dir):
+    customization = Path("debian/gbp_format_changelog")
+    paths = [str(customization), "missing"]
+    digest = hash_formatter(paths, "gbp 1")
+    assert digest != hash_formatter(paths, "gbp 2")
+    customization.write_text("# customized\n")
+    customized = hash_formatter(paths, "gbp 1")
+    assert digest != customized
+    customization.write_text("# customized again\n")
+    assert customized != hash_formatter(paths, "gbp 1")
+
+
+@pytest.mark.skipif(not shutil.which("dch"), reason="dch not installed")
+def test_add_changelog_matches_dch(changelog_dir):
+    """The batched writer matches the dch commands it replaced."""
+    version = "22.2~1g23456789-0ubuntu1"
+    msg = (
+        "d/control: and this\n"
+        + "a rather long line " * 6
+        + "\nList of changes from upstream can be found at "
+        + "https://github.com/canonical/cloud-init/blob/main/ChangeLog"
+        + "#L1-L100000"
+    )
+    snapshot_messages = ["+feat: one [Author Name]", "+fix: two (LP: #1)"]
+    changelog = Path("debian/changelog")
+    changelog.write_text(
+        UNRELEASED.replace(
+            "  * New upstream snapshot.\n"
+            "    + feat: one [Author Name]\n"
+            "    + fix: two (LP: #1)\n",
+            "",
+        )
+    )
+    for line in msg.splitlines():
+        check_output(["dch", "--nomultimaint", "-b", "-v", version, line])
+    for message in snapshot_messages:
+        check_output(["dch", "-v", version, message])
+    # The formatting fixes add_changelog made with sed
+    for script in (
+        "s/ \\* +/   + /",
+        "s/\\*       /    /",
+        "/^     [^ ]/{s/^/ /}",
+    ):
+        check_output(["sed", "-i", script, str(changelog)])
+    expected = changelog.read_text()
+
+    changelog.write_text(UNRELEASED)
+    add_changelog(msg, version)
+    assert without_dates(expected) == without_dates(changelog.read_text())
+
+
+@pytest.fixture()
+def fake_gbp():
+    """Stand in for the parts of gbp that add_changelog uses in process.
+
+    The repository has commits c1 to c3, which git log lists newest first.
+    """
+    commits = ["c3", "c2", "c1"]
+    calls = []
+
+    def module(name, **attributes):
+        fake = ModuleType(name)
+        fake.__dict__.update(attributes)
+        return fake
+
+    def parse_args(argv):
+        calls.append(argv)
+        options = SimpleNamespace(
+            since=None,
+            debian_tag="ubuntu/%(version)s",
+            git_log="--no-merges",
+            customization_file=None,
+            new_version=None,
+            multimaint=False,
+        )
+        return options, [], None, None
+
+    class DebianGitRepository:
+        def __init__(self, path):
+            pass
+
+        def get_commits(self, since, until, options):
+            return list(commits)
+
+        def get_commit_info(self, commit):
+            return {"id": commit, "subject": f"change {commit[1:]}"}
+
+    def format_changelog_entry(commit_info, options, last_commit=False):
+        last = " (last)" if last_commit else ""
+        return [f"{commit_info['subject']}{last}"]
+
+    dch = module("gbp.dch", format_changelog_entry=format_changelog_entry)
+    scripts_dch = module(
+        "gbp.scripts.dch",
+        parse_args=parse_args,
+        guess_documented_commit=lambda changelog, repo, tag: "c0",
+    )
+    modules = {
+        "gbp": module("gbp", dch=dch, __version__="0.9"),
+        "gbp.dch": dch,
+        "gbp.deb": module("gbp.deb"),
+        "gbp.deb.changelog": module(
+            "gbp.deb.changelog", ChangeLog=lambda contents: contents
+        ),
+        "gbp.deb.git": module(
+            "gbp.deb.git", DebianGitRepository=DebianGitRepository
+        ),
+        "gbp.scripts": module("gbp.scripts", dch=scripts_dch),
+        "gbp.scripts.dch": scripts_dch,
+    }
+    with mock.patch.dict(sys.modules, modules):
+        yield calls
+
+
+def test_get_gbp_entries_oldest_first(changelog_dir, fake_gbp):
+    assert [
+        ["change 1"],
+        ["change 2"],
+        ["change 3 (last)"],
+    ] == get_gbp_entries(["--ignore-branch"], RELEASED.splitlines(), {})
+    assert [["dch", "--ignore-branch"]] == fake_gbp
+
+
+def test_get_gbp_entries_batch_customization(changelog_dir, fake_gbp):
+    """Customizations with format_changelog_entries get one call."""
+    Path("debian/gbp_format_changelog").write_text(
+        "def format_changelog_entry(commit_info, options, last_commit):\n"
+        "    raise AssertionError('called per commit')\n"
+        "\n"
+        "def format_changelog_entries(commits, options, last_commit=True):\n"
+        "    return [\n"
+        "        [f\"+{c['subject']} of {len(commits)} {last_commit}\"]\n"
+        "        for c in commits\n"
+        "    ]\n"
+    )
+    with mock.patch(
+        "gbp.scripts.dch.parse_args",
+        return_value=(
+            SimpleNamespace(
+                since="c0",
+                git_log="--no-merges",
+                customization_file="debian/gbp_format_changelog",
+                multimaint=False,
+            ),
+            [],
+            None,
+            None,
+        ),
+    ):
+        assert [
+            ["+change 1 of 3 True"],
+            ["+change 2 of 3 True"],
+            ["+change 3 of 3 True"],
+        ] == get_gbp_entries([], RELEASED.splitlines(), {})
+
+
+def test_add_changelog_in_process_gbp(changelog_dir, fake_gbp):
+    changelog = Path("debian/changelog")
+    changelog.write_text(RELEASED)
+    with mock.patch(
+        "scripts.add_changelog.get_entry_cache", return_value=None
+    ), mock.patch("scripts.add_changelog.check_output") as spawn:
+        add_changelog("New upstream snapshot.", "22.2-0ubuntu1")
+    spawn.assert_not_called()
+    assert (
+        "cloud-init (22.2-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * New upstream snapshot.\n"
+        "  * change 1\n"
+        "  * change 2\n"
+        "  * change 3 (last)\n"
+        "\n"
+        " -- A Packager <a.packager@example.com>  DATE\n\n" + RELEASED
+    ) == without_dates(changelog.read_text())
+
+
+def test_get_gbp_entries_leaves_multimaint_to_gbp(changelog_dir, fake_gbp):
+    with mock.patch(
+        "gbp.scripts.dch.parse_args",
+        return_value=(SimpleNamespace(multimaint=True), [], None, None),
+    ):
+        assert None is get_gbp_entries([], RELEASED.splitlines(), {})
+
+
+def test_add_changelog_leaves_maintainer_markers_to_dch(changelog_dir):
+    """Snapshot entries re-added to someone else's stanza are marked."""
+    changelog = Path("debian/changelog")
+    changelog.write_text(UNRELEASED)
+    with mock.patch("scripts.add_changelog.check_output") as dch:
+        add_changelog("", "22.2~1g23456789-0ubuntu1")
+    assert [
+        mock.call(["dch", "-v", "22.2~1g23456789-0ubuntu1", message])
+        for message in ("+feat: one [Author Name]", "+fix: two (LP: #1)")
+    ] == dch.call_args_list
@@ -0,0 +1,90 @@
+"""Tests for gbp_format_changelog
+
+Requires pytest and git-buildpackage
+"""
+import importlib.machinery
+import importlib.util
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("gbp.dch")
+
+FORMATTER = Path(__file__).parent.parent / "scripts" / "gbp_format_changelog"
+
+
+@pytest.fixture(scope="module")
+def formatter():
+    loader = importlib.machinery.SourceFileLoader(
+        "gbp_format_changelog", str(FORMATTER)
+    )
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(loader.name, loader)
+    )
+    loader.exec_module(module)
+    return module
+
+
+def test_wrap_on_delimiter(formatter):
+    text = "fix: " + "word " * 12 + "(LP: #1234567) [Jane Contributor]"
+    assert [
+        "+fix: word word word word word word word word word word word word",
+        "  (LP: #1234567) [Jane Contributor]",
+    ] == formatter._wrap_on_delimiter(text, prefix="+")
+    assert ["+short (LP: #1)"] == formatter._wrap_on_delimiter(
+        "short (LP: #1)", prefix="+"
+    )
+    # A closing delimiter without its opening one is wrapped at whitespace
+    unbalanced = "fix: " + "word " * 16 + "smile :)"
+    assert formatter.textwrap.wrap("+" + unbalanced) == (
+        formatter._wrap_on_delimiter(unbalanced, prefix="+")
+    )
+    # As is a delimited part too long for a line of its own
+    bugs = "(LP: " + ", ".join(f"#{bug}" for bug in range(1, 20)) + ")"
+    assert formatter.textwrap.wrap("+" + bugs) == (
+        formatter._wrap_on_delimiter(bugs, prefix="+")
+    )
+    assert ["+fix:", *formatter.textwrap.wrap(" " + bugs)] == (
+        formatter._wrap_on_delimiter(f"fix: {bugs}", prefix="+")
+    )
+
+
+def test_format_entry(formatter):
+    assert ["+fix: thing [Jane Contributor]"] == formatter._format_entry(
+        ["fix: thing (SC-123)"], "Jane Contributor"
+    )
+    assert ["+feat: thing"] == formatter._format_entry(
+        ["feat: thing"], "Chad Smith"
+    )
+    assert None is formatter._format_entry(
+        ["refresh patches against main"], "Chad Smith"
+    )
+
+
+def test_format_changelog_entries(formatter):
+    author = mock.Mock()
+    author.name = "Chad Smith"
+    commits = [
+        {"id": "1", "subject": "feat: one", "author": author},
+        {"id": "2", "subject": "update changelog", "author": author},
+        {"id": "3", "subject": "fix: two", "author": author},
+    ]
+
+    def format_entry(commit_info, options, last_commit):
+        return [commit_info["subject"] + (" (last)" if last_commit else "")]
+
+    with mock.patch.object(
+        formatter.gbp.dch, "format_changelog_entry", format_entry
+    ):
+        entries = formatter.format_changelog_entries(commits, None)
+        assert entries == [
+            formatter.format_changelog_entry(commit, None, i == 2)
+            for i, commit in enumerate(commits)
+        ]
+        assert [["+feat: one"], None, ["+fix: two"]] == (
+            formatter.format_changelog_entries(
+                commits, None, last_commit=False
+            )
+        )
+    assert [["+feat: one"], None, ["+fix: two (last)"]] == entries
@@ -0,0 +1,245 @@
+"""Tests for tboard.py against a local fake Trello server
+
+Requires pytest and py-trello
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("trello")
+requests = pytest.importorskip("requests")
+
+CARDS = 12
+DELAY = 0.05  # seconds each card detail request takes
+
+
+def card_json(number, list_id, label):
+    card_id = f"c{number}"
+    return {
+        "id": card_id,
+        "name": f"Card {number}",
+        "desc": f"Description {number}",
+        "dueComplete": False,
+        "closed": False,
+        "url": f"https://trello.com/c/{card_id}",
+        "shortUrl": f"https://trello.com/c/{card_id}",
+        "pos": number,
+        "idMembers": [],
+        "idLabels": [label],
+        "idBoard": "b1",
+        "idList": list_id,
+        "idShort": number,
+        "badges": {"attachments": 0, "comments": 0, "checkItems": 0},
+        "idChecklists": [],
+        "labels": [{"id": label, "name": label, "color": "green"}],
+        "dateLastActivity": "2022-01-01T00:00:00.000Z",
+    }
+
+
+class FakeTrello(BaseHTTPRequestHandler):
+    """Serve a board of CARDS cards, every other one labelled cloud-init."""
+
+    lock = threading.Lock()
+    requests = []
+    queries = []
+    in_flight = 0
+    most_in_flight = 0
+
+    def routes(self, path):
+        if path == "/1/members/me/boards/":
+            return [
+                {"id": "b1", "name": "Board", "closed": False, "url": "b1"}
+            ]
+        if path == "/1/boards/b1/lists":
+            return [
+                {"id": "l1", "name": "Done", "closed": False, "pos": 1},
+                {"id": "l2", "name": "Doing", "closed": False, "pos": 2},
+            ]
+        if path.startswith("/1/lists/"):
+            list_id = path.split("/")[3]
+            first = 0 if list_id == "l1" else CARDS // 2
+            return [
+                card_json(n, list_id, "cloud-init" if n % 2 else "curtin")
+                for n in range(first, first + CARDS // 2)
+            ]
+        if path == "/1/boards/b1/cards/open":
+            query = parse_qs(urlparse(self.path).query)
+            limit = int(query.get("actions_limit", ["50"])[0])
+            cards = self.routes("/1/lists/l1/cards")
+            cards += self.routes("/1/lists/l2/cards")
+            for card in cards:
+                card["attachments"] = self.routes(
+                    f"/1/cards/{card['id']}/attachments"
+                )
+                # Newest first, unlike Card.fetch_comments()
+                card["actions"] = self.routes(f"/1/cards/{card['id']}/actions")
+                card["actions"].reverse()
+                del card["actions"][limit:]
+            return cards[::-1]
+        _, _, _, card_id, detail = path.split("/")
+        number = int(card_id[1:])
+        if detail == "attachments":
+            bug = f"https://bugs.launchpad.net/cloud-init/+bug/{number}"
+            return [{"url": bug}] if number % 3 else []
+        comments = [
+            {"date": "2022-01-01", "data": {"text": f"DOC: Doc {number}"}},
+            {"date": "2022-01-02", "data": {"text": "not the doc"}},
+        ]
+        if number == 1:  # More than Trello nests in a card by default
+            comments += [
+                {"date": f"2022-01-03T{i:02}", "data": {"text": "more"}}
+                for i in range(60)
+            ]
+        return comments
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        with self.lock:
+            self.requests.append(path)
+            self.queries.append(parse_qs(urlparse(self.path).query))
+            FakeTrello.in_flight += 1
+            FakeTrello.most_in_flight = max(
+                self.most_in_flight, self.in_flight
+            )
+        try:
+            if path.startswith("/1/cards/"):
+                time.sleep(DELAY)
+            body = json.dumps(self.routes(path)).encode()
+        finally:
+            with self.lock:
+                FakeTrello.in_flight -= 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def trello_client():
+    """Return a TrelloClient talking to a local FakeTrello server."""
+    from trello import TrelloClient
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTrello)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    class LocalHTTP:
+        @staticmethod
+        def request(method, url, **kwargs):
+            url = url.replace("https://api.trello.com", base)
+            return requests.request(method, url, **kwargs)
+
+    FakeTrello.requests = []
+    FakeTrello.queries = []
+    FakeTrello.most_in_flight = 0
+    yield TrelloClient(
+        api_key="key", api_secret="secret", http_service=LocalHTTP
+    )
+    server.shutdown()
+    server.server_close()
+
+
+def run_main(client, capsys, *args):
+    from scripts import tboard
+
+    with mock.patch.object(
+        tboard, "get_trello_client", return_value=client
+    ), mock.patch("sys.argv", ["tboard.py", *args]):
+        tboard.main()
+    return capsys.readouterr().out
+
+
+def test_main_prefetches_concurrently(trello_client, capsys):
+    start = time.monotonic()
+    out = run_main(trello_client, capsys, "--label-name", "cloud-init")
+    elapsed = time.monotonic() - start
+    # Every other card, in board order
+    names = [line for line in out.splitlines() if line.startswith("Name:")]
+    assert [f"Name: Card {n}" for n in range(1, CARDS, 2)] == names
+    assert (
+        "Name: Card 1\n"
+        "Labels: [<Label cloud-init>]\n"
+        "Doc:\n"
+        "- [LP: #1](https://bugs.launchpad.net/cloud-init/+bug/1):  Doc 1\n"
+        "Description:\n"
+        "Description 1\n"
+        "\n"
+        "URL: https://trello.com/c/c1\n"
+    ) in out
+    details = [p for p in FakeTrello.requests if p.startswith("/1/cards/")]
+    assert CARDS == len(details)  # Filtered out cards aren't fetched
+    assert FakeTrello.most_in_flight > 1
+    assert elapsed < len(details) * DELAY
+
+
+def test_main_jobs_one_matches(trello_client, capsys):
+    concurrent = run_main(trello_client, capsys, "--doc")
+    FakeTrello.most_in_flight = 0
+    sequential = run_main(trello_client, capsys, "--doc", "--jobs", "1")
+    assert 1 == FakeTrello.most_in_flight
+    assert concurrent == sequential
+    assert (
+        "- [LP: #2](https://bugs.launchpad.net/cloud-init/+bug/2):  Doc 2\n"
+        "-  Doc 3\n"
+    ) in sequential
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        [],
+        ["--doc", "--label-name", "cloud-init"],
+        ["--list-name", "Doing"],
+    ),
+)
+def test_main_bulk_matches(trello_client, capsys, args):
+    expected = run_main(trello_client, capsys, *args)
+    FakeTrello.requests = []
+    FakeTrello.queries = []
+    assert expected == run_main(trello_client, capsys, "--bulk", *args)
+    # One request for the boards, and two for the board
+    assert [
+        "/1/members/me/boards/",
+        "/1/boards/b1/lists",
+        "/1/boards/b1/cards/open",
+    ] == FakeTrello.requests
+    cards_query = FakeTrello.queries[-1]
+    assert ["true"] == cards_query["attachments"]
+    assert ["commentCard,copyCommentCard"] == cards_query["actions"]
+    assert ["1000"] == cards_query["actions_limit"]
+
+
+def test_main_bulk_unknown_list(trello_client, capsys):
+    assert "" == run_main(
+        trello_client, capsys, "--bulk", "--list-name", "Missing"
+    )
+    assert [
+        "/1/members/me/boards/",
+        "/1/boards/b1/lists",
+    ] == FakeTrello.requests
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1", "many"])
+def test_main_rejects_jobs_below_one(trello_client, capsys, jobs):
+    with pytest.raises(SystemExit):
+        run_main(trello_client, capsys, "--bulk", "--jobs", jobs)
+    assert "--jobs" in capsys.readouterr().err
+    assert [] == FakeTrello.requests
+
+
+def test_main_bulk_no_executor(trello_client, capsys):
+    from scripts import tboard
+
+    with mock.patch.object(tboard, "ThreadPoolExecutor") as executor:
+        run_main(trello_client, capsys, "--bulk")
+    executor.assert_not_called()
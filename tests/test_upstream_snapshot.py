@@ -2,21 +2,56 @@
 
 Requires pytest
 """
+import json
 import os
-from functools import partial
+import random
+import shutil
+import subprocess
+import time
+from datetime import date
 from pathlib import Path
-from subprocess import CalledProcessError, CompletedProcess
+from subprocess import CalledProcessError
 from unittest import mock
 
 import pytest
 
 from scripts.new_upstream_snapshot import (
+    CASSETTE,
+    GIT,
+    QUILT_COMMAND,
     ChangelogDetails,
+    ChangelogIndex,
     CliError,
+    DistroInfo,
+    GitSession,
+    Profiler,
+    SnapshotContext,
+    SnapshotJournal,
     VersionInfo,
+    add_msg_to_changelog,
+    apply_hunks,
     capture,
+    check_patches_apply,
+    compare_versions,
+    drop_cpicks,
+    find_applicable_commitish,
+    format_batch_report,
+    get_affected_patches,
+    get_ancestor_hashes,
+    get_bugs_fixed_devel,
+    get_first_containing,
+    get_maintainer,
+    get_original_head,
+    get_series,
+    get_series_entries,
+    get_upstream_file_changes,
+    merge_commitish,
     new_upstream_snapshot,
+    parse_patch,
+    plan_upstream_snapshot,
     sh,
+    snapshot_branches,
+    stream,
 )
 
 PACKAGED_VERSION = "1.4"
@@ -24,43 +59,55 @@ PACKAGED_NEXT = "2.1"
 UPSTREAM_MAIN_VERSION = "2.3"
 
 
-def new_capture(devel_series, stable_number, *args, **kwargs):
-    if args[0] == "distro-info --devel":
-        return CompletedProcess(args[0], 0, stdout=devel_series)
-    elif args[0] == "distro-info --stable -r":
-        return CompletedProcess(args[0], 0, stdout=stable_number)
-    elif (
-        args[0].startswith("git diff --name-only")
-        and "debian/patches/" not in args[0]
-    ):
-        return CompletedProcess(args[0], 0, stdout="")
-    return capture(*args, **kwargs)
+DISTRO_INFO_CSV = """\
+version,codename,series,created,release,eol,eol-server
+10.04 LTS,Aseries,aseries,2009-10-29,2010-04-29,2013-05-09,2015-04-30
+10.10,Bseries,bseries,2010-04-29,2010-10-10,2012-04-10
+11.04,Cseries,cseries,2010-10-10,2011-04-28,2012-10-28
+"""
+
+
+@pytest.fixture(autouse=True)
+def distro_info(tmp_path_factory):
+    """During the test, bseries is in development and aseries is stable."""
+    path = tmp_path_factory.mktemp("distro-info") / "ubuntu.csv"
+    path.write_text(DISTRO_INFO_CSV)
+    with mock.patch(
+        "scripts.new_upstream_snapshot.DISTRO_INFO",
+        DistroInfo(path, today=date(2010, 6, 1)),
+    ) as distro_info:
+        yield distro_info
 
 
 @pytest.fixture(autouse=True)
-def mock_distro_info():
-    side_effect = partial(new_capture, "bseries", "10.04")
+def mock_upstream_file_check():
+    """The test packaging branches track .pc/, which upstream doesn't."""
     with mock.patch(
-        "scripts.new_upstream_snapshot.capture", side_effect=side_effect
+        "scripts.new_upstream_snapshot.get_upstream_file_changes",
+        return_value=[],
     ):
         yield
 
 
 @pytest.fixture()
-def mock_new_sru():
-    side_effect = partial(new_capture, "cseries", "10.10")
+def real_upstream_file_check(mock_upstream_file_check):
+    """Check upstream files for real, on branches that don't track .pc/."""
     with mock.patch(
-        "scripts.new_upstream_snapshot.capture", side_effect=side_effect
+        "scripts.new_upstream_snapshot.get_upstream_file_changes",
+        get_upstream_file_changes,
     ):
         yield
 
 
 @pytest.fixture()
-def main_setup(tmp_path):
-    commits = []
+def mock_new_sru(distro_info):
+    """Move on to cseries being in development, and bseries stable."""
+    distro_info.today = date(2010, 11, 1)
 
-    previous_dir = os.getcwd()
-    os.chdir(tmp_path)
+
+def create_main_branch():
+    """Create a repo with a main branch in the cwd, returning its commits."""
+    commits = []
     try:
         capture("git init -b main")
     except CalledProcessError as e:
@@ -82,8 +129,14 @@ def main_setup(tmp_path):
         f"git tag -a {UPSTREAM_MAIN_VERSION} {commits[3]} -m "
         "'release {UPSTREAM_MAIN_VERSION}'"
     )
+    return commits
 
-    yield commits
+
+@pytest.fixture()
+def main_setup(tmp_path):
+    previous_dir = os.getcwd()
+    os.chdir(tmp_path)
+    yield create_main_branch()
     os.chdir(previous_dir)
 
 
@@ -407,7 +460,7 @@ def test_refresh_patches(devel_setup):
     )
 
 
-def test_refresh_fail(devel_setup):
+def test_refresh_fail(devel_setup, capsys):
     sh("git checkout ubuntu/devel")
 
     sh(
@@ -422,6 +475,1208 @@ def test_refresh_fail(devel_setup):
     )
     with pytest.raises(CliError, match="Failed applying patch 'new-patch'"):
         new_upstream_snapshot(UPSTREAM_MAIN_VERSION, no_sru_bug=True)
+    assert "may no longer apply:\n  new-patch: " in capsys.readouterr().out
+
+
+def test_refresh_patches_incremental(devel_setup):
+    sh("git checkout ubuntu/devel")
+    sh(
+        "quilt new new-patch && "
+        "quilt add file.txt && "
+        "echo 'patch-stuff' >> file.txt && "
+        "quilt refresh && "
+        "quilt new unaffected-patch && "
+        "quilt add unaffected.txt && "
+        "echo 'unaffected' > unaffected.txt && "
+        "quilt refresh && "
+        "quilt pop -a && "
+        "git add debian/patches && "
+        "git commit -m 'add quilt patches'"
+    )
+    with mock.patch("scripts.new_upstream_snapshot.sh", wraps=sh) as mock_sh:
+        new_upstream_snapshot(UPSTREAM_MAIN_VERSION, no_sru_bug=True)
+    commands = [c.args[0] for c in mock_sh.call_args_list]
+    assert f"{QUILT_COMMAND} push new-patch" in commands
+    assert not any("unaffected-patch" in command for command in commands)
+    assert (
+        f"refresh patches against {UPSTREAM_MAIN_VERSION}"
+        in capture("git log HEAD~ -1 --oneline").stdout
+    )
+
+
+def test_get_affected_patches(git_only_devel_setup):
+    cpick = get_series()[0]
+    assert [] == get_affected_patches(set())
+    assert [cpick] == get_affected_patches({"file.txt", "debian/changelog"})
+    assert [cpick, "other.patch"] == get_affected_patches(
+        {"other.txt", "file.txt"}, "HEAD"
+    )
+    Path("debian/patches/series").write_text("other.patch\n")
+    assert ["other.patch"] == get_affected_patches({"other.txt", "file.txt"})
+    Path("debian/patches/series").write_text("other.patch -p0\n")
+    assert [] == get_affected_patches({"other.txt"})
+    assert ["other.patch"] == get_affected_patches({"b/other.txt"})
+
+
+def test_drop_cpicks(main_setup):
+    commits = main_setup
+    Path("debian/patches").mkdir(parents=True)
+    cpicks = [
+        f"cpick-{commits[1][:8]}-included",
+        f"cpick-{commits[4][:8]}-not-included",
+        "cpick-deadbeef-unknown",
+        f"cpick-{commits[2]}-full-hash",
+    ]
+    for cpick in cpicks:
+        Path("debian/patches", cpick).write_text(cpick)
+    Path("debian/patches/series").write_text(
+        "\n".join(cpicks + ["other.patch"]) + "\n"
+    )
+    sh("git add debian && git commit -m 'add cpicks'")
+
+    drop_cpicks(commits[3])
+
+    assert [cpicks[1], cpicks[2], "other.patch"] == (
+        Path("debian/patches/series").read_text().splitlines()
+    )
+    assert sorted([cpicks[1], cpicks[2], "series"]) == sorted(
+        p.name for p in Path("debian/patches").iterdir()
+    )
+    assert f"drop cherry picks included in {commits[3]}" in (
+        capture("git log -1 --oneline").stdout
+    )
+    assert not capture("git status --porcelain").stdout
+
+
+def test_get_first_containing(main_setup):
+    commits = main_setup
+    sh(f"git checkout -q -b side {commits[1]}")
+    sh("echo side > side.txt && git add side.txt && git commit -q -m side")
+    side = capture("git rev-parse HEAD").stdout.strip()
+    sh("git checkout -q main && git merge -q --no-edit side")
+    merge = capture("git rev-parse HEAD").stdout.strip()
+    git_hashes = [commits[3][:8], side[:8], commits[1], "deadbeef"]
+
+    with mock.patch(
+        "scripts.new_upstream_snapshot.capture", wraps=capture
+    ) as mock_capture:
+        first = get_first_containing(
+            git_hashes, [commits[2], commits[3], commits[4], merge], commits[2]
+        )
+    assert {commits[3][:8]: 1, side[:8]: 3, commits[1]: 0} == first
+    commands = [c.args[0] for c in mock_capture.call_args_list]
+    # Only the commits since commits[2] are walked, and hashes that
+    # aren't among them are checked on their own
+    assert f"git rev-list --parents {merge} ^{commits[2]}" == commands[0]
+    assert 3 == len(commands)
+    assert {side[:8]} == get_ancestor_hashes([side[:8], "deadbeef"], merge)
+
+
+def test_git_session(main_setup):
+    commits = main_setup
+    sh(f"git checkout -q -b side {commits[2]}")
+    Path("side.txt").write_text("side")
+    sh("git add side.txt && git commit -q -m side")
+    sh("git merge -q --no-edit main && git commit -q --allow-empty -m after")
+
+    session = GitSession()
+    with mock.patch(
+        "scripts.new_upstream_snapshot.subprocess.Popen",
+        wraps=subprocess.Popen,
+    ) as popen:
+        assert commits[4] == session.resolve("main")
+        assert commits[3] == session.resolve(UPSTREAM_MAIN_VERSION)
+        assert 1 == session.parent_count("HEAD")
+        assert 2 == session.parent_count("HEAD~1")
+        assert [commits[4]] == session.get_object("HEAD~1").parents[1:]
+        assert 0 == session.parent_count(commits[0])
+        with pytest.raises(CliError, match="Unknown git revision"):
+            session.resolve("does-not-exist")
+    # One --batch-check and one --batch process answer every query
+    assert 2 == popen.call_count
+    session.close()
+
+    assert "HEAD~2" == get_original_head()
+    sh("git checkout -q main")
+    GIT.invalidate()
+    with pytest.raises(CliError, match="No recent merge"):
+        get_original_head()
+
+
+@pytest.fixture()
+def git_only_devel_setup(main_setup):
+    """Like devel_setup, but built without quilt or uss-tableflip scripts."""
+    return create_git_only_packaging(main_setup)
+
+
+def create_git_only_packaging(
+    commits,
+    branch="ubuntu/devel",
+    version=f"{PACKAGED_VERSION}-0ubuntu1",
+    distro="bseries",
+):
+    """Create a released packaging branch off the first of main's commits.
+
+    Its series has a cherry pick of the second commit and another patch.
+    """
+    sh(f"git checkout -q {commits[0]} -b {branch}")
+    Path("debian/patches").mkdir(parents=True)
+    Path("debian/changelog").write_text(
+        f"cloud-init ({version}) {distro}; "
+        "urgency=medium\n\n"
+        "  * Initial release\n\n"
+        " -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200\n"
+    )
+    cpick = f"cpick-{commits[1][:8]}-line1"
+    Path("debian/patches", cpick).write_text(
+        "--- a/file.txt\n+++ b/file.txt\n@@ -1 +1,2 @@\n line0\n+line1\n"
+    )
+    Path("debian/patches/other.patch").write_text(
+        "--- a/other.txt\n+++ b/other.txt\n@@ -0,0 +1 @@\n+other\n"
+    )
+    Path("debian/patches/series").write_text(
+        f"{cpick}\nother.patch\n# comment\n"
+    )
+    sh("git add debian && git commit -q -m 'packaging'")
+    return commits
+
+
+def git_version():
+    version = capture("git --version").stdout.split()[2]
+    return tuple(int(part) for part in version.split(".")[:2])
+
+
+def test_plan_upstream_snapshot(
+    git_only_devel_setup, real_upstream_file_check
+):
+    commits = git_only_devel_setup
+    head = capture("git rev-parse HEAD").stdout
+    status = capture("git status --porcelain --ignored").stdout
+
+    plan = plan_upstream_snapshot("main")
+
+    assert head == capture("git rev-parse HEAD").stdout
+    assert status == capture("git status --porcelain --ignored").stdout
+    assert [] == plan.conflicts
+    assert [] == plan.upstream_files
+    assert [f"cpick-{commits[1][:8]}-line1"] == plan.dropped_cpicks
+    assert [] == plan.patches_to_refresh
+    assert [] == plan.failing_hunks
+    assert f"{PACKAGED_NEXT}~1g{commits[-1][:8]}-0ubuntu1" == str(plan.version)
+    assert (
+        "  * Upstream snapshot based on main at "
+        f"{commits[-1][:8]}.\n"
+        "    - Bugs fixed in this snapshot: "
+        "(LP: #123454, #123453, #123452, #123451)"
+    ) in plan.changelog_entry
+    assert "Upstream file check: ok" in str(plan)
+
+
+def test_plan_upstream_snapshot_reports_problems(
+    git_only_devel_setup, real_upstream_file_check
+):
+    commits = git_only_devel_setup
+    sh("git checkout -q main")
+    Path("other.txt").write_text("upstream\n")
+    sh("git add other.txt && git commit -q -m 'add other'")
+    sh("git checkout -q ubuntu/devel")
+    Path("file.txt").write_text("line0\nlocal change\n")
+    Path("local.txt").write_text("not upstream\n")
+    sh("git add . && git commit -q -m 'change upstream files on packaging'")
+
+    plan = plan_upstream_snapshot(commits[2], bug="123")
+
+    assert [f"cpick-{commits[1][:8]}-line1"] == plan.dropped_cpicks
+    assert [] == plan.patches_to_refresh
+    # file.txt is taken from commits[2] either way, but older gits can't
+    # merge with -X theirs so report it as a conflict
+    if git_version() >= (2, 44):
+        assert [] == plan.conflicts
+    else:
+        assert ["file.txt"] == plan.conflicts
+    assert ["local.txt"] == plan.upstream_files
+    assert "Upstream file check: would fail for:" in str(plan)
+
+    plan = plan_upstream_snapshot("main")
+    assert ["other.patch"] == plan.patches_to_refresh
+    with pytest.raises(CliError, match="not a valid commitish"):
+        plan_upstream_snapshot("does-not-exist")
+
+
+QUILT_PATCH = """\
+Description: two hunks
+Author: J Doe <j.doe@canonical.com>
+Index: pkg/file.txt
+===================================================================
+--- a/file.txt
++++ b/file.txt
+@@ -1,3 +1,3 @@
+ line0
+-line1
++LINE1
+ line2
+@@ -6,3 +6,4 @@
+ line5
+ line6
+ line7
++line7.5
+\\ No newline at end of file
+--- /dev/null
++++ b/new.txt
+@@ -0,0 +1 @@
++new
+"""
+
+
+def test_parse_patch():
+    file_patch, new_file = parse_patch(QUILT_PATCH)
+    assert "file.txt" == file_patch.path
+    assert not file_patch.creates
+    assert ["@@ -1,3 +1,3 @@", "@@ -6,3 +6,4 @@"] == [
+        hunk.header for hunk in file_patch.hunks
+    ]
+    assert ["line0", "line1", "line2"] == file_patch.hunks[0].old
+    assert ["line0", "LINE1", "line2"] == file_patch.hunks[0].new
+    assert (3, 0) == file_patch.hunks[1].context()
+    assert ("new.txt", True) == (new_file.path, new_file.creates)
+    assert [["new"]] == [hunk.new for hunk in new_file.hunks]
+
+
+def test_parse_patch_lines():
+    # Only newlines end lines, as in patch
+    (file_patch,) = parse_patch(
+        "--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n"
+        " page\x0cbreak\n-line\u2028separator\n+line\n"
+    )
+    assert ["page\x0cbreak", "line\u2028separator"] == file_patch.hunks[0].old
+    assert ["page\x0cbreak", "line"] == file_patch.hunks[0].new
+
+
+def test_parse_patch_strip():
+    assert ["b/file.txt", "b/new.txt"] == [
+        file_patch.path for file_patch in parse_patch(QUILT_PATCH, strip=0)
+    ]
+    nested = QUILT_PATCH.replace(" a/", " a/x/").replace(" b/", " b/x/")
+    assert ["file.txt", "new.txt"] == [
+        file_patch.path for file_patch in parse_patch(nested, strip=2)
+    ]
+
+
+def test_get_series_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Path("debian/patches").mkdir(parents=True)
+    Path("debian/patches/series").write_text(
+        "# comment\none.patch\ntwo.patch -p0\nthree.patch -p2 # why\n"
+    )
+    assert [("one.patch", 1), ("two.patch", 0), ("three.patch", 2)] == (
+        get_series_entries()
+    )
+    assert ["one.patch", "two.patch", "three.patch"] == get_series()
+
+
+@pytest.mark.parametrize(
+    "lines,applies",
+    [
+        (["line0", "line1", "line2", "line3"], True),
+        # Offset
+        (["extra", "line0", "line1", "line2"], True),
+        # Fuzz: up to two lines of context may differ
+        (["other", "line1", "line2", "line3"], True),
+        (["line0", "line1", "other", "line3"], True),
+        (["line0", "line1"], True),
+        (["line0", "other", "line2", "line3"], False),
+        # The hunk can't start before the first line
+        (["line1"], False),
+        ([], False),
+    ],
+)
+def test_apply_hunks(lines, applies):
+    hunk = parse_patch(QUILT_PATCH)[0].hunks[0]
+    patched, failed = apply_hunks(lines, [hunk])
+    if applies:
+        assert [] == failed
+        assert "LINE1" in patched
+        assert "line1" not in patched
+    else:
+        assert [(hunk, "does not apply")] == failed
+        assert lines == patched
+    assert ([], [(hunk, "does not apply")]) == apply_hunks([], [hunk], 0)
+
+
+def test_apply_hunks_at_file_start():
+    # Without leading context, the hunk can only apply at the file start
+    # unless fuzz is allowed
+    (hunk,) = parse_patch(
+        "--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n-line0\n+zero\n line1\n"
+    )[0].hunks
+    assert (["zero", "line1", "extra"], []) == apply_hunks(
+        ["line0", "line1", "extra"], [hunk], 0
+    )
+    lines = ["extra", "line0", "line1"]
+    assert (lines, [(hunk, "does not apply")]) == apply_hunks(lines, [hunk], 0)
+    assert (["extra", "zero", "line1"], []) == apply_hunks(lines, [hunk])
+
+
+def test_check_patches_apply(git_only_devel_setup):
+    commits = git_only_devel_setup
+    cpick = get_series()[0]
+    assert [] == check_patches_apply(commits[-1])
+
+    Path("debian/patches/first.patch").write_text(
+        "--- a/file.txt\n+++ b/file.txt\n@@ -1 +1 @@\n-line0\n+zero\n"
+    )
+    Path("debian/patches/second.patch").write_text(
+        "--- a/file.txt\n+++ b/file.txt\n@@ -1,2 +1,2 @@\n"
+        "-zero\n+0\n line1\n"
+        "@@ -4,2 +4,2 @@\n line3\n-nope\n+four\n"
+    )
+    Path("debian/patches/other.txt.patch").write_text(
+        "--- a/other.txt\n+++ b/other.txt\n@@ -1 +1 @@\n-nope\n+changed\n"
+    )
+    Path("debian/patches/series").write_text(
+        "first.patch\nother.patch\nsecond.patch\nother.txt.patch\n"
+        f"{cpick}\n"
+    )
+    failures = check_patches_apply(commits[-1], jobs=2)
+    assert [
+        "second.patch: file.txt: @@ -4,2 +4,2 @@ does not apply",
+        "other.txt.patch: other.txt: @@ -1 +1 @@ does not apply",
+    ] == [str(failure) for failure in failures]
+    # Patches are applied in order: without first.patch, second.patch's
+    # first hunk doesn't apply either
+    failures = check_patches_apply(commits[-1], skip=["first.patch"])
+    assert ["@@ -1,2 +1,2 @@", "@@ -4,2 +4,2 @@"] == [
+        failure.hunk for failure in failures if failure.patch == "second.patch"
+    ]
+    # The committed series applies, and isn't affected by the checkout
+    assert [] == check_patches_apply(commits[-1], "HEAD")
+    missing = check_patches_apply(commits[-1], skip=["other.patch"])
+    assert "other.txt.patch: other.txt: patches a missing file" in [
+        str(failure) for failure in missing
+    ]
+
+    # Patches are applied with the -p level the series gives them, and
+    # files are split at newlines only
+    Path("debian/patches/page.patch").write_text(
+        "--- file.txt\n+++ file.txt\n@@ -1,2 +1,2 @@\n"
+        " line0\n-line1\n+page\x0cbreak\n"
+        "@@ -2,2 +2,2 @@\n page\x0cbreak\n-line2\n+two\n"
+    )
+    Path("debian/patches/series").write_text("page.patch -p0\n")
+    assert [] == check_patches_apply(commits[-1])
+
+
+def test_find_applicable_commitish(git_only_devel_setup):
+    commits = git_only_devel_setup
+    Path("debian/patches/zero.patch").write_text(
+        "--- a/file.txt\n+++ b/file.txt\n@@ -1 +1 @@\n-line0\n+zero\n"
+    )
+    with open("debian/patches/series", "a") as f:
+        f.write("zero.patch\n")
+    sh("git add debian && git commit -q -m 'add zero.patch'")
+    sh("git checkout -q main")
+    for i in range(5, 12):
+        sh(f"echo 'line{i}' >> file.txt && git commit -q -am 'line{i}'")
+    sh("sed -i 's/line0/LINE0/' file.txt && git commit -q -am 'LINE0'")
+    breaking = capture("git rev-parse HEAD").stdout.strip()
+    sh("echo 'line12' >> file.txt && git commit -q -am 'line12'")
+    sh("git checkout -q ubuntu/devel")
+
+    with mock.patch(
+        "scripts.new_upstream_snapshot.capture", wraps=capture
+    ) as mock_capture:
+        result = find_applicable_commitish("main")
+    # The cpicks in each probe are found once, up front
+    walks = [
+        c.args[0]
+        for c in mock_capture.call_args_list
+        if c.args[0].startswith("git rev-list --parents")
+    ]
+    main = capture("git rev-parse main").stdout.strip()
+    assert [f"git rev-list --parents {main} ^HEAD"] == walks
+    assert breaking == result.breaking_commit
+    assert capture(f"git rev-parse {breaking}~").stdout.strip() == (
+        result.commit
+    )
+    # The cpick of line1 no longer applies either, but would be dropped
+    assert ["zero.patch: file.txt: @@ -1 +1 @@ does not apply"] == [
+        str(failure) for failure in result.failures
+    ]
+    assert result.probes <= 5
+    assert f"new_upstream_snapshot.py -c {result.commit}" in str(result)
+
+    result = find_applicable_commitish(commits[3])
+    assert (commits[3], None, [], 1) == result[1:]
+    with pytest.raises(CliError, match="not a valid commitish"):
+        find_applicable_commitish("does-not-exist")
+
+
+def test_distro_info(distro_info, tmp_path):
+    assert "bseries" == distro_info.devel().series
+    assert "10.04" == distro_info.stable().version
+    assert distro_info.stable().lts
+    assert ["aseries", "bseries"] == [
+        release.series for release in distro_info.supported()
+    ]
+    later = date(2012, 6, 1)
+    assert "11.04" == distro_info.stable(later).version
+    # aseries is only supported on servers by then
+    assert ["aseries", "cseries"] == [
+        release.series for release in distro_info.supported(later)
+    ]
+    assert "10.10" == distro_info.get("bseries").version
+    assert "cseries" == distro_info.get("11.04").series
+    with pytest.raises(CliError, match="Unknown Ubuntu release"):
+        distro_info.get("dseries")
+    with pytest.raises(CliError, match="is outdated"):
+        distro_info.devel(later)
+    with pytest.raises(CliError, match="Can't read distro-info data"):
+        DistroInfo(tmp_path / "missing.csv").devel()
+
+
+def test_snapshot_context(git_only_devel_setup):
+    context = SnapshotContext()
+    assert "bseries" == context.devel_distro
+    assert "bseries" == context.changelog_distro
+    details = context.changelog_details
+    add_msg_to_changelog(
+        "  * new", changelog_version=VersionInfo.from_string("9.9-0ubuntu1")
+    )
+    assert details is context.changelog_details
+    assert "bseries" == context.changelog_distro
+    context.invalidate_changelog()
+    assert "9.9-0ubuntu1" == str(context.changelog_details.version)
+    assert "bseries" == context.changelog_distro
+
+
+def test_add_msg_to_changelog(git_only_devel_setup, monkeypatch):
+    changelog = Path("debian/changelog")
+    released = changelog.read_text()
+    monkeypatch.delenv("DEBFULLNAME", raising=False)
+    monkeypatch.delenv("NAME", raising=False)
+    monkeypatch.setenv("DEBEMAIL", "Jane Roe <jane@example.com>")
+    monkeypatch.setenv("EMAIL", "ignored@example.com")
+
+    add_msg_to_changelog("  * refresh patches:\n    - d/p/other.patch")
+    details = ChangelogDetails.get()
+    assert f"{PACKAGED_VERSION}-0ubuntu2" == str(details.version)
+    assert "UNRELEASED" == details.distro
+    assert "medium" == details.urgency
+    assert "Jane Roe <jane@example.com>" == details.maintainer
+    assert abs(int(details.timestamp) - time.time()) < 60
+    assert changelog.read_text().endswith(f"\n\n{released}")
+
+    monkeypatch.setenv("DEBFULLNAME", "John Doe")
+    add_msg_to_changelog(
+        "  * Upstream snapshot based on main.",
+        changelog_version=VersionInfo.from_string("2.1-0ubuntu1"),
+    )
+    assert changelog.read_text().startswith(
+        "cloud-init (2.1-0ubuntu1) UNRELEASED; urgency=medium\n\n"
+        "  * refresh patches:\n"
+        "    - d/p/other.patch\n"
+        "  * Upstream snapshot based on main.\n\n"
+        " -- John Doe <jane@example.com>  "
+    )
+    assert changelog.read_text().endswith(f"\n\n{released}")
+    assert 2 == len(ChangelogIndex())
+    assert ["changelog", "patches"] == sorted(os.listdir("debian"))
+
+
+def test_add_msg_to_changelog_keeps_the_rest(git_only_devel_setup):
+    changelog = Path("debian/changelog")
+    released = changelog.read_text()
+    older = "cloud-init (1.0-0ubuntu1) aseries; urgency=medium\r\n\x0c\n"
+    changelog.write_text(
+        "cloud-init (2.1-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * page\x0cbreak\r\n"
+        "\n"
+        " -- J Doe <j.doe@example.com>  Fri, 12 Sep 2008 15:30:32 +0200\n"
+        "\n" + released + older,
+        newline="",
+    )
+    add_msg_to_changelog("  * refresh patches:")
+    content = changelog.read_bytes().decode()
+    assert content.startswith(
+        "cloud-init (2.1-0ubuntu1) UNRELEASED; urgency=medium\n"
+        "\n"
+        "  * page\x0cbreak\r\n"
+        "  * refresh patches:\n"
+        "\n"
+    )
+    assert content.endswith(f"\n\n{released}{older}")
+
+    changelog.write_text(released + older, newline="")
+    add_msg_to_changelog("  * refresh patches:")
+    assert changelog.read_bytes().decode().endswith(f"\n\n{released}{older}")
+
+
+def test_get_maintainer(monkeypatch):
+    for name in ("DEBFULLNAME", "NAME", "DEBEMAIL", "EMAIL"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "Git Author")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "git@example.com")
+    assert "Git Author <git@example.com>" == get_maintainer()
+    monkeypatch.setenv("EMAIL", "email@example.com")
+    assert "Git Author <email@example.com>" == get_maintainer()
+    monkeypatch.setenv("NAME", "Name")
+    monkeypatch.setenv("DEBEMAIL", "Deb Name <deb@example.com>")
+    assert "Name <deb@example.com>" == get_maintainer()
+
+
+def test_snapshot_context_subprocess_count(
+    git_only_devel_setup, capsys, monkeypatch
+):
+    commits = git_only_devel_setup
+    monkeypatch.setenv("DEBFULLNAME", "J Doe")
+    monkeypatch.setenv("DEBEMAIL", "j.doe@canonical.com")
+    with mock.patch(
+        "scripts.new_upstream_snapshot.capture", wraps=capture
+    ) as mock_capture, mock.patch(
+        "subprocess.Popen", wraps=subprocess.Popen
+    ) as popen:
+        new_upstream_snapshot("main", interactive=False)
+    GIT.close()
+
+    details = ChangelogDetails.get()
+    assert f"{PACKAGED_NEXT}~1g{commits[-1][:8]}-0ubuntu1" == str(
+        details.version
+    )
+    assert "dch -r -D bseries ''" in capsys.readouterr().out
+    commands = [c.args[0] for c in mock_capture.call_args_list]
+    assert len(commands) == len(set(commands)), commands
+    spawned = [c.args[0] for c in popen.call_args_list]
+    assert not any("dpkg-parsechangelog" in str(c) for c in spawned)
+    # describe, merge, cpick search, cpick commit, merge diff, refresh
+    # diff, bug search, changelog commit and current branch, plus cat-file
+    # sessions: restarted after commits, as the journal records HEAD
+    assert 14 == len(spawned), "\n".join(map(str, spawned))
+
+
+def test_snapshot_journal_resume(git_only_devel_setup, capsys):
+    commits = git_only_devel_setup
+    original_head = capture("git rev-parse HEAD").stdout.strip()
+    with mock.patch(
+        "scripts.new_upstream_snapshot.refresh_patches",
+        side_effect=CliError("quilt failed"),
+    ):
+        with pytest.raises(CliError, match="quilt failed"):
+            new_upstream_snapshot("main", interactive=False)
+    journal_path = Path(".git", SnapshotJournal.FILENAME)
+    journal = json.loads(journal_path.read_text())
+    assert original_head == journal["original_head"]
+    assert commits[-1] == journal["commit"]
+    assert ["merge", "drop cpicks"] == list(journal["stages"])
+
+    # The journal doesn't apply to another commitish, or once it moves
+    assert SnapshotJournal("main~").original_head is None
+    assert original_head == SnapshotJournal("main").original_head
+    sh("git branch -f moved main~ && git branch -f main moved")
+    GIT.invalidate()
+    assert SnapshotJournal("main").original_head is None
+    sh(f"git branch -f main {commits[-1]}")
+    GIT.invalidate()
+
+    with mock.patch(
+        "scripts.new_upstream_snapshot.merge_commitish"
+    ) as merge, mock.patch(
+        "scripts.new_upstream_snapshot.drop_cpicks"
+    ) as drop:
+        new_upstream_snapshot("main", interactive=False)
+    merge.assert_not_called()
+    drop.assert_not_called()
+    assert "Resuming the snapshot of main" in capsys.readouterr().out
+    details = ChangelogDetails.get()
+    assert f"{PACKAGED_NEXT}~1g{commits[-1][:8]}-0ubuntu1" == str(
+        details.version
+    )
+    assert "123454" in details.bugs_fixed
+    # The snapshot finished, so there's nothing left to resume
+    assert not journal_path.exists()
+
+
+def test_snapshot_journal_reset(git_only_devel_setup):
+    commits = git_only_devel_setup
+    with mock.patch(
+        "scripts.new_upstream_snapshot.refresh_patches",
+        side_effect=CliError("quilt failed"),
+    ):
+        with pytest.raises(CliError, match="quilt failed"):
+            new_upstream_snapshot("main", interactive=False)
+    assert SnapshotJournal("main").original_head
+    sh(f"git reset -q --hard {commits[-1]}")
+    assert SnapshotJournal("main").original_head is None
+
+
+def test_snapshot_journal_not_started(git_only_devel_setup):
+    with mock.patch(
+        "scripts.new_upstream_snapshot.merge_commitish",
+        side_effect=CliError("merge failed"),
+    ):
+        with pytest.raises(CliError, match="merge failed"):
+            new_upstream_snapshot("main", interactive=False)
+    assert SnapshotJournal("main").original_head
+    # HEAD moved before any stage completed
+    sh("git commit -q --allow-empty -m 'more packaging'")
+    GIT.invalidate()
+    assert SnapshotJournal("main").original_head is None
+
+
+def fail_upstream_file_check(commitish, fetch):
+    with mock.patch(
+        "scripts.new_upstream_snapshot.get_upstream_file_changes",
+        return_value=["file.txt"],
+    ):
+        merge_commitish(commitish, fetch=fetch)
+
+
+def fail_merge_then_commit(commitish, fetch):
+    sh(f"git merge -q --no-commit {commitish}")
+    # The conflicts are resolved by hand, and the merge committed
+    sh("git commit -q --no-edit")
+    raise CalledProcessError(1, "git merge")
+
+
+@pytest.mark.parametrize(
+    "failed_merge", [fail_upstream_file_check, fail_merge_then_commit]
+)
+def test_snapshot_journal_merge_committed(
+    git_only_devel_setup, capsys, failed_merge
+):
+    commits = git_only_devel_setup
+    original_head = capture("git rev-parse HEAD").stdout.strip()
+    with mock.patch(
+        "scripts.new_upstream_snapshot.merge_commitish",
+        side_effect=failed_merge,
+    ):
+        with pytest.raises((CliError, CalledProcessError)):
+            new_upstream_snapshot("main", interactive=False)
+    GIT.invalidate()
+    # HEAD moved to the merge before the merge stage completed
+    assert 2 == GIT.parent_count("HEAD")
+    journal = SnapshotJournal("main")
+    assert original_head == journal.original_head
+    assert journal.merged
+
+    with mock.patch("scripts.new_upstream_snapshot.merge_commitish") as merge:
+        new_upstream_snapshot("main", interactive=False)
+    merge.assert_not_called()
+    out = capsys.readouterr().out
+    assert "Resuming the snapshot of main" in out
+    assert "main was already merged" in out
+    details = ChangelogDetails.get()
+    assert f"{PACKAGED_NEXT}~1g{commits[-1][:8]}-0ubuntu1" == str(
+        details.version
+    )
+    assert "123454" in details.bugs_fixed
+    assert not Path(".git", SnapshotJournal.FILENAME).exists()
+
+
+def test_snapshot_journal_merged_upstream_files(git_only_devel_setup):
+    with mock.patch(
+        "scripts.new_upstream_snapshot.merge_commitish",
+        side_effect=fail_upstream_file_check,
+    ):
+        with pytest.raises(CliError):
+            new_upstream_snapshot("main", interactive=False)
+    # Resuming from the merge checks it again
+    with mock.patch(
+        "scripts.new_upstream_snapshot.get_upstream_file_changes",
+        return_value=["file.txt"],
+    ):
+        with pytest.raises(CliError, match="changes to upstream files"):
+            new_upstream_snapshot("main", interactive=False)
+    assert not SnapshotJournal("main").is_done("merge")
+
+
+def test_back_to_back_snapshots(git_only_devel_setup, capsys):
+    commits = git_only_devel_setup
+    new_upstream_snapshot("main", interactive=False)
+    assert not Path(".git", SnapshotJournal.FILENAME).exists()
+    capsys.readouterr()
+
+    sh(
+        "git checkout -q main && echo line5 >> file.txt && "
+        "git commit -q -am 'line5\n\nLP: #1234565' && "
+        "git checkout -q ubuntu/devel"
+    )
+    new_main = capture("git rev-parse main").stdout.strip()
+    new_upstream_snapshot("main", interactive=False)
+
+    assert "Resuming" not in capsys.readouterr().out
+    assert not capture(
+        f"git merge-base --is-ancestor {new_main} HEAD", check=False
+    ).returncode
+    details = ChangelogDetails.get()
+    assert f"{PACKAGED_NEXT}~2g{new_main[:8]}-0ubuntu1" == str(details.version)
+    assert "1234565" in details.bugs_fixed
+    assert (
+        f"based on main at {new_main[:8]}"
+        in Path("debian/changelog").read_text()
+    )
+    assert commits[-1] != new_main
+
+
+def test_cassette_replays_results(tmp_path):
+    cassette = tmp_path / "cassette.json"
+    failing = "echo oops >&2; exit 3"
+    CASSETTE.record(cassette)
+    try:
+        assert "hi\n" == capture("echo hi").stdout
+        with pytest.raises(CalledProcessError):
+            capture(failing)
+        assert ["a", "b"] == list(stream("printf 'a\\0b'"))
+    finally:
+        CASSETTE.stop()
+
+    CASSETTE.replay(cassette)
+    try:
+        with mock.patch("subprocess.Popen", side_effect=AssertionError):
+            assert "hi\n" == capture("echo hi").stdout
+            with pytest.raises(CalledProcessError) as error:
+                capture(failing)
+            assert 3 == error.value.returncode
+            assert "oops\n" == error.value.stderr
+            assert ["a", "b"] == list(stream("printf 'a\\0b'"))
+            with pytest.raises(CliError, match="was not recorded"):
+                capture("echo hi")
+    finally:
+        CASSETTE.stop()
+
+
+def test_cassette_replays_snapshot(
+    git_only_devel_setup, tmp_path_factory, monkeypatch
+):
+    monkeypatch.setenv("DEBFULLNAME", "J Doe")
+    monkeypatch.setenv("DEBEMAIL", "j.doe@canonical.com")
+    replay_checkout = tmp_path_factory.mktemp("replay") / "checkout"
+    shutil.copytree(os.getcwd(), replay_checkout, symlinks=True)
+    cassette = tmp_path_factory.mktemp("cassette") / "snapshot.json"
+
+    CASSETTE.record(cassette)
+    try:
+        new_upstream_snapshot("main", interactive=False)
+    finally:
+        CASSETTE.stop()
+    recorded = Path("debian/changelog").read_text()
+
+    os.chdir(replay_checkout)
+    CASSETTE.replay(cassette)
+    try:
+        with mock.patch("subprocess.Popen", side_effect=AssertionError):
+            new_upstream_snapshot("main", interactive=False)
+    finally:
+        CASSETTE.stop()
+    replayed = Path("debian/changelog").read_text()
+
+    def without_dates(changelog):
+        return [line for line in changelog.splitlines() if " -- " not in line]
+
+    assert without_dates(recorded) == without_dates(replayed)
+
+
+CASSETTES = Path(__file__).parent / "cassettes"
+# Snapshots replayed from CASSETTES, each made on a packaging branch
+# from create_git_only_packaging(): (branch, commitish or index of a main
+# commit, new_upstream_snapshot() arguments, lines the new changelog has)
+SNAPSHOT_CASSETTES = {
+    "devel-main": (
+        "ubuntu/devel",
+        "main",
+        {},
+        [
+            f"cloud-init ({PACKAGED_NEXT}~1g",
+            "  * Upstream snapshot based on main at ",
+            "    - Bugs fixed in this snapshot: "
+            "(LP: #123454, #123453, #123452, #123451)",
+        ],
+    ),
+    "devel-tag": (
+        "ubuntu/devel",
+        UPSTREAM_MAIN_VERSION,
+        {"no_sru_bug": True},
+        [
+            f"cloud-init ({UPSTREAM_MAIN_VERSION}-0ubuntu1) UNRELEASED;",
+            f"  * Upstream snapshot based on {UPSTREAM_MAIN_VERSION}.\n",
+            "    List of changes from upstream can be found at",
+            "    - Bugs fixed in this snapshot: (LP: #123453, #123452,",
+        ],
+    ),
+    "devel-commit": (
+        "ubuntu/devel",
+        2,
+        {"no_sru_bug": True},
+        [
+            f"cloud-init ({PACKAGED_NEXT}~1g",
+            "    - Bugs fixed in this snapshot: (LP: #123452, #123451)",
+        ],
+    ),
+    "sru-main": (
+        "ubuntu/aseries",
+        "main",
+        {"bug": "1234567"},
+        [
+            f"cloud-init ({PACKAGED_VERSION}-0ubuntu0~10.04.2) UNRELEASED;",
+            "  * Upstream snapshot based on main at ",
+            ". (LP: #1234567)",
+        ],
+    ),
+    "sru-tag": (
+        "ubuntu/aseries",
+        UPSTREAM_MAIN_VERSION,
+        {"no_sru_bug": True},
+        [
+            f"cloud-init ({UPSTREAM_MAIN_VERSION}-0ubuntu0~10.04.1) "
+            "UNRELEASED;",
+            "    List of changes from upstream can be found at",
+        ],
+    ),
+}
+
+
+def read_debian():
+    return {
+        str(path): path.read_text()
+        for path in sorted(Path("debian").rglob("*"))
+        if path.is_file()
+    }
+
+
+def record_snapshot_cassette(name, cassette, monkeypatch, capsys):
+    """Record SNAPSHOT_CASSETTES[name] in a new repo in the cwd.
+
+    Commit and changelog dates are fixed, so recording again gives the
+    same commits.
+    """
+    branch, commitish, kwargs, _ = SNAPSHOT_CASSETTES[name]
+    for variable in ("GIT_AUTHOR_DATE", "GIT_COMMITTER_DATE"):
+        monkeypatch.setenv(variable, "2010-06-01T12:00:00+0000")
+    for variable in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        monkeypatch.setenv(variable, "J Doe")
+    for variable in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        monkeypatch.setenv(variable, "j.doe@canonical.com")
+    commits = create_main_branch()
+    if branch == "ubuntu/devel":
+        create_git_only_packaging(commits)
+    else:
+        create_git_only_packaging(
+            commits, branch, f"{PACKAGED_VERSION}-0ubuntu0~10.04.1", "aseries"
+        )
+    if isinstance(commitish, int):
+        commitish = commits[commitish]
+    capsys.readouterr()
+    CASSETTE.record(cassette)
+    try:
+        new_upstream_snapshot(commitish, interactive=False, **kwargs)
+    finally:
+        CASSETTE.stop()
+    recorded = json.loads(cassette.read_text())
+    recorded["snapshot"] = {"commitish": commitish, **kwargs}
+    recorded["expected"] = {
+        "stdout": capsys.readouterr().out,
+        "files": read_debian(),
+    }
+    cassette.write_text(json.dumps(recorded, indent=1) + "\n")
+
+
+@pytest.mark.parametrize("name", sorted(SNAPSHOT_CASSETTES))
+def test_snapshot_cassette(name, tmp_path, monkeypatch, capsys):
+    """Replay a snapshot from its cassette, without running any command.
+
+    Set RECORD_CASSETTES=1 to record the cassette again first, with git.
+    """
+    cassette = CASSETTES / f"{name}.json"
+    monkeypatch.setenv("DEBFULLNAME", "J Doe")
+    monkeypatch.setenv("DEBEMAIL", "j.doe@canonical.com")
+    monkeypatch.setattr(
+        "scripts.new_upstream_snapshot.formatdate",
+        lambda localtime: "Tue, 01 Jun 2010 12:00:00 +0000",
+    )
+    if os.environ.get("RECORD_CASSETTES"):
+        (tmp_path / "record").mkdir()
+        monkeypatch.chdir(tmp_path / "record")
+        record_snapshot_cassette(name, cassette, monkeypatch, capsys)
+    recorded = json.loads(cassette.read_text())
+    (tmp_path / "replay").mkdir()
+    monkeypatch.chdir(tmp_path / "replay")
+    monkeypatch.setenv("PATH", "")
+
+    CASSETTE.replay(cassette)
+    try:
+        CASSETTE.restore(".")
+        with mock.patch("subprocess.Popen", side_effect=AssertionError):
+            new_upstream_snapshot(interactive=False, **recorded["snapshot"])
+    finally:
+        CASSETTE.stop()
+
+    expected = recorded["expected"]
+    assert expected["stdout"] == capsys.readouterr().out
+    files = read_debian()
+    assert expected["files"] == files
+    changelog = files["debian/changelog"]
+    entry = changelog[: changelog.index("\n -- ")]
+    for line in SNAPSHOT_CASSETTES[name][3]:
+        assert line in entry
+
+
+def fake_snapshot(commitish, bug, **kwargs):
+    """Stand-in for new_upstream_snapshot() run by snapshot_branches()."""
+    assert not kwargs["interactive"]
+    branch = capture("git rev-parse --abbrev-ref HEAD").stdout
+    if "aseries" in branch:
+        raise CliError("Failed applying patch 'some-patch'")
+    if "bseries" in branch:
+        raise KeyError("distro")
+    print(f"snapshot of {commitish} in {os.getcwd()}")
+    sh("echo 'command output' && echo 'command error' >&2")
+    print("after the command")
+    sh(
+        "sed -i -e '1s/1.4-0ubuntu1/2.1-0ubuntu1/' debian/changelog && "
+        "git commit -q -am 'snapshot'"
+    )
+
+
+def test_snapshot_branches(git_only_devel_setup):
+    sh("git branch ubuntu/bseries")
+    sh("git branch ubuntu/aseries && git checkout -q ubuntu/aseries")
+
+    branches = [
+        "ubuntu/devel",
+        "ubuntu/aseries",
+        "ubuntu/bseries",
+        "ubuntu/missing",
+    ]
+    with mock.patch(
+        "scripts.new_upstream_snapshot.new_upstream_snapshot",
+        side_effect=fake_snapshot,
+    ):
+        results = snapshot_branches(branches, "main", jobs=2)
+
+    assert branches == [result.branch for result in results]
+    devel, aseries, bseries, missing = results
+    assert "2.1-0ubuntu1" == devel.version
+    assert "snapshot of main in " in devel.output
+    # Commands' output is logged in order with what is printed
+    assert "command output\ncommand error\nafter the command\n" in (
+        devel.output
+    )
+    assert "snapshot" in capture("git log -1 --format=%s ubuntu/devel").stdout
+    assert aseries.version is None
+    assert "Failed applying patch 'some-patch'" == aseries.error
+    assert (None, "KeyError: 'distro'") == (bseries.version, bseries.error)
+    assert "Traceback" in bseries.output
+    assert missing.error
+    # Only the main worktree is left
+    assert 1 == len(capture("git worktree list").stdout.splitlines())
+
+    report = format_batch_report(results)
+    assert "ubuntu/devel    2.1-0ubuntu1" in report
+    assert "ubuntu/aseries  FAILED: Failed applying patch" in report
+
+
+def test_snapshot_branches_ambiguous_devel(git_only_devel_setup, mock_new_sru):
+    # The changelog is for bseries, but cseries is now in development
+    head = capture("git rev-parse HEAD").stdout.strip()
+    (result,) = snapshot_branches(["ubuntu/devel"], "main")
+    assert result.version is None
+    assert "Snapshot this branch with -d" in result.error
+    # The branch failed before it was changed
+    assert head == capture("git rev-parse HEAD").stdout.strip()
+    report = format_batch_report([result])
+    assert "ubuntu/devel  FAILED: d/changelog shows" in report
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler()
+    profiler.enabled = True
+    with mock.patch("scripts.new_upstream_snapshot.PROFILER", profiler):
+        with profiler.span("merge"):
+            capture("echo hello")
+            sh("exit 3", check=False)
+            with pytest.raises(CalledProcessError):
+                sh("exit 2")
+
+    assert ["echo hello", "exit 3", "exit 2", "merge"] == [
+        event.name for event in profiler.events
+    ]
+    summary = profiler.summary().splitlines()
+    assert summary[1].startswith("stage   merge ")
+    assert any(line.startswith("command exit 3 ") for line in summary)
+
+    trace_file = tmp_path / "trace.json"
+    profiler.write_chrome_trace(trace_file)
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert [0, 3, 2] == [e["args"]["returncode"] for e in events[:3]]
+    merge = events[3]
+    assert {"X"} == {e["ph"] for e in events}
+    for command in events[:3]:
+        assert command["cat"] == "command"
+        assert merge["ts"] <= command["ts"]
+        assert command["ts"] + command["dur"] <= merge["ts"] + merge["dur"]
+
+
+def test_profiler_disabled():
+    profiler = Profiler()
+    with profiler.span("merge") as trace_args:
+        trace_args["ignored"] = True
+    assert [] == profiler.events
+
+
+def test_get_bugs_fixed_devel(main_setup):
+    commits = main_setup
+    sh(f"git checkout -q -b ubuntu/devel {commits[0]}")
+    sh("git checkout -q main")
+    sh("git commit -q --allow-empty -m 'LP: #200\nLP: #201'")
+    sh(
+        "git commit -q --allow-empty -m 'multi\n\n"
+        "Fix it. LP: #999 is not at the start of a line\n"
+        "LP: #300, #301,#302\n\nLP: #123451'"
+    )
+    sh("git commit -q --allow-empty -m 'no bugs here'")
+    sh("git checkout -q ubuntu/devel && git merge -q --no-ff --no-edit main")
+
+    assert "HEAD~1" == get_original_head()
+    assert [
+        "300",
+        "301",
+        "302",
+        "123451",
+        "200",
+        "201",
+        "123454",
+        "123453",
+        "123452",
+    ] == list(get_bugs_fixed_devel())
+    assert ["123452"] == list(
+        get_bugs_fixed_devel(f"{commits[1]}..{commits[2]}")
+    )
+
+
+def test_stream():
+    assert ["a", "b\nc", ""] == list(stream("printf 'a\\0b\\nc\\0\\0'"))
+    assert ["x"] == list(stream("printf 'x,y'", separator=","))[:1]
+    lines = stream("yes", separator="\n")
+    assert "y" == next(lines)
+    lines.close()  # Must not hang waiting for 'yes' to finish
+    with pytest.raises(CalledProcessError):
+        list(stream("echo out; exit 3"))
+
+
+def test_get_upstream_file_changes(git_only_devel_setup):
+    commits = git_only_devel_setup
+    assert [] == get_upstream_file_changes(commits[0])
+    assert ["file.txt"] == get_upstream_file_changes(commits[1])
+
+    for i in range(5):
+        Path(f"dir{i}").mkdir()
+        Path(f"dir{i}/file").write_text("not upstream")
+    sh("git add . && git commit -q -m 'add upstream files'")
+    GIT.invalidate()
+    changes = get_upstream_file_changes(commits[0], limit=3)
+    assert ["dir0/file", "dir1/file", "dir2/file"] == changes
+    assert 5 == len(get_upstream_file_changes(commits[0], limit=None))
+
+
+@pytest.mark.parametrize(
+    "count,more", [(12, "file09, ...."), (11, "file09, ...."), (10, "file09.")]
+)
+def test_merge_commitish_upstream_file_check(
+    git_only_devel_setup, count, more
+):
+    commits = git_only_devel_setup
+    for i in range(count):
+        Path(f"file{i:02}").write_text("not upstream")
+    sh("git add . && git commit -q -m 'add upstream files'")
+    with mock.patch(
+        "scripts.new_upstream_snapshot.get_upstream_file_changes",
+        get_upstream_file_changes,
+    ):
+        with pytest.raises(CliError) as error:
+            merge_commitish(commits[2])
+    assert (
+        "Merge resulted in changes to upstream files: file00, file01, "
+        f"file02, file03, file04, file05, file06, file07, file08, {more} Fix"
+    ) in str(error.value)
+
+
+MULTI_ENTRY_CHANGELOG = """\
+cloud-init (2.1~1gabcdef12-0ubuntu1) UNRELEASED; urgency=medium
+
+  * Upstream snapshot based on main at abcdef12.
+    - Bugs fixed in this snapshot: (LP: #123454, #123453)
+
+
+  * refresh patches:
+    - d/p/some-patch
+    LP: #99, #12 lp: #7
+
+
+ -- J Doe <j.doe@canonical.com>  Fri, 12 Sep 2008 15:30:32 +0200
+
+cloud-init (1.4-0ubuntu1) bseries bseries-proposed; urgency=low
+
+  * Initial release
+
+ -- J Doe <j.doe@canonical.com>  Thu, 11 Sep 2008 15:30:32 -0400
+
+cloud-init (1.3-0ubuntu1) aseries; urgency=high
+  * Older release
+ -- A Person <a@example.com> Mon, 01 Sep 2008 01:02:03 +0000
+"""
+
+
+def parse_dpkg_output(output):
+    fields = {}
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("Changes:"):
+            fields["Changes"] = "\n".join(lines[i + 1 :])
+            break
+        key, _, value = line.partition(": ")
+        fields[key] = value
+    return fields
+
+
+@pytest.mark.skipif(
+    not shutil.which("dpkg-parsechangelog"),
+    reason="dpkg-parsechangelog not installed",
+)
+def test_changelog_index_matches_dpkg_parsechangelog(tmp_path):
+    changelog = tmp_path / "changelog"
+    changelog.write_text(MULTI_ENTRY_CHANGELOG)
+    index = ChangelogIndex(changelog)
+    assert 3 == len(index)
+    for offset in range(len(index)):
+        expected = parse_dpkg_output(
+            capture(
+                f"dpkg-parsechangelog -l {changelog} "
+                f"--count=1 --offset={offset}"
+            ).stdout
+        )
+        details = index.get(offset)
+        assert expected["Source"] == details.source
+        assert expected["Version"] == str(details.version)
+        assert expected["Distribution"] == details.distro
+        assert expected["Urgency"] == details.urgency
+        assert expected["Maintainer"] == details.maintainer
+        assert expected["Timestamp"] == details.timestamp
+        assert expected["Date"] == details.date
+        assert expected["Changes"] == details.changes
+        # Only Ubuntu's dpkg reports Launchpad bugs
+        if "Launchpad-Bugs-Fixed" in expected:
+            assert expected["Launchpad-Bugs-Fixed"] == details.bugs_fixed
+
+
+def test_changelog_index_random_access(tmp_path):
+    changelog = tmp_path / "changelog"
+    changelog.write_text(MULTI_ENTRY_CHANGELOG)
+    index = ChangelogIndex(changelog)
+    assert "1.3-0ubuntu1" == str(index.get(2).version)
+    assert "2.1~1gabcdef12-0ubuntu1" == str(index.get(0).version)
+    assert "7 12 99 123453 123454" == index.get(0).bugs_fixed
+    assert "" == index.get(3).distro
+
 
 @pytest.mark.parametrize(
     "src_version,major,minor,hotfix,pre_revision,pre_commit,debian,ubuntu",
@@ -494,3 +1749,106 @@ def test_release_instructions(devel_setup, capsys):
         pre_changelog.changes.splitlines()[1:]
         == post_changelog.changes.splitlines()[1:]
     )
+
+
+def generate_versions(count, seed=0):
+    """Generate cloud-init style versions for ordering tests."""
+    rng = random.Random(seed)
+    versions = []
+    for _ in range(count):
+        major, minor = rng.randint(22, 24), rng.randint(1, 4)
+        upstream = f"{major}.{minor}"
+        kind = rng.choice(["release", "hotfix", "snapshot"])
+        if kind == "hotfix":
+            upstream += f".{rng.randint(0, 3)}"
+        elif kind == "snapshot":
+            upstream += f"~{rng.randint(1, 12)}g{rng.getrandbits(32):08x}"
+        version = f"{upstream}-0ubuntu{rng.randint(0, 3)}"
+        if kind != "snapshot" and rng.random() < 0.5:
+            version += f"~{rng.choice(['20.04', '22.04', '24.04'])}"
+            version += f".{rng.randint(1, 3)}"
+        if rng.random() < 0.1:
+            version = f"1:{version}"
+        versions.append(version)
+    return versions
+
+
+@pytest.mark.parametrize(
+    "lower,higher",
+    (
+        ("23.1-0ubuntu1", "23.1-0ubuntu2"),
+        ("23.1~1g0cb0b80f-0ubuntu1", "23.1-0ubuntu1"),
+        ("23.1-0ubuntu1~22.04.1", "23.1-0ubuntu1"),
+        ("23.1-0ubuntu1~22.04.1", "23.1-0ubuntu1~22.04.2"),
+        ("23.1-0ubuntu1~20.04.9", "23.1-0ubuntu1~22.04.1"),
+        ("23.4.4-0ubuntu0~22.04.1", "24.1-0ubuntu0~22.04.1"),
+        ("24.1-0ubuntu1", "1:22.1-0ubuntu1"),
+        ("1.0~rc1", "1.0"),
+        ("1.0", "1.0+b1"),
+        ("1.0", "1.0a"),
+        ("0~", "0"),
+        ("1.0~~", "1.0~"),
+    ),
+)
+def test_compare_versions(lower, higher):
+    assert -1 == compare_versions(lower, higher)
+    assert 1 == compare_versions(higher, lower)
+    assert 0 == compare_versions(higher, higher)
+
+
+def test_compare_versions_equivalent():
+    assert 0 == compare_versions("0:1.0-1", "1.0-1")
+    assert 0 == compare_versions("1.01-1", "1.1-1")
+    assert 0 == compare_versions("1.0", "1.0-")
+
+
+def test_version_info_ordering():
+    versions = VersionInfo.parse_many(generate_versions(200))
+    ordered = sorted(versions)
+    for lower, higher in zip(ordered, ordered[1:]):
+        assert compare_versions(str(lower), str(higher)) <= 0
+    assert VersionInfo.from_string("23.1-0ubuntu1") == VersionInfo(
+        23, 1, debian=0, ubuntu=1
+    )
+    assert {VersionInfo(23, 1, debian=0, ubuntu=1)} == {
+        VersionInfo.from_string("0:23.1-0ubuntu1")
+    }
+    newest = max(versions)
+    assert newest < newest.replace(epoch=9)
+    assert not hasattr(newest, "__dict__")
+
+
+def test_version_info_sort_key_follows_changes():
+    version = VersionInfo.from_string("23.1-0ubuntu1")
+    older = VersionInfo.from_string("23.1-0ubuntu2")
+    assert version < older
+    version.ubuntu = 3
+    assert version > older
+
+
+def test_parse_many_matches_from_string():
+    versions = generate_versions(100) + ["23.2", "23.1.1"]
+    assert [str(VersionInfo.from_string(v)) for v in versions] == [
+        str(v) for v in VersionInfo.parse_many(versions)
+    ]
+
+
+@pytest.mark.skipif(not shutil.which("dpkg"), reason="dpkg not installed")
+def test_version_ordering_matches_dpkg():
+    versions = generate_versions(60, seed=1)
+    pairs = list(zip(versions, reversed(versions)))
+    for a, b in pairs:
+        if sh(f"dpkg --compare-versions {a} lt {b}", check=False).returncode:
+            expected = (
+                0
+                if sh(
+                    f"dpkg --compare-versions {a} eq {b}", check=False
+                ).returncode
+                == 0
+                else 1
+            )
+        else:
+            expected = -1
+        version_a, version_b = VersionInfo.parse_many([a, b])
+        assert expected == compare_versions(a, b), (a, b)
+        assert (expected == -1) == (version_a < version_b), (a, b)